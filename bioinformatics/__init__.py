@@ -30,12 +30,52 @@ manipulation of atomic struct objects
 """
 
 import os
+import subprocess
+import pyworkflow as pw
 import pyworkflow.utils as pwutils
 import pwem
 from .bibtex import _bibtexStr
 
 _logo = 'tool.png'
 
+class RDKitWorker:
+    """ Long-lived RDKit process that executes the jobs of a protocol run.
+        It avoids activating the conda environment and importing RDKit for every molecule.
+        Use it as a context manager so that it is shut down when the run ends.
+    """
+    def __init__(self, command, env=None, cwd=None):
+        self.process = subprocess.Popen(command, shell=True, executable='/bin/bash', env=env, cwd=cwd,
+                                        stdin=subprocess.PIPE, stdout=subprocess.PIPE,
+                                        universal_newlines=True, bufsize=1)
+
+    def submit(self, *job):
+        """ Send a job and wait for its answer. A RuntimeError is raised if the job fails."""
+        if self.process.poll() is not None:
+            raise RuntimeError("The RDKit worker is not running (exit code %s)" % self.process.returncode)
+        self.process.stdin.write("\t".join(job) + "\n")
+        self.process.stdin.flush()
+        answer = self.process.stdout.readline().rstrip('\n')
+        if answer != "OK":
+            raise RuntimeError("RDKit job %s failed: %s" % (" ".join(job), answer))
+
+    def draw(self, fnIn, fnOut):
+        self.submit("draw", fnIn, fnOut)
+
+    def close(self):
+        if self.process.poll() is None:
+            try:
+                self.process.stdin.write("quit\n")
+                self.process.stdin.close()
+            except OSError:
+                pass
+            self.process.wait()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
 class Plugin(pwem.Plugin):
     @classmethod
     def defineBinaries(cls, env):
@@ -62,6 +102,10 @@ class Plugin(pwem.Plugin):
         cls._defineVar("RDKIT_ENV_ACTIVATION", 'conda activate my-rdkit-env')
         cls._defineEmVar('MGL_HOME', 'mgltools-1.5.6')
         cls._defineEmVar('AUTODOCK_HOME', 'autodock-4.2.6')
+        # Records downloaded from remote databases, shared by all projects
+        cls._defineVar("BIOINFORMATICS_CACHE_DIR", os.path.join(pw.Config.SCIPION_USER_DATA, 'bioinformaticsCache'))
+        cls._defineVar("BIOINFORMATICS_CACHE_DAYS", '30')
+        cls._defineVar("BIOINFORMATICS_CACHE_MB", '2048')
 
     @classmethod
     def getRDKitEnvActivation(cls):
@@ -114,6 +158,13 @@ class Plugin(pwem.Plugin):
         fullProgram = '%s %s && %s' % (cls.getCondaActivationCmd(), cls.getRDKitEnvActivation(), program)
         protocol.runJob(fullProgram, args, env=cls.getEnviron(), cwd=cwd)
 
+    @classmethod
+    def startRDKitWorker(cls, cwd=None):
+        """ Start a persistent rdkit process. Jobs are submitted to it through its stdin, see RDKitWorker."""
+        program = '%s %s && python3 %s server' % (cls.getCondaActivationCmd(), cls.getRDKitEnvActivation(),
+                                                  cls.getPluginHome('utils/rdkitUtils.py'))
+        return RDKitWorker(program, env=cls.getEnviron(), cwd=cwd)
+
     @classmethod
     def getMGLEnviron(cls):
         """ Create the needed environment for MGL Tools programs. """
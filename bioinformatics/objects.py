@@ -23,8 +23,20 @@
 # *
 # **************************************************************************
 
+import os
+
 import pyworkflow.object as pwobj
 import pwem.objects.data as data
+from bioinformatics.utils.columnSnapshot import updateColumnSnapshot
+from bioinformatics.utils.moleculeFiles import readMoleculeRecord
+from bioinformatics.utils.setUtils import iterSetRows
+
+def _updateSnapshot(setObj):
+    """ Columnar snapshot of a set that is not being streamed (see bioinformatics.utils.columnSnapshot).
+        It is called from write, which only the protocol that produces the set calls (e.g. through
+        _defineOutputs), so reading an input set never writes a snapshot"""
+    if not setObj.isStreamOpen() and setObj.getSize()>0:
+        updateColumnSnapshot(setObj.getFileName())
 
 
 class DatabaseID(data.EMObject):
@@ -52,13 +64,150 @@ class DatabaseID(data.EMObject):
         if copyId:
             self.copyObjId(other)
 
+    def getColumns(self):
+        """ List of (attribute, class) of the entry, as expected by SetOfDatabaseID.appendMany"""
+        return [(name, type(attr)) for name, attr in self.getAttributes() if not attr.isPointer()]
+
+    def getRow(self, copyId=False):
+        """ Dictionary attribute -> value of the entry, with its objId if copyId (see appendMany)"""
+        row = {name: attr.get() for name, attr in self.getAttributes() if not attr.isPointer()}
+        if copyId:
+            row['objId'] = self.getObjId()
+        return row
+
 class SetOfDatabaseID(data.EMSet):
     """ Set of DatabaseIDs """
     ITEM_TYPE = DatabaseID
     FILE_TEMPLATE_NAME = 'setOfDatabaseIds%s.sqlite'
 
     def __init__(self, **kwargs):
+        kwargs.setdefault('indexes', ['dbId'])
         data.EMSet.__init__(self, **kwargs)
+        self._appendManyPlan = None
+
+    def appendMany(self, rows, columns, **constants):
+        """ Append many entries in bulk. rows are dictionaries attribute -> value or tuples with one value per
+            column, columns is a list of attribute names (String) or (name, class) pairs, and the constants
+            (e.g. database='pdb') are given to every row. A dictionary may also give the objId of the entry,
+            otherwise the entries are numbered as with append.
+            The first row is appended as a template entry, which creates the tables and the insert command of
+            the set file, and the rest are inserted with a single executemany of that command, without
+            building a DatabaseID per row. As with append, they are committed when the set is written.
+            All the calls on a set must use the same columns."""
+        columns = [column if isinstance(column, tuple) else (column, pwobj.String) for column in columns]
+        key = (tuple(columns), tuple(sorted(constants.items())))
+        if self._appendManyPlan is None:
+            template = DatabaseID()
+            for name, attrClass in columns+[(name, pwobj.String) for name in constants]:
+                if not hasattr(template, name):
+                    setattr(template, name, attrClass())
+            for name, value in constants.items():
+                getattr(template, name).set(value)
+            names = [name for name, _ in columns]
+            self._appendManyPlan = (key, template, names, set(names) | set(constants) | {'objId'})
+        elif self._appendManyPlan[0] != key:
+            raise ValueError("appendMany: the columns %s do not match the columns %s of the previous calls" %
+                             ([name for name, _ in columns], [name for name, _ in self._appendManyPlan[0][0]]))
+        _, template, names, allowed = self._appendManyPlan
+
+        def fillTemplate(row):
+            """ Set the attributes of the template from a row. It returns the objId of the row or None"""
+            if isinstance(row, dict):
+                unknown = [name for name in row if not name in allowed]
+                if len(unknown)>0:
+                    raise ValueError("appendMany: %s are not among the declared columns %s" %
+                                     (", ".join(unknown), ", ".join(names)))
+                for name in names:
+                    getattr(template, name).set(row.get(name, constants.get(name)))
+                for name, value in constants.items():
+                    if not name in names:
+                        getattr(template, name).set(row.get(name, value))
+                return row.get('objId')
+            for name, value in zip(names, row):
+                getattr(template, name).set(value)
+            for name, value in constants.items():
+                if not name in names:
+                    getattr(template, name).set(value)
+            return None
+
+        def appendTemplate(row):
+            objId = fillTemplate(row)
+            if objId is not None:
+                template.setObjId(objId)
+            self.append(template)
+            template.cleanObjId()
+
+        rows = iter(rows)
+        db = getattr(self._getMapper(), 'db', None)
+        if getattr(db, 'INSERT_OBJECT', None) is None:
+            # The first row goes through append, that creates the tables and the insert command
+            for row in rows:
+                appendTemplate(row)
+                break
+            db = getattr(self._getMapper(), 'db', None)
+            if getattr(db, 'INSERT_OBJECT', None) is None:
+                # Not a flat set file, insert the rest one by one
+                for row in rows:
+                    appendTemplate(row)
+                return
+
+        def iterRecords():
+            # Same arguments as the mapper gives to the insert command for each appended item
+            for row in rows:
+                objId = fillTemplate(row)
+                if objId is None:
+                    self._idCount += 1
+                    objId = self._idCount
+                else:
+                    self._idCount = max(self._idCount, objId)
+                self._size.increment()
+                yield [objId, template.isEnabled(), template.getObjLabel(), template.getObjComment()] + \
+                      list(template.getObjDict().values())
+        db.cursor.executemany(db.INSERT_OBJECT, iterRecords())
+
+    def iterRows(self, columns=None, chunk=None):
+        """ Read-only iteration over the entries written to the set file. Each row is a light tuple with
+            objId and the requested columns (all if None) as attributes, e.g. row._DaliZscore.
+            chunk=(i, n) restricts it to the i-th of n id ranges"""
+        if self.getSize()==0:
+            return iter([])
+        return iterSetRows(self.getFileName(), columns, chunk=chunk)
+
+    def createIndex(self, *columns):
+        """ Create SQLite indexes on some attributes of the entries, dbId is indexed when the set is created.
+            SQLite keeps them up to date as entries are added"""
+        mapper = self._getMapper()
+        if mapper.doCreateTables:
+            # The mapper shares this list and creates the indexes with the tables
+            self._indexes.extend([column for column in columns if not column in self._indexes])
+            return
+        db = mapper.db
+        columnNames = {row['label_property']: row['column_name'] for row in db.getClassRows()}
+        for column in columns:
+            db.executeCommand("CREATE INDEX IF NOT EXISTS index_%s ON Objects (%s)" %
+                              (column.replace('.', '_'), columnNames[column]))
+        db.commit()
+
+    def lookup(self, column, values, columns=None):
+        """ Light rows (see iterRows) of the entries whose column takes one of values. It is a single query
+            that uses the index of the column, if there is one"""
+        if self.getSize()==0:
+            return iter([])
+        return iterSetRows(self.getFileName(), columns, column, values)
+
+    def getByDbId(self, dbId):
+        """ First entry with this dbId or None. As with set[objId], the entry is reused by the next query"""
+        for row in self.lookup('dbId', [dbId], []):
+            return self[row.objId]
+        return None
+
+    def write(self, properties=True):
+        data.EMSet.write(self, properties)
+        _updateSnapshot(self)
+
+    def close(self):
+        self._appendManyPlan = None
+        data.EMSet.close(self)
 
 class ProteinSequenceFile(data.EMFile):
     """A file with a list of protein sequences"""
@@ -71,7 +220,8 @@ class NucleotideSequenceFile(data.EMFile):
         data.EMFile.__init__(self, **kwargs)
 
 class SmallMolecule(data.EMObject):
-    """ Small molecule """
+    """ Small molecule. It is either a file with a single molecule or a record of a library file,
+        in the latter case the file is the library and the record is at (_libraryOffset, _librarySize)"""
     def __init__(self, **kwargs):
         data.EMObject.__init__(self, **kwargs)
         self.smallMoleculeFile = pwobj.String(kwargs.get('smallMolFilename', None))
@@ -79,6 +229,34 @@ class SmallMolecule(data.EMObject):
     def getFileName(self):
         return self.smallMoleculeFile.get()
 
+    def setLibraryRecord(self, name, offset, size):
+        self._molName = pwobj.String(name)
+        self._libraryOffset = pwobj.Integer(offset)
+        self._librarySize = pwobj.Integer(size)
+
+    def isInLibrary(self):
+        return hasattr(self, '_libraryOffset')
+
+    def getMolName(self):
+        if hasattr(self, '_molName'):
+            return self._molName.get()
+        return os.path.splitext(os.path.split(self.getFileName())[1])[0]
+
+    def getMolExtension(self):
+        return os.path.splitext(self.getFileName())[1]
+
+    def getRecord(self):
+        """ Text of the molecule, read from the library if needed"""
+        if self.isInLibrary():
+            return readMoleculeRecord(self.getFileName(), self._libraryOffset.get(), self._librarySize.get())
+        with open(self.getFileName()) as fh:
+            return fh.read()
+
+    def writeRecord(self, fnOut):
+        """ Write the molecule to its own file, for programs that cannot read the library"""
+        with open(fnOut, 'w') as fh:
+            fh.write(self.getRecord())
+
     def getConformersFileName(self):
         return self._ConformersFile.get()
 
@@ -96,6 +274,18 @@ class SetOfSmallMolecules(data.EMSet):
     def __init__(self, **kwargs):
         data.EMSet.__init__(self, **kwargs)
 
+    def iterRows(self, columns=None, chunk=None):
+        """ Read-only iteration over the entries written to the set file. Each row is a light tuple with
+            objId and the requested columns (all if None) as attributes, e.g. row._DaliZscore.
+            chunk=(i, n) restricts it to the i-th of n id ranges"""
+        if self.getSize()==0:
+            return iter([])
+        return iterSetRows(self.getFileName(), columns, chunk=chunk)
+
+    def write(self, properties=True):
+        data.EMSet.write(self, properties)
+        _updateSnapshot(self)
+
 class BindingSite(data.EMObject):
     """ Binding site """
     def __init__(self, **kwargs):
@@ -32,6 +32,7 @@ import urllib.request
 import pyworkflow.object as pwobj
 from pwem.protocols import EMProtocol
 from pyworkflow.protocol.params import PointerParam, BooleanParam, EnumParam
+from bioinformatics.utils.recordCache import getRecordCache, BufferedRecords
 
 class ProtBioinformaticsZINCFilter(EMProtocol):
     """Filter a set of small molecules by being in all selected catalogs of ZINC.
@@ -54,9 +55,10 @@ class ProtBioinformaticsZINCFilter(EMProtocol):
 
     def operateStep(self):
         outputSet = self.inputSet.get().create(self._getPath())
+        # The downloaded records are stored in the cache in batches
+        cache = BufferedRecords(getRecordCache())
         for oldEntry in self.inputSet.get():
-            fnSmall = oldEntry.smallMoleculeFile.get()
-            fnBase = os.path.splitext(os.path.split(fnSmall)[1])[0]
+            fnBase = oldEntry.getMolName()
             if "-" in fnBase:
                 fnBase = fnBase.split("-")[0]
             if not "ZINC" in fnBase:
@@ -68,10 +70,13 @@ class ProtBioinformaticsZINCFilter(EMProtocol):
                 sys.stdout.flush()
                 add = True
                 try:
-                    with contextlib.closing(urllib.request.urlopen(url)) as fp:
-                        mybytes = fp.read()
-                        mystr = mybytes.decode("utf8")
-                        fp.close()
+                    mybytes = cache.get("zinc", "substance", fnBase)
+                    if mybytes is None:
+                        with contextlib.closing(urllib.request.urlopen(url)) as fp:
+                            mybytes = fp.read()
+                            fp.close()
+                        cache.put("zinc", "substance", fnBase, mybytes)
+                    mystr = mybytes.decode("utf8")
                     notForSale=False
                     agent=False
                     forSale=False
@@ -130,6 +135,7 @@ class ProtBioinformaticsZINCFilter(EMProtocol):
                 newEntry.copy(oldEntry)
                 newEntry.ZINCname = pwobj.String(title)
                 outputSet.append(newEntry)
+        cache.flush()
 
         if len(outputSet)>0:
             self._defineOutputs(output=outputSet)
@@ -140,6 +146,6 @@ class ProtBioinformaticsZINCFilter(EMProtocol):
         firstItem = self.inputSet.get().getFirstItem()
         if not hasattr(firstItem,"smallMoleculeFile"):
             errors.append("The input set does not contain small molecules")
-        elif not "ZINC" in firstItem.smallMoleculeFile.get():
+        elif not "ZINC" in firstItem.getMolName():
             errors.append("Cannot find the ZINC code in the small molecule filename")
         return errors
\ No newline at end of file
@@ -24,14 +24,26 @@
 # *
 # **************************************************************************
 
+import fcntl
+import glob
+import hashlib
+import heapq
+from math import ceil
 import os
+import sys
+import threading
+import time
 
 from pwem.protocols import EMProtocol
-from pyworkflow.protocol.params import PointerParam, IntParam, FloatParam
+from pyworkflow.object import Set
+from pyworkflow.protocol import STEPS_PARALLEL
+from pyworkflow.protocol.params import PointerParam, IntParam, FloatParam, LEVEL_ADVANCED
 import pyworkflow.object as pwobj
 from bioinformatics import Plugin as bioinformatics_plugin
-from pyworkflow.utils.path import makePath, createLink, cleanPattern
+from pyworkflow.utils.path import makePath, createLink, cleanPattern, copyFile
 from bioinformatics.objects import SetOfSmallMolecules, SmallMolecule
+from bioinformatics.utils.moleculeFiles import writeMoleculeRecord
+from bioinformatics.utils.autodockUtils import parseDlg
 
 class ProtBioinformaticsAutodock(EMProtocol):
     """Perform a docking experiment with autodock. See the help at
@@ -39,6 +51,15 @@ class ProtBioinformaticsAutodock(EMProtocol):
     _label = 'autodock'
     _program = ""
 
+    def __init__(self, **kwargs):
+        EMProtocol.__init__(self, **kwargs)
+        self.stepsExecutionMode = STEPS_PARALLEL
+        self._dockLock = threading.Lock()
+        self._outputLock = threading.Lock()
+        self._dockStart = None
+        self._dockedLigands = []
+        self._appendedLigands = None
+
     def _defineParams(self, form):
         form.addSection(label='Input')
         form.addParam('inputGrid', PointerParam, pointerClass="AutodockGrid",
@@ -69,24 +90,109 @@ class ProtBioinformaticsAutodock(EMProtocol):
         form.addParam('swRho', FloatParam, label='Initial variance', default=1.0,
                       help='It defines the size of the local search')
         form.addParam('swLbRho', FloatParam, label='Variance lower bound', default=0.01)
-        form.addParallelSection(threads=1, mpi=1)
+        form.addParam('batchSize', IntParam, label='Ligands per batch', default=10, expertLevel=LEVEL_ADVANCED,
+                      help='Ligands are docked in batches of similar cost, as many batches at the same time as threads')
+        form.addParallelSection(threads=4, mpi=0)
 
     # --------------------------- INSERT steps functions --------------------
     def _insertAllSteps(self):
         fnGridDir = self.inputGrid.get().getFileName()
-        dockSteps = []
+
+        # Group the ligands in batches of similar cost, the number of torsions is used as cost estimate
+        molecules = []
+        self._ligandIds = {}
         for smallMol in self.inputLibrary.get():
-            fnSmall = smallMol.getFileName()
+            self._ligandIds[smallMol.getMolName()] = smallMol.getObjId()
+            if smallMol.isInLibrary():
+                molecule = (smallMol.getFileName(), smallMol.getMolName(),
+                            smallMol._libraryOffset.get(), smallMol._librarySize.get())
+            else:
+                molecule = (smallMol.getFileName(), smallMol.getMolName(), None, None)
+            molecules.append((1+self.countTorsions(smallMol.getRecord()), molecule))
+        molecules.sort(key=lambda x: -x[0])
+
+        nBatches = int(ceil(len(molecules)/max(1, self.batchSize.get())))
+        batchLoad = [(0, i) for i in range(nBatches)]
+        batches = [[] for i in range(nBatches)]
+        for cost, molecule in molecules:
+            load, i = heapq.heappop(batchLoad)
+            batches[i].append(molecule)
+            heapq.heappush(batchLoad, (load+cost, i))
 
-            stepId = self._insertFunctionStep('dockStep', fnGridDir, fnSmall, prerequisites=[])
+        self._dockTotal = len(molecules)
+        self._dockDone = 0
+        self._dockStart = None
+        self._dockedLigands = []
+
+        # The batches are written to extra/batches so that the steps only store their batch number
+        makePath(self._getExtraPath("batches"))
+        dockSteps = []
+        for i, batch in enumerate(batches):
+            with open(self._getBatchFileName(i), 'w') as fh:
+                for fnSmall, fnBase, offset, size in batch:
+                    fh.write("%s\t%s\t%s\t%s\n" % (fnSmall, fnBase, "" if offset is None else offset,
+                                                   "" if size is None else size))
+            stepId = self._insertFunctionStep('dockStep', fnGridDir, i, prerequisites=[])
             dockSteps.append(stepId)
+        # The output is updated in _stepsCheck while docking, this step adds the last ligands and closes it
         self._insertFunctionStep('createOutputStep', prerequisites=dockSteps)
 
-    def dockStep(self, fnGridDir, fnSmall):
+    def countTorsions(self, record):
+        for line in record.split('\n'):
+            if line.startswith("TORSDOF"):
+                return int(line.split()[1])
+        return 0
+
+    def _getBatchFileName(self, batch):
+        return self._getExtraPath(os.path.join("batches", "batch%06d.txt" % batch))
+
+    def _readBatch(self, batch):
+        """ (file, name, offset, size) of the ligands of a batch, offset and size are None if the
+            ligand is not in a library"""
+        molecules = []
+        with open(self._getBatchFileName(batch)) as fh:
+            for line in fh:
+                fnSmall, fnBase, offset, size = line.rstrip('\n').split('\t')
+                if offset=="":
+                    molecules.append((fnSmall, fnBase, None, None))
+                else:
+                    molecules.append((fnSmall, fnBase, int(offset), int(size)))
+        return molecules
+
+    def dockStep(self, fnGridDir, batch):
+        if self._dockStart is None:
+            self._dockStart = time.time()
+        for fnSmall, fnBase, offset, size in self._readBatch(batch):
+            if not os.path.exists(self._getDockedMarker(fnBase)):
+                try:
+                    self.dockMolecule(fnGridDir, fnSmall, fnBase, offset, size)
+                    open(self._getDockedMarker(fnBase), 'w').close()
+                except Exception as e:
+                    print("Ligand %s could not be docked: %s" % (fnBase, e))
+            with self._dockLock:
+                self._dockedLigands.append(fnBase)
+                self._dockDone += 1
+                elapsed = time.time()-self._dockStart
+                eta = elapsed/self._dockDone*(self._dockTotal-self._dockDone)
+                print("Docked %d/%d ligands, ETA %s" % (self._dockDone, self._dockTotal,
+                                                        time.strftime("%H:%M:%S", time.gmtime(eta))))
+                sys.stdout.flush()
+
+    def _getDockedMarker(self, fnBase):
+        """ File that marks that the .dlg of a ligand is complete"""
+        return self._getExtraPath(os.path.join(fnBase, "docked"))
+
+    def dockMolecule(self, fnGridDir, fnMol, fnBase, offset, size):
         fnReceptor = os.path.join(fnGridDir,"atomStruct.pdbqt")
-        fnBase = os.path.splitext(os.path.split(fnSmall)[1])[0]
         fnSmallDir = self._getExtraPath(fnBase)
         makePath(fnSmallDir)
+        fnSmallLocal = fnBase+os.path.splitext(fnMol)[1]
+        if offset is not None:
+            fnSmall = os.path.join(fnSmallDir,fnSmallLocal)
+            writeMoleculeRecord(fnMol, offset, size, fnSmall)
+        else:
+            fnSmall = fnMol
+            createLink(fnSmall,os.path.join(fnSmallDir,fnSmallLocal))
         fnDPF = os.path.join(fnSmallDir,fnBase+".dpf")
         args = " -l %s -r %s -o %s"%(fnSmall, fnReceptor, fnDPF)
 
@@ -109,8 +215,6 @@ class ProtBioinformaticsAutodock(EMProtocol):
         self.runJob(bioinformatics_plugin.getMGLPath('bin/pythonsh'),
                     bioinformatics_plugin.getADTPath('Utilities24/prepare_dpf42.py')+args)
 
-        fnSmallLocal = os.path.split(fnSmall)[1]
-        createLink(fnSmall,os.path.join(fnSmallDir,fnSmallLocal))
         createLink(fnReceptor,os.path.join(fnSmallDir,"atomStruct.pdbqt"))
 
         args = " -r atomStruct.pdbqt -l %s -o library.gpf"%fnSmallLocal
@@ -118,72 +222,148 @@ class ProtBioinformaticsAutodock(EMProtocol):
                     bioinformatics_plugin.getADTPath('Utilities24/prepare_gpf4.py') + args,
                     cwd=fnSmallDir)
 
-        args = "-p library.gpf -l library.glg"
-        self.runJob(bioinformatics_plugin.getAutodockPath("autogrid4"), args, cwd=fnSmallDir)
+        fnMapsDir = self.computeGridMaps(fnReceptor, os.path.join(fnSmallDir,"library.gpf"))
+        for fnMap in glob.glob(os.path.join(fnMapsDir,"atomStruct.*.map"))+\
+                     glob.glob(os.path.join(fnMapsDir,"atomStruct.maps.*")):
+            createLink(fnMap,os.path.join(fnSmallDir,os.path.split(fnMap)[1]))
 
         args = "-p %s.dpf -l %s.dlg"%(fnBase,fnBase)
         self.runJob(bioinformatics_plugin.getAutodockPath("autodock4"), args, cwd=fnSmallDir)
 
-        # Clean a bit
+        # Clean a bit, the maps are only links to the grid cache
         cleanPattern(os.path.join(fnSmallDir,"atomStruct.*.map"))
 
+    def getReceptorHash(self, fnReceptor):
+        if not hasattr(self, '_receptorHashes'):
+            self._receptorHashes = {}
+        if not fnReceptor in self._receptorHashes:
+            with open(fnReceptor, 'rb') as fh:
+                self._receptorHashes[fnReceptor] = hashlib.sha1(fh.read()).hexdigest()
+        return self._receptorHashes[fnReceptor]
+
+    def computeGridMaps(self, fnReceptor, fnGPF):
+        """ The grid maps depend only on the receptor, the grid box and the ligand atom types. They are computed
+            once for each distinct set of these in extra/gridMaps/<key> and shared by all the ligands.
+            It returns the directory with the maps."""
+        gpfLines = []
+        with open(fnGPF) as fh:
+            for line in fh:
+                tokens = line.split('#')[0].split()
+                if len(tokens)==0:
+                    continue
+                if tokens[0] == "ligand_types":
+                    tokens = tokens[0:1]+sorted(tokens[1:])
+                gpfLines.append(" ".join(tokens))
+        key = hashlib.sha1((self.getReceptorHash(fnReceptor)+"\n"+
+                            "\n".join(sorted(gpfLines))).encode()).hexdigest()
+
+        fnMapsDir = self._getExtraPath(os.path.join("gridMaps", key))
+        makePath(fnMapsDir)
+        fnDone = os.path.join(fnMapsDir, "done")
+        with open(os.path.join(fnMapsDir, "lock"), 'w') as fhLock:
+            fcntl.flock(fhLock, fcntl.LOCK_EX)
+            if not os.path.exists(fnDone):
+                createLink(fnReceptor, os.path.join(fnMapsDir, "atomStruct.pdbqt"))
+                copyFile(fnGPF, os.path.join(fnMapsDir, "library.gpf"))
+                args = "-p library.gpf -l library.glg"
+                self.runJob(bioinformatics_plugin.getAutodockPath("autogrid4"), args, cwd=fnMapsDir)
+                open(fnDone, 'w').close()
+            fcntl.flock(fhLock, fcntl.LOCK_UN)
+        return fnMapsDir
+
+    # --------------------------- OUTPUT functions ------------------
+    def _stepsCheck(self):
+        self._appendDockedLigands(Set.STREAM_OPEN)
+
+    def _findPendingLigands(self):
+        """ Ligands docked in a previous execution whose results are not in the output yet. The ligands in
+            the output are taken from the output set itself, so nothing is lost if the run was interrupted"""
+        self._appendedLigands = set()
+        fnSet = self._getPath(SetOfSmallMolecules.FILE_TEMPLATE_NAME % '')
+        if os.path.exists(fnSet):
+            outputSet = SetOfSmallMolecules(filename=fnSet)
+            for smallMol in outputSet:
+                self._appendedLigands.add(smallMol.getMolName())
+            outputSet.close()
+        return [fnBase for fnBase in self._ligandIds
+                if not fnBase in self._appendedLigands and os.path.exists(self._getDockedMarker(fnBase))]
+
+    def _appendDockedLigands(self, streamState):
+        """ Add the results of the ligands docked since the last call to the output sets. The queue is drained
+            after the caller has decided the stream state, so a ligand docked in between is not left out"""
+        with self._outputLock:
+            newLigands = []
+            if self._appendedLigands is None:
+                newLigands = self._findPendingLigands()
+            with self._dockLock:
+                newLigands += self._dockedLigands
+                self._dockedLigands = []
+            newLigands = [fnBase for fnBase in newLigands if not fnBase in self._appendedLigands]
+            if len(newLigands)==0 and streamState==Set.STREAM_OPEN:
+                return
+
+            outputSet = self._loadOutputSet('')
+            outputSetBest = self._loadOutputSet('Best')
+            inputLibrary = self.inputLibrary.get()
+            for fnBase in newLigands:
+                if fnBase in self._appendedLigands:
+                    continue
+                self.appendDockingResults(inputLibrary[self._ligandIds[fnBase]], outputSet, outputSetBest)
+                self._appendedLigands.add(fnBase)
+
+            self._updateDockingOutput('outputSmallMolecules', outputSet, streamState)
+            self._updateDockingOutput('outputSmallMoleculesBest', outputSetBest, streamState)
+
+    def _loadOutputSet(self, suffix):
+        fnSet = self._getPath(SetOfSmallMolecules.FILE_TEMPLATE_NAME % suffix)
+        if os.path.exists(fnSet):
+            outputSet = SetOfSmallMolecules(filename=fnSet)
+            outputSet.loadAllProperties()
+            outputSet.enableAppend()
+        else:
+            outputSet = SetOfSmallMolecules().create(path=self._getPath(), suffix=suffix)
+            outputSet.setStreamState(outputSet.STREAM_OPEN)
+        return outputSet
+
+    def _updateDockingOutput(self, outputName, outputSet, streamState):
+        firstTime = not self.hasAttribute(outputName)
+        self._updateOutputSet(outputName, outputSet, streamState)
+        if firstTime:
+            self._defineSourceRelation(self.inputGrid, outputSet)
+            self._defineSourceRelation(self.inputLibrary, outputSet)
+
+    def appendDockingResults(self, smallMol, outputSet, outputSetBest):
+        fnBase = smallMol.getMolName()
+        fnSmallDir = self._getExtraPath(fnBase)
+        fnDlg = os.path.join(fnSmallDir,fnBase+".dlg")
+        if not os.path.exists(fnDlg):
+            return
+        results = parseDlg(fnDlg)
+        if results.bestEnergy is None:
+            return
+        fnTop = os.path.join(fnSmallDir,"%s_top.pdbqt"%fnBase)
+        results.writeBestPose(fnTop)
+
+        newSmallMol = SmallMolecule()
+        newSmallMol.copy(smallMol)
+        newSmallMol.dockingScoreLE = pwobj.Float(results.bestEnergy)
+        newSmallMol.ligandEfficiency = pwobj.Float(results.ligandEfficiency(results.bestEnergy))
+        newSmallMol.smallMoleculeFilePose = pwobj.String(fnTop)
+        outputSetBest.append(newSmallMol)
+
+        # One entry per ligand with the lowest energy cluster, as summarize_results4 reported
+        energy = min(results.clusters, key=lambda cluster: cluster[0])[1] if len(results.clusters)>0 \
+                 else results.bestEnergy
+        newSmallMol = SmallMolecule()
+        newSmallMol.copy(smallMol)
+        newSmallMol.cleanObjId()
+        newSmallMol.dockingScoreLE = pwobj.Float(energy)
+        newSmallMol.ligandEfficiency = pwobj.Float(results.ligandEfficiency(energy))
+        outputSet.append(newSmallMol)
+
     def createOutputStep(self):
-        outputSetBest = SetOfSmallMolecules().create(path=self._getPath(),suffix='Best')
-        outputSet = SetOfSmallMolecules().create(path=self._getPath())
-        for smallMol in self.inputLibrary.get():
-            fnSmall = smallMol.getFileName()
-            fnBase = os.path.splitext(os.path.split(fnSmall)[1])[0]
-            fnSmallDir = self._getExtraPath(fnBase)
-            fnDlg = os.path.join(fnSmallDir,fnBase+".dlg")
-            if os.path.exists(fnDlg):
-                args = " -d . -b -o bestDock.txt"
-                self.runJob(bioinformatics_plugin.getMGLPath('bin/pythonsh'),
-                            bioinformatics_plugin.getADTPath('Utilities24/summarize_results4.py') + args,
-                            cwd=fnSmallDir)
-                args = " -d . -o bestCluster.txt"
-                self.runJob(bioinformatics_plugin.getMGLPath('bin/pythonsh'),
-                            bioinformatics_plugin.getADTPath('Utilities24/summarize_results4.py') + args,
-                            cwd=fnSmallDir)
-                args = " -f %s.dlg -o %s_top.pdbqt"%(fnBase,fnBase)
-                self.runJob(bioinformatics_plugin.getMGLPath('bin/pythonsh'),
-                            bioinformatics_plugin.getADTPath('Utilities24/write_lowest_energy_ligand.py') + args,
-                            cwd=fnSmallDir)
-
-                newSmallMol = SmallMolecule()
-                newSmallMol.copy(smallMol)
-                fh = open(os.path.join(fnSmallDir,"bestDock.txt"))
-                lineNo = 0
-                for line in fh.readlines():
-                    if lineNo == 1:
-                        tokens = line.split(',')
-                        newSmallMol.dockingScoreLE = pwobj.Float(tokens[4].strip())
-                        newSmallMol.ligandEfficiency = pwobj.Float(tokens[-1].strip())
-                        newSmallMol.smallMoleculeFilePose = pwobj.String(os.path.join(fnSmallDir,"%s_top.pdbqt"%fnBase))
-                    lineNo += 1
-                fh.close()
-                outputSetBest.append(newSmallMol)
-
-                fh = open(os.path.join(fnSmallDir, "bestCluster.txt"))
-                lineNo = 0
-                for line in fh.readlines():
-                    if lineNo >= 1:
-                        newSmallMol = SmallMolecule()
-                        newSmallMol.copy(smallMol)
-                        newSmallMol.cleanObjId()
-                        tokens = line.split(',')
-                        newSmallMol.dockingScoreLE = pwobj.Float(tokens[2].strip())
-                        newSmallMol.ligandEfficiency = pwobj.Float(tokens[-1].strip())
-                        outputSet.append(newSmallMol)
-                    lineNo += 1
-                fh.close()
-
-        self._defineOutputs(outputSmallMolecules=outputSet)
-        self._defineSourceRelation(self.inputGrid, outputSet)
-        self._defineSourceRelation(self.inputLibrary, outputSet)
-
-        self._defineOutputs(outputSmallMoleculesBest=outputSetBest)
-        self._defineSourceRelation(self.inputGrid, outputSetBest)
-        self._defineSourceRelation(self.inputLibrary, outputSetBest)
+        # All the docking steps are done, so no ligand can be added after this call
+        self._appendDockedLigands(Set.STREAM_CLOSED)
 
     def _citations(self):
         return ['Morris2009']
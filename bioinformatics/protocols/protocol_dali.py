@@ -26,7 +26,7 @@
 import os
 import sys
 
-from bioinformatics.objects import SetOfDatabaseID, DatabaseID
+from bioinformatics.objects import SetOfDatabaseID
 import pyworkflow.object as pwobj
 from pwem.protocols import EMProtocol
 from pwem.convert.atom_struct import AtomicStructHandler
@@ -81,7 +81,7 @@ class ProtBioinformaticsDali(EMProtocol):
         else:
             subset = ""
 
-        outputSet = SetOfDatabaseID.create(path=prot._getPath(), suffix=subset)
+        rows = []
         for line in open(fnTxt, "r"):
             line = line.strip()
             if line == "":
@@ -92,21 +92,20 @@ class ProtBioinformaticsDali(EMProtocol):
                 continue
             else:
                 tokens = line.split()
-                pdbId = DatabaseID()
                 tokens2 = tokens[1].split('-')
-                pdbId.setDatabase("pdb")
-                pdbId.setDbId(tokens[1])
-                pdbId._pdbId = pwobj.String(tokens2[0])
-                if len(tokens2) > 1:
-                    pdbId._chain = pwobj.String(tokens2[1])
-                pdbId._PDBLink = pwobj.String("https://www.rcsb.org/structure/%s" % tokens2[0])
-                pdbId._DaliZscore = pwobj.Float(float(tokens[2]))
-                pdbId._DaliRMSD = pwobj.Float(float(tokens[3]))
-                pdbId._DaliSuperpositionLength = pwobj.Integer(int(tokens[4]))
-                pdbId._DaliSeqLength = pwobj.Integer(int(tokens[5]))
-                pdbId._DaliSeqIdentity = pwobj.Float(float(tokens[6]))
-                pdbId._DaliDescription = pwobj.String(" ".join(tokens[7:]))
-                outputSet.append(pdbId)
+                rows.append((tokens[1], tokens2[0], tokens2[1] if len(tokens2) > 1 else None,
+                             "https://www.rcsb.org/structure/%s" % tokens2[0],
+                             float(tokens[2]), float(tokens[3]), int(tokens[4]), int(tokens[5]),
+                             float(tokens[6]), " ".join(tokens[7:])))
+        columns = ['dbId', '_pdbId', '_chain', '_PDBLink', ('_DaliZscore', pwobj.Float),
+                   ('_DaliRMSD', pwobj.Float), ('_DaliSuperpositionLength', pwobj.Integer),
+                   ('_DaliSeqLength', pwobj.Integer), ('_DaliSeqIdentity', pwobj.Float), '_DaliDescription']
+        if all(row[2] is None for row in rows):
+            # As when the entries were appended one by one, there is no _chain if no hit has a chain
+            columns.pop(2)
+            rows = [row[:2]+row[3:] for row in rows]
+        outputSet = SetOfDatabaseID.create(path=prot._getPath(), suffix=subset)
+        outputSet.appendMany(rows, columns, database="pdb")
         outputDict = {'outputDatabaseIds%s' % subset: outputSet}
         prot._defineOutputs(**outputDict)
         prot._defineSourceRelation(prot.inputStructure, outputSet)
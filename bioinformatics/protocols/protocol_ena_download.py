@@ -25,12 +25,14 @@
 # **************************************************************************
 
 import os
-import urllib.request
+import sys
 
 from pwem.protocols import EMProtocol
 from pwem.convert.sequence import sequenceLength
 import pyworkflow.object as pwobj
 from pyworkflow.protocol.params import PointerParam
+from bioinformatics.utils.webFetch import WebFetcher
+from bioinformatics.utils.recordCache import fetchCached
 from bioinformatics.objects import DatabaseID, SetOfDatabaseID, NucleotideSequenceFile
 
 class ProtBioinformaticsEnaDownload(EMProtocol):
@@ -48,6 +50,18 @@ class ProtBioinformaticsEnaDownload(EMProtocol):
         self._insertFunctionStep('searchStep')
 
     def searchStep(self):
+        jobs = {}
+        for item in self.inputListID.get():
+            enaId = item._enaId.get()
+            fnFasta = self._getExtraPath("%s.fasta"%enaId)
+            if not os.path.exists(fnFasta):
+                jobs[enaId] = fnFasta
+        print("Fetching %d ena entries"%len(jobs))
+        sys.stdout.flush()
+        fetchCached("ena", "fasta", jobs, lambda missing: WebFetcher().fetchAll(
+            [("https://www.ebi.ac.uk/ena/data/view/%s&display=fasta" % enaId, fnFasta)
+             for enaId, fnFasta in missing.items()]))
+
         outputDatabaseID = SetOfDatabaseID().create(path=self._getPath())
         fnList = []
         for item in self.inputListID.get():
@@ -57,22 +71,10 @@ class ProtBioinformaticsEnaDownload(EMProtocol):
             newItem._enaSeqLength = pwobj.Integer(-1)
 
             enaId = item._enaId.get()
-            print("Processing %s"%enaId)
-
-            urlId = "https://www.ebi.ac.uk/ena/data/view/%s&display=fasta" % enaId
-
             fnFasta=self._getExtraPath("%s.fasta"%enaId)
-            if not os.path.exists(fnFasta):
-                print("Fetching ena: %s"%urlId)
-                for i in range(3):
-                    try:
-                        urllib.request.urlretrieve(urlId,fnFasta)
-                        if not fnFasta in fnList:
-                            fnList.append(fnFasta)
-                        break
-                    except: # The library raises an exception when the web is not found
-                        pass
             if os.path.exists(fnFasta):
+                if not fnFasta in fnList:
+                    fnList.append(fnFasta)
                 newItem._enaFile = pwobj.String(fnFasta)
                 newItem._enaSeqLength = pwobj.Integer(sequenceLength(fnFasta))
 
@@ -30,6 +30,8 @@ import numpy as np
 from pwem.protocols import EMProtocol
 from pyworkflow.object import Float, Integer
 from pyworkflow.protocol.params import PointerParam, EnumParam, StringParam, IntParam, FloatParam
+from bioinformatics.utils.columnSnapshot import readColumnSnapshot
+from bioinformatics.utils.setUtils import getSetColumns, NUMERIC_CLASSES
 
 class ProtBioinformaticsExportCSV(EMProtocol):
     """Export a set as a csv. It is located in the Run directory"""
@@ -45,10 +47,22 @@ class ProtBioinformaticsExportCSV(EMProtocol):
         self._insertFunctionStep('exportStep')
 
     def exportStep(self):
+        inputSet = self.inputSet.get()
+        snapshot = readColumnSnapshot(inputSet.getFileName())
+        if snapshot is not None and not any('.' in attribute for attribute in snapshot[1]):
+            self.exportColumns(*snapshot)
+            return
+        if hasattr(inputSet, 'iterRows') and len(inputSet)>0:
+            classNames = {attribute: className
+                          for attribute, (_, className) in getSetColumns(inputSet.getFileName()).items()}
+            if not any('.' in attribute for attribute in classNames):
+                self.exportRows(inputSet.iterRows(list(classNames)), classNames)
+                return
+
         fh = open(self._getPath("output.csv"),"w")
         lineNo = 0
         lineHdr = ""
-        for entry in self.inputSet.get():
+        for entry in inputSet:
             line = ""
             for key, value in entry.getAttributes():
                 if lineNo == 0:
@@ -63,3 +77,34 @@ class ProtBioinformaticsExportCSV(EMProtocol):
             fh.write(line+"\n")
             lineNo+=1
         fh.close()
+
+    def exportColumns(self, ids, columns, classNames):
+        """ Same output as the loop over the entries, from the columnar snapshot of the set"""
+        attributes = list(columns)
+        with open(self._getPath("output.csv"),"w") as fh:
+            if len(ids)>0:
+                fh.write("; ".join(attributes)+"\n")
+            for i in range(len(ids)):
+                fh.write("; ".join([formatValue(columns[attribute][i], classNames[attribute])
+                                    for attribute in attributes])+"\n")
+
+    def exportRows(self, rows, classNames):
+        """ Same output as the loop over the entries, from the light rows of the set"""
+        attributes = list(classNames)
+        with open(self._getPath("output.csv"),"w") as fh:
+            fh.write("; ".join(attributes)+"\n")
+            for row in rows:
+                fh.write("; ".join([formatValue(value, classNames[attribute])
+                                    for attribute, value in zip(attributes, row[1:])])+"\n")
+
+def formatValue(value, className):
+    """ Text of a stored value, as str(attribute.get()) of the entry"""
+    if value is None or (className in NUMERIC_CLASSES and np.isnan(value)):
+        return "None"
+    elif className=='Integer':
+        return str(int(value))
+    elif className=='Boolean':
+        return str(bool(value))
+    elif className=='Float':
+        return str(float(value))
+    return str(value)
@@ -34,6 +34,7 @@ import pyworkflow.object as pwobj
 from pyworkflow.utils.path import copyFile
 from pyworkflow.protocol.params import PathParam, StringParam, BooleanParam
 from bioinformatics.objects import SmallMolecule, SetOfSmallMolecules
+from bioinformatics.utils.moleculeFiles import splitMoleculeFile, writeMoleculeLibrary
 from bioinformatics import Plugin
 
 class ProtBioinformaticsImportSmallMolecules(EMProtocol):
@@ -80,97 +81,65 @@ class ProtBioinformaticsImportSmallMolecules(EMProtocol):
                                          ' - CSV smiles (ID, compound; this is downloaded from ZINC) \n'
                                          ' - Mol2 (Multiple mol2 file) \n'
                                          ' - SDF (Multiple sdf file)')
+        form.addParam('library', BooleanParam, default=False, condition='not multiple',
+                      label='Keep as a single library file',
+                      help='The molecules are stored in a single library file in the extra directory, each one '
+                           'referenced by its position in the file, instead of writing one file per molecule. '
+                           'Recommended for large libraries.')
+        form.addParallelSection(threads=4, mpi=0)
 
     # --------------------------- INSERT steps functions --------------------
     def _insertAllSteps(self):
         self._insertFunctionStep('importStep')
 
     def importStep(self):
-
+        smallMolecules = []
         if not self.multiple.get():
-
-            fnSmall = self._getExtraPath(os.path.split(self.filePath.get())[1])
-            copyFile(self.filePath.get(), fnSmall)
-
-            if fnSmall.endswith(".mol2"): # Multiple mol2
-                with open(fnSmall) as f:
-                    lines = f.readlines()
-                    i = 0
-                    for line in lines:
-                        if line.startswith("#"):
-                            continue
-
-                        if line.startswith("@<TRIPOS>MOLECULE"):
-                            zincID = lines[i+1].split()[0]
-                            fname_small = self._getExtraPath("%s.mol2" %zincID)
-                            f_small = open(fname_small, 'w+')
-                            f_small.write(line)
-
-                        f_small.write(line)
-                        try:
-                            if lines[i+1].startswith("@<TRIPOS>MOLECULE"):
-                                f_small.close()
-                        except:
-                            f_small.close()
-
-                        i += 1
-
-                os.remove(fnSmall)
-
-
-            elif fnSmall.endswith(".sdf"): # Multiple sdf
-                with open(fnSmall) as f:
-                    lines = f.readlines()
-                    lines2write = []
-                    i = 0
-                    for line in lines:
-                        lines2write.append(i)
-
-                        if line.startswith("$$$$"):
-                            zincID = lines[i-5].split()[0]
-                            fname_small = self._getExtraPath("%s.sdf" % zincID)
-                            f_small = open(fname_small, 'w+')
-                            for l in lines2write:
-                                f_small.write(lines[l])
-
-                            lines2write = []
-                            f_small.close()
-
-                        i += 1
-
-                os.remove(fnSmall)
-
+            fnIn = self.filePath.get()
+            if self.library.get():
+                fnLibrary, index = writeMoleculeLibrary(fnIn, self._getExtraPath("library"))
+                for name, offset, size in index:
+                    smallMolecule = SmallMolecule(smallMolFilename=fnLibrary)
+                    smallMolecule.setLibraryRecord(name, offset, size)
+                    smallMolecules.append(smallMolecule)
             else:
-                fh = open(self.filePath.get())
-                for line in fh.readlines():
-                    tokens = line.split(',')
-                    if len(tokens)==2:
-                        fhSmile = open(self._getExtraPath(tokens[0].strip()+".smi"),'w')
-                        fhSmile.write(tokens[1].strip()+"\n")
-                        fhSmile.close()
-                fh.close()
+                fnSplit = splitMoleculeFile(fnIn, self._getExtraPath())
+                if len(fnSplit)==0 and not fnIn.endswith(".mol2") and not fnIn.endswith(".sdf"):
+                    # Not a CSV of smiles, but a single molecule file
+                    copyFile(fnIn, self._getExtraPath(os.path.split(fnIn)[1]))
 
         else:
             for filename in glob.glob(os.path.join(self.filesPath.get(), self.filesPattern.get())):
                 fnSmall = self._getExtraPath(os.path.split(filename)[1])
                 copyFile(filename, fnSmall)
 
-        outputSmallMolecules = SetOfSmallMolecules().create(path=self._getPath(),suffix='SmallMols')
-
-
-        for fnSmall in glob.glob(self._getExtraPath("*")):
-            smallMolecule = SmallMolecule(smallMolFilename=fnSmall)
-
-            if len(os.listdir(self._getExtraPath())) <= 100: # costly
-                if not fnSmall.endswith('.mae') or not fnSmall.endswith('.maegz'):
-                    fnRoot = os.path.splitext(os.path.split(fnSmall)[1])[0]
-                    fnOut = self._getExtraPath("%s.png" % fnRoot)
-                    args = Plugin.getPluginHome('utils/rdkitUtils.py') + " draw %s %s" % (fnSmall, fnOut)
-                    try:
-                        Plugin.runRDKit(self, "python3", args)
-                        smallMolecule._PDBLigandImage = pwobj.String(fnOut)
-                    except:
-                        smallMolecule._PDBLigandImage = pwobj.String("Not available")
+        if len(smallMolecules)==0:
+            for fnSmall in glob.glob(self._getExtraPath("*")):
+                smallMolecules.append(SmallMolecule(smallMolFilename=fnSmall))
+
+        fnManifest = self._getTmpPath("draw_manifest.txt")
+        with open(fnManifest, 'w') as fh:
+            for smallMolecule in smallMolecules:
+                fnOut = self._getExtraPath("%s.png" % smallMolecule.getMolName())
+                if smallMolecule.isInLibrary():
+                    fh.write("%s\t%s\t%d\t%d\n" % (smallMolecule.getFileName(), fnOut,
+                                                    smallMolecule._libraryOffset.get(),
+                                                    smallMolecule._librarySize.get()))
+                else:
+                    fh.write("%s\t%s\n" % (smallMolecule.getFileName(), fnOut))
+        args = Plugin.getPluginHome('utils/rdkitUtils.py') + " draw-batch %s --jobs %d" % \
+               (fnManifest, self.numberOfThreads.get())
+        try:
+            Plugin.runRDKit(self, "python3", args)
+        except Exception as e:
+            print(e)
 
+        outputSmallMolecules = SetOfSmallMolecules().create(path=self._getPath(),suffix='SmallMols')
+        for smallMolecule in smallMolecules:
+            fnOut = self._getExtraPath("%s.png" % smallMolecule.getMolName())
+            if os.path.exists(fnOut):
+                smallMolecule._PDBLigandImage = pwobj.String(fnOut)
+            else:
+                smallMolecule._PDBLigandImage = pwobj.String("Not available")
             outputSmallMolecules.append(smallMolecule)
         self._defineOutputs(outputSmallMols=outputSmallMolecules)
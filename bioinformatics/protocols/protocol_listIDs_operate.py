@@ -27,11 +27,13 @@
 import copy
 import os
 import sys
+import time
 
 from pwem.protocols import EMProtocol
-from pyworkflow.object import Float, Integer
 from pyworkflow.protocol.params import PointerParam, EnumParam, MultiPointerParam, BooleanParam, StringParam
-from bioinformatics.objects import DatabaseID, SetOfDatabaseID
+from bioinformatics.objects import SetOfDatabaseID
+from bioinformatics.utils.predicates import (parsePredicate, singlePredicate, predicateColumns, evaluatePredicate,
+                                             readColumns)
 
 class ProtBioinformaticsListIDOperate(EMProtocol):
     """This protocol will remove all duplicated entries using the DbID as key"""
@@ -40,15 +42,19 @@ class ProtBioinformaticsListIDOperate(EMProtocol):
     def _defineParams(self, form):
         form.addSection(label='Input')
         form.addParam('operation', EnumParam, choices=['Unique', 'Union', 'Intersection', 'Difference', 'Change DbID',
-                                                       'Keep columns', 'Filter'],
+                                                       'Keep columns', 'Filter', 'Symmetric difference',
+                                                       'Multiple intersection'],
                       label='Operation', default=0,
-                      help='Unique: Remove replicated Ids.')
+                      help='Unique: Remove replicated Ids.\n'
+                           'Symmetric difference: Ids that are in only one of the two lists.\n'
+                           'Multiple intersection: Ids that are in all the lists.')
         form.addParam('inputListID', PointerParam, pointerClass="SetOfDatabaseID",
-                       label='List of DB Ids:', allowsNull=True, condition='(operation!=1)')
+                       label='List of DB Ids:', allowsNull=True, condition='(operation!=1 and operation!=8)')
         form.addParam('multipleInputListID', MultiPointerParam, pointerClass="SetOfDatabaseID",
-                       label='List of DB Ids:', allowsNull=True, condition='(operation==1)')
+                       label='List of DB Ids:', allowsNull=True, condition='(operation==1 or operation==8)')
         form.addParam('inputListID2', PointerParam, pointerClass="SetOfDatabaseID",
-                       label='List of DB Ids:', allowsNull=True, condition='(operation==2 or operation==3)')
+                       label='List of DB Ids:', allowsNull=True,
+                       condition='(operation==2 or operation==3 or operation==7)')
         form.addParam('newDb', StringParam,
                        label='New Db:', condition='(operation==4)',
                        help='New database. It can be a label or one of the columns in the table')
@@ -58,15 +64,20 @@ class ProtBioinformaticsListIDOperate(EMProtocol):
         form.addParam('keepColumns', StringParam,
                        label='Keep columns:', condition='(operation==5)',
                        help='They must exist in the input database list. Separated by semicolons')
-        form.addParam('filterColumn', StringParam,
-                       label='Filter column:', condition='(operation==6)',
-                       help='It must exist in the input database list.')
         form.addParam('filterOp', EnumParam, choices=['==', '>', '>=', '<', '<=', '!=', 'startswith',
                                                       'endswith', 'contains', 'does not startwith',
-                                                      'does not end with', 'does not contain'],
+                                                      'does not end with', 'does not contain', 'expression'],
                        label='Filter operation:', condition='(operation==6)')
+        form.addParam('filterColumn', StringParam,
+                       label='Filter column:', condition='(operation==6 and filterOp!=12)',
+                       help='It must exist in the input database list.')
+        form.addParam('filterExpression', StringParam,
+                       label='Filter expression:', condition='(operation==6 and filterOp==12)',
+                       help='Comparisons (==, !=, >, >=, <, <=, between, startswith, endswith, contains) of the '
+                            'columns combined with and, or, not and parentheses, e.g. '
+                            '_DaliZscore > 10 and _DaliSeqIdentity between 30,90')
         form.addParam('filterValue', StringParam,
-                       label='Value:', condition='(operation==6)',
+                       label='Value:', condition='(operation==6 and filterOp!=12)',
                        help='Value to use in the filter')
         form.addParam('removeDuplicates', BooleanParam, default=False,
                        label='Remove duplicates:', condition='(operation!=1)')
@@ -76,6 +87,7 @@ class ProtBioinformaticsListIDOperate(EMProtocol):
         self._insertFunctionStep('operateStep')
 
     def operateStep(self):
+        t0 = time.time()
         outputDict = {}
         if self.operation.get()==1:
             # Union
@@ -85,15 +97,14 @@ class ProtBioinformaticsListIDOperate(EMProtocol):
                     if self.removeDuplicates.get():
                         add=not databaseEntry.getDbId() in outputDict
                     if add:
-                        dbEntry = DatabaseID()
-                        dbEntry.copy(databaseEntry, copyId=False)
-                        outputDict[databaseEntry.getDbId()]=dbEntry
+                        outputDict[databaseEntry.getDbId()] = databaseEntry.getRow()
         elif self.operation.get()==0 or self.operation.get()==2 or self.operation.get()==3:
             # Unique, Intersection, Difference
-            outputList2 = []
+            outputList2 = set()
             if self.operation.get()==2 or self.operation.get()==3:
-                for databaseEntry in self.inputListID2.get():
-                    outputList2.append(databaseEntry.getDbId())
+                # dbIds of the first list that are in the second one, in a single indexed query
+                dbIds1 = set(row.dbId for row in self.inputListID.get().iterRows(['dbId']))
+                outputList2 = set(row.dbId for row in self.inputListID2.get().lookup('dbId', dbIds1, ['dbId']))
 
             for databaseEntry in self.inputListID.get():
                 add=False
@@ -108,9 +119,7 @@ class ProtBioinformaticsListIDOperate(EMProtocol):
                     if self.removeDuplicates.get():
                         add = add and not databaseEntry.getDbId() in outputDict
                 if add:
-                    dbEntry = DatabaseID()
-                    dbEntry.copy(databaseEntry)
-                    outputDict[databaseEntry.getDbId()]=dbEntry
+                    outputDict[databaseEntry.getDbId()] = databaseEntry.getRow(copyId=True)
         elif self.operation.get()==4:
             # Change ID
             newLabel=True
@@ -120,90 +129,100 @@ class ProtBioinformaticsListIDOperate(EMProtocol):
                     break
 
             for databaseEntry in self.inputListID.get():
-                dbEntry = DatabaseID()
-                dbEntry.copy(databaseEntry)
-                if hasattr(dbEntry,self.newDbId.get()):
+                row = databaseEntry.getRow(copyId=True)
+                if self.newDbId.get() in row:
                     if newLabel:
-                        dbEntry.setDatabase(self.newDb.get())
+                        row['database'] = self.newDb.get()
                     else:
-                        dbEntry.setDatabase(dbEntry.getAttributeValue(self.newDb.get()))
-                    dbEntry.setDbId(dbEntry.getAttributeValue(self.newDbId.get()))
+                        row['database'] = row[self.newDb.get()]
+                    row['dbId'] = row[self.newDbId.get()]
                 add = True
                 if self.removeDuplicates.get():
-                    add = add and not dbEntry.getDbId() in outputDict
+                    add = add and not row['dbId'] in outputDict
                 if add:
-                    outputDict[dbEntry.getDbId()] = dbEntry
+                    outputDict[row['dbId']] = row
         elif self.operation.get()==5:
             # Keep columns
             keepList=[x.strip() for x in self.keepColumns.get().split()]
             keepList.append("database")
             keepList.append("dbId")
+            keepList.append("objId")
 
-            ignoreList=[]
-            for name, _ in self.inputListID.get().getFirstItem().getAttributes():
-                if not name in keepList:
-                    ignoreList.append(name)
             for databaseEntry in self.inputListID.get():
-                dbEntry = DatabaseID()
-                dbEntry.copy(databaseEntry,ignoreAttrs=ignoreList)
+                row = {name: value for name, value in databaseEntry.getRow(copyId=True).items() if name in keepList}
                 add = True
                 if self.removeDuplicates.get():
-                    add = add and not dbEntry.getDbId() in outputDict
+                    add = add and not row['dbId'] in outputDict
                 if add:
-                    outputDict[dbEntry.getDbId()] = dbEntry
+                    outputDict[row['dbId']] = row
         elif self.operation.get()==6:
             # Filter columns
-            referenceValue = self.filterValue.get()
-            value = self.inputListID.get().getFirstItem().getAttributeValue(self.filterColumn.get())
-            if isinstance(value,float):
-                referenceValue = float(referenceValue)
-            elif isinstance(value,int):
-                referenceValue = int(referenceValue)
+            if self.filterOp.get()==12:
+                predicate = parsePredicate(self.filterExpression.get())
+            else:
+                predicate = singlePredicate(self.filterColumn.get(), self.getEnumText('filterOp'),
+                                            self.filterValue.get())
+            ids, values = readColumns(self.inputListID.get(), sorted(predicateColumns(predicate)))
+            keepIds = set(ids[evaluatePredicate(predicate, values)].tolist())
 
             for databaseEntry in self.inputListID.get():
-                dbEntry = DatabaseID()
-                dbEntry.copy(databaseEntry)
-                add = False
-
-                value = dbEntry.getAttributeValue(self.filterColumn.get())
-                if isinstance(value, Float):
-                    value = float(value)
-                elif isinstance(value, Integer):
-                    value = int(value)
-
-                filterOp = self.filterOp.get()
-                if filterOp == 0: # ==
-                    add = value==referenceValue
-                elif filterOp == 1: # >
-                    add = value>referenceValue
-                elif filterOp == 2:  # >=
-                    add = value > referenceValue
-                elif filterOp == 3:  # <
-                    add = value < referenceValue
-                elif filterOp == 4:  # <=
-                    add = value <= referenceValue
-                elif filterOp == 5:  # !=
-                    add = value != referenceValue
-                elif filterOp == 6:  #startswith
-                    add = value.startswith(referenceValue)
-                elif filterOp == 7:  # endswith
-                    add = value.endswith(referenceValue)
-                elif filterOp == 8:  # contains
-                    add = referenceValue in value
-                elif filterOp == 9:  # does not startswith
-                    add = not (value.startswith(referenceValue))
-                elif filterOp == 10:  # does not endswith
-                    add = not (value.endswith(referenceValue))
-                elif filterOp == 11:  # does not contains
-                    add = not (referenceValue in value)
-
+                add = databaseEntry.getObjId() in keepIds
                 if self.removeDuplicates.get():
-                    add = add and not dbEntry.getDbId() in outputDict
+                    add = add and not databaseEntry.getDbId() in outputDict
                 if add:
-                    outputDict[dbEntry.getDbId()] = dbEntry
+                    outputDict[databaseEntry.getDbId()] = databaseEntry.getRow(copyId=True)
+        elif self.operation.get()==7:
+            # Symmetric difference
+            dbIds1 = set(row.dbId for row in self.inputListID.get().iterRows(['dbId']))
+            dbIds2 = set(row.dbId for row in self.inputListID2.get().iterRows(['dbId']))
+            for inputList, otherDbIds in [(self.inputListID.get(), dbIds2), (self.inputListID2.get(), dbIds1)]:
+                for databaseEntry in inputList:
+                    add = not databaseEntry.getDbId() in otherDbIds
+                    if self.removeDuplicates.get():
+                        add = add and not databaseEntry.getDbId() in outputDict
+                    if add:
+                        outputDict[databaseEntry.getDbId()] = databaseEntry.getRow()
+        elif self.operation.get()==8:
+            # Multiple intersection, the entries are taken from the first list
+            commonDbIds = None
+            for database in self.multipleInputListID:
+                if commonDbIds is None:
+                    commonDbIds = set(row.dbId for row in database.get().iterRows(['dbId']))
+                else:
+                    commonDbIds = set(row.dbId for row in database.get().lookup('dbId', commonDbIds, ['dbId']))
+            for databaseEntry in self.multipleInputListID[0].get():
+                add = databaseEntry.getDbId() in commonDbIds
+                if self.removeDuplicates.get():
+                    add = add and not databaseEntry.getDbId() in outputDict
+                if add:
+                    outputDict[databaseEntry.getDbId()] = databaseEntry.getRow()
+
+        print("%s: %d entries in %.2f s" % (self.getEnumText('operation'), len(outputDict), time.time()-t0))
+        sys.stdout.flush()
 
+        if self.operation.get()==1 or self.operation.get()==8:
+            inputSets = [database.get() for database in self.multipleInputListID]
+        elif self.operation.get()==7:
+            inputSets = [self.inputListID.get(), self.inputListID2.get()]
+        else:
+            inputSets = [self.inputListID.get()]
+        columns = [column for column in self.getColumns(inputSets)
+                   if self.operation.get()!=5 or column[0] in keepList]
         outputDatabaseID = SetOfDatabaseID().create(path=self._getPath())
-        for dbId in outputDict:
-            outputDatabaseID.append(outputDict[dbId])
+        outputDatabaseID.appendMany(outputDict.values(), columns)
         self._defineOutputs(output=outputDatabaseID)
-        self._defineSourceRelation(self.inputListID, outputDatabaseID)
+        if self.operation.get()==1 or self.operation.get()==8:
+            for database in self.multipleInputListID:
+                self._defineSourceRelation(database, outputDatabaseID)
+        else:
+            self._defineSourceRelation(self.inputListID, outputDatabaseID)
+
+    def getColumns(self, inputSets):
+        """ (attribute, class) of the entries of several sets, in order of appearance"""
+        columns = {}
+        for inputSet in inputSets:
+            firstItem = inputSet.getFirstItem()
+            if firstItem is not None:
+                for name, attrClass in firstItem.getColumns():
+                    columns.setdefault(name, attrClass)
+        return list(columns.items())
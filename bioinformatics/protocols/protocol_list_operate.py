@@ -24,12 +24,17 @@
 # *
 # **************************************************************************
 
+import heapq
 from math import ceil
-import numpy as np
+import sys
 
 from pwem.protocols import EMProtocol
-from pyworkflow.object import Float, Integer
+from pyworkflow.object import Integer
 from pyworkflow.protocol.params import PointerParam, EnumParam, StringParam, IntParam, FloatParam
+from bioinformatics.utils.setUtils import (getSetColumns, copySetFile, keepRows, uniqueRows, topRows, countRows,
+                                           intersectRows, joinRows, sortRows, externalSort)
+from bioinformatics.utils.predicates import (parsePredicate, singlePredicate, predicateColumns, evaluatePredicate,
+                                             readSetColumns, readColumns)
 
 class ProtBioinformaticsListOperate(EMProtocol):
     """Filter a set by a column value or keep just a few columns"""
@@ -38,23 +43,39 @@ class ProtBioinformaticsListOperate(EMProtocol):
     def _defineParams(self, form):
         form.addSection(label='Input')
         form.addParam('operation', EnumParam, choices=['Filter', 'Keep columns', 'Unique', 'Top N', 'Bottom N',
-                                                       'Top %', 'Bottom %', 'Count', 'Intersection', 'Sort'],
+                                                       'Top %', 'Bottom %', 'Count', 'Intersection', 'Sort', 'Join'],
                       label='Operation', default=0,
                       help='In intersection, we keep those entries of the Set to filter whose identifier (filter column) '
-                           'are in the second set')
+                           'are in the second set. In join, the entries of the Set to filter are combined with the '
+                           'entries of the second set whose key column has the same value, and they get the '
+                           'attributes of the second set')
         form.addParam('inputSet', PointerParam, pointerClass="EMSet",
                        label='Set to filter:', allowsNull=False)
-        form.addParam('secondSet', PointerParam, pointerClass="EMSet", condition="operation==8", # Intersection between 2 Sets
-                       label='Set with IDs:', allowsNull=True)
-        form.addParam('filterColumn', StringParam,
-                       label='Filter column:', condition='(operation!=1)',
-                       help='It must exist in the input object.')
+        form.addParam('secondSet', PointerParam, pointerClass="EMSet", condition="operation==8 or operation==10",
+                       label='Second set:', allowsNull=True)
+        form.addParam('joinColumn', StringParam, default="",
+                       label='Key column in the second set:', condition='(operation==10)',
+                       help='If empty, the filter column is used. Attributes of the second set whose name already '
+                            'exists in the first one are renamed with the suffix _2')
+        form.addParam('joinType', EnumParam, choices=['Inner', 'Left', 'Anti'], default=0,
+                       label='Join type:', condition='(operation==10)',
+                       help='Inner: one entry for each pair of entries with the same key. Left: also the entries of '
+                            'the first set without a match, with empty attributes from the second set. Anti: only '
+                            'the entries of the first set without a match')
         form.addParam('filterOp', EnumParam, choices=['==', '>', '>=', '<', '<=', '!=', 'between', 'startswith',
                                                       'endswith', 'contains', 'does not startwith',
-                                                      'does not end with', 'does not contain'],
+                                                      'does not end with', 'does not contain', 'expression'],
                        label='Filter operation:', condition='(operation==0)')
+        form.addParam('filterColumn', StringParam,
+                       label='Filter column:', condition='(operation!=1 and not (operation==0 and filterOp==13))',
+                       help='It must exist in the input object.')
+        form.addParam('filterExpression', StringParam,
+                       label='Filter expression:', condition='(operation==0 and filterOp==13)',
+                       help='Comparisons (==, !=, >, >=, <, <=, between, startswith, endswith, contains) of the '
+                            'columns combined with and, or, not and parentheses, e.g. '
+                            '_DaliZscore > 10 and _DaliSeqIdentity between 30,90')
         form.addParam('filterValue', StringParam,
-                       label='Value:', condition='(operation==0)',
+                       label='Value:', condition='(operation==0 and filterOp!=13)',
                        help='Value to use in the filter')
         form.addParam('filterValue2', StringParam,
                        label='Lower Value:', condition='(operation==0 and filterOp==6)',
@@ -69,70 +90,91 @@ class ProtBioinformaticsListOperate(EMProtocol):
                        help='Between 0 and 100')
         form.addParam('direction', EnumParam, choices=['Ascending', 'Descending'], default=0,
                        label='Sorting direction:', condition='(operation==9)')
+        form.addParam('secondaryKeys', StringParam, default="",
+                       label='Then sort by:', condition='(operation==9)',
+                       help='Columns used to sort the entries with the same value of the filter column, each one '
+                            'optionally followed by asc or desc. Separated by semicolons (e.g. _DaliRMSD asc ; _pdbId)')
 
     # --------------------------- INSERT steps functions --------------------
     def _insertAllSteps(self):
         self._insertFunctionStep('operateStep')
 
     def operateStep(self):
-
         outputSet = self.inputSet.get().create(self._getPath())
+        if not self.sqlOperate(outputSet):
+            self.pythonOperate(outputSet)
 
-        if self.operation.get()==0:
-            # Filter columns
-            referenceValue = self.filterValue.get()
-            value = self.inputSet.get().getFirstItem().getAttributeValue(self.filterColumn.get())
-
-            if isinstance(value,float):
-                referenceValue = float(referenceValue)
-            elif isinstance(value,int):
-                referenceValue = int(referenceValue)
+        if len(outputSet)>0:
+            self._defineOutputs(output=outputSet)
+            self._defineSourceRelation(self.inputSet, outputSet)
 
-            filterOp = self.filterOp.get()
-            if filterOp == 6:
-                referenceValue2 = self.filterValue2.get()
+    def sqlOperate(self, outputSet):
+        """ Execute the operation in a copy of the SQLite file of the input set. It returns False if the
+            operation cannot be expressed in SQL, e.g. the filter column is not stored as a column of the file"""
+        op = self.operation.get()
+        if op==1:
+            return False
+        columns = getSetColumns(self.inputSet.get().getFileName())
+        if op==0:
+            predicate = self.getPredicate()
+            usedColumns = sorted(predicateColumns(predicate))
+        elif op==9:
+            sortKeys = self.getSortKeys()
+            usedColumns = [key for key, _ in sortKeys]
+        else:
+            usedColumns = [self.filterColumn.get()]
+        missingColumns = [column for column in usedColumns if not column in columns]
+        if len(missingColumns)>0:
+            if op==10:
+                raise Exception("%s is not a column of %s" % (", ".join(missingColumns),
+                                                              self.inputSet.get().getFileName()))
+            print("%s is not a column of %s, operating in Python" % (", ".join(missingColumns),
+                                                                    self.inputSet.get().getFileName()))
+            return False
+        if op==7 and 'count' in columns:
+            return False
+        if op==8 or op==10:
+            secondKey = (self.joinColumn.get() or self.filterColumn.get()) if op==10 else self.filterColumn.get()
+            secondColumns = getSetColumns(self.secondSet.get().getFileName())
+            if not secondKey in secondColumns:
+                if op==10:
+                    raise Exception("%s is not a column of %s" % (secondKey, self.secondSet.get().getFileName()))
+                return False
+            secondColumn = secondColumns[secondKey][0]
 
-                if isinstance(value, float):
-                    referenceValue2 = float(referenceValue2)
-                elif isinstance(value, int):
-                    referenceValue2 = int(referenceValue2)
+        fnSqlite = copySetFile(self.inputSet.get(), outputSet)
+        column = columns[usedColumns[0]][0]
+        if op==0:
+            ids, values = readSetColumns(self.inputSet.get().getFileName(), usedColumns)
+            keepRows(fnSqlite, ids[evaluatePredicate(predicate, values)])
+        elif op==2:
+            uniqueRows(fnSqlite, column)
+        elif op==3 or op==4:
+            topRows(fnSqlite, column, n=self.N.get(), top=op==3)
+        elif op==5 or op==6:
+            topRows(fnSqlite, column, percentile=self.percentile.get(), top=op==5)
+        elif op==7:
+            countRows(fnSqlite, column)
+        elif op==8:
+            intersectRows(fnSqlite, column, self.secondSet.get().getFileName(), secondColumn)
+        elif op==9:
+            sortRows(fnSqlite, [(columns[key][0], descending) for key, descending in sortKeys])
+        elif op==10:
+            joinRows(fnSqlite, column, self.secondSet.get().getFileName(), secondColumn,
+                     self.getEnumText('joinType').lower())
+        outputSet.load()
+        print("%s: %d entries kept" % (self.getEnumText('operation'), len(outputSet)))
+        sys.stdout.flush()
+        return True
 
+    def pythonOperate(self, outputSet):
+        if self.operation.get()==0:
+            # Filter columns
+            predicate = self.getPredicate()
+            ids, values = readColumns(self.inputSet.get(), sorted(predicateColumns(predicate)))
+            keepIds = set(ids[evaluatePredicate(predicate, values)].tolist())
             for oldEntry in self.inputSet.get():
-                value = oldEntry.getAttributeValue(self.filterColumn.get())
-                if isinstance(value, Float):
-                    value = float(value)
-                elif isinstance(value, Integer):
-                    value = int(value)
-
-
-                add = False
-                if filterOp == 0: # ==
-                    add = value==referenceValue
-                elif filterOp == 1: # >
-                    add = value>referenceValue
-                elif filterOp == 2:  # >=
-                    add = value > referenceValue
-                elif filterOp == 3:  # <
-                    add = value < referenceValue
-                elif filterOp == 4:  # <=
-                    add = value <= referenceValue
-                elif filterOp == 5:  # !=
-                    add = value != referenceValue
-                elif filterOp == 6:  # between
-                    add = (value <= referenceValue and value >= referenceValue2)
-                elif filterOp == 7:  #startswith
-                    add = value.startswith(referenceValue)
-                elif filterOp == 8:  # endswith
-                    add = value.endswith(referenceValue)
-                elif filterOp == 9:  # contains
-                    add = referenceValue in value
-                elif filterOp == 10:  # does not startswith
-                    add = not (value.startswith(referenceValue))
-                elif filterOp == 11:  # does not endswith
-                    add = not (value.endswith(referenceValue))
-                elif filterOp == 12:  # does not contains
-                    add = not (referenceValue in value)
-                if add:
+                if oldEntry.getObjId() in keepIds:
                     newEntry = self.inputSet.get().ITEM_TYPE()
                     newEntry.copy(oldEntry)
                     outputSet.append(newEntry)
@@ -162,37 +204,29 @@ class ProtBioinformaticsListOperate(EMProtocol):
                     outputSet.append(newEntry)
 
         elif self.operation.get()>=3 and self.operation.get()<=6:
-            # Top N, Bottom N,Top %, Bottom %
-            V = []
-            for entry in self.inputSet.get():
-                V.append(entry.getAttributeValue(self.filterColumn.get()))
-            V.sort()
+            # Top N, Bottom N,Top %, Bottom %: bounded heap over (value, id), ties are resolved by id
             op = self.operation.get()
-            if op==3:
-                threshold = V[-self.N.get()]
-            elif op==4:
-                threshold = V[self.N.get()-1]
-            elif op==5:
-                threshold = V[-ceil(self.percentile.get()/100*len(V))]
-            elif op==6:
-                threshold = V[ceil(self.percentile.get()/100*len(V))-1]
+            if op==3 or op==4:
+                k = self.N.get()
+            else:
+                k = ceil(self.percentile.get()/100*len(self.inputSet.get()))
+            entries = ((values[0], objId)
+                       for values, objId in self.iterValues(self.inputSet.get(), [self.filterColumn.get()])
+                       if values[0] is not None)
+            if op==3 or op==5:
+                selected = heapq.nlargest(k, entries, key=lambda entry: (entry[0], -entry[1]))
+            else:
+                selected = heapq.nsmallest(k, entries)
 
-            for oldEntry in self.inputSet.get():
-                value = oldEntry.getAttributeValue(self.filterColumn.get())
-                if (op==3 or op==5) and value>=threshold:
-                    newEntry = self.inputSet.get().ITEM_TYPE()
-                    newEntry.copy(oldEntry)
-                    outputSet.append(newEntry)
-                elif (op==4 or op==6) and value<=threshold:
-                    newEntry = self.inputSet.get().ITEM_TYPE()
-                    newEntry.copy(oldEntry)
-                    outputSet.append(newEntry)
+            for _, objId in sorted(selected, key=lambda entry: entry[1]):
+                newEntry = self.inputSet.get().ITEM_TYPE()
+                newEntry.copy(self.inputSet.get()[objId])
+                outputSet.append(newEntry)
 
         elif self.operation.get()==7:
             # Count the number of entries that are the same
             count={}
-            for oldEntry in self.inputSet.get():
-                value = oldEntry.getAttributeValue(self.filterColumn.get())
+            for (value,), _ in self.iterValues(self.inputSet.get(), [self.filterColumn.get()]):
                 if not value in count:
                     count[value] = 0
                 count[value] += 1
@@ -208,8 +242,7 @@ class ProtBioinformaticsListOperate(EMProtocol):
         elif self.operation.get()==8:
             # Intersection between 2 Sets
             secondSet={}
-            for entry in self.secondSet.get():
-                value = entry.getAttributeValue(self.filterColumn.get())
+            for (value,), _ in self.iterValues(self.secondSet.get(), [self.filterColumn.get()]):
                 if not value in secondSet:
                     secondSet[value] = True
 
@@ -222,23 +255,37 @@ class ProtBioinformaticsListOperate(EMProtocol):
                     outputSet.append(newEntry)
 
         elif self.operation.get()==9:
-            # Sort
-            V = []
-            newEntries = []
-            for entry in self.inputSet.get():
-                V.append(entry.getAttributeValue(self.filterColumn.get()))
+            # Sort with bounded memory: the keys are sorted in chunks written to disk and then merged
+            sortKeys = self.getSortKeys()
+            entries = self.iterValues(self.inputSet.get(), [key for key, _ in sortKeys])
+            for objId in externalSort(entries, [descending for _, descending in sortKeys], self._getTmpPath()):
                 newEntry = self.inputSet.get().ITEM_TYPE()
-                newEntry.copy(entry)
+                newEntry.copy(self.inputSet.get()[objId])
                 newEntry.cleanObjId()
-                newEntries.append(newEntry)
-            if self.direction.get()==0:
-                idxSort = np.argsort(V)
-            else:
-                idxSort = np.argsort(-np.asarray(V))
+                outputSet.append(newEntry)
 
-            for idx in idxSort:
-                outputSet.append(newEntries[idx])
+    def iterValues(self, inputSet, attributes):
+        """ (values, id) of the entries of a set. The entries are read as light rows if the attributes
+            are columns of the set file"""
+        if hasattr(inputSet, 'iterRows') and len(inputSet)>0:
+            columns = getSetColumns(inputSet.getFileName())
+            if all(attribute in columns for attribute in attributes):
+                return ((row[1:], row.objId) for row in inputSet.iterRows(attributes))
+        return ((tuple(entry.getAttributeValue(attribute) for attribute in attributes), entry.getObjId())
+                for entry in inputSet)
 
-        if len(outputSet)>0:
-            self._defineOutputs(output=outputSet)
-            self._defineSourceRelation(self.inputSet, outputSet)
+    def getPredicate(self):
+        """ Filter predicate, either the expression or the single comparison of the filter parameters"""
+        if self.filterOp.get()==13:
+            return parsePredicate(self.filterExpression.get())
+        return singlePredicate(self.filterColumn.get(), self.getEnumText('filterOp'), self.filterValue.get(),
+                               self.filterValue2.get())
+
+    def getSortKeys(self):
+        """ List of (column, descending) starting with the filter column"""
+        sortKeys = [(self.filterColumn.get(), self.direction.get()==1)]
+        for key in (self.secondaryKeys.get() or "").split(';'):
+            tokens = key.split()
+            if len(tokens)>0:
+                sortKeys.append((tokens[0], len(tokens)>1 and tokens[1].lower()=='desc'))
+        return sortKeys
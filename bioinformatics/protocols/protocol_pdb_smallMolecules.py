@@ -26,11 +26,13 @@
 
 import lxml.etree as ET
 import os
-import urllib.request
+import sys
 
 from pwem.protocols import EMProtocol
 import pyworkflow.object as pwobj
-from pyworkflow.protocol.params import (PointerParam)
+from pyworkflow.protocol.params import PointerParam, IntParam, LEVEL_ADVANCED
+from bioinformatics.utils.databaseQueries import fetchLigandInfo
+from bioinformatics.utils.recordCache import fetchCached
 from bioinformatics.objects import DatabaseID, SetOfDatabaseID
 from bioinformatics import Plugin
 
@@ -43,6 +45,9 @@ class ProtBioinformaticsPDBSmallMolecules(EMProtocol):
         form.addParam('inputListID', PointerParam, pointerClass="SetOfDatabaseID",
                        label='List of PDB Ids:', allowsNull=False,
                        help="List of atomic structures for the query")
+        form.addParam('chunkSize', IntParam, label='Structures per query', default=100, expertLevel=LEVEL_ADVANCED,
+                      help='Structures are requested in batches of this size. Structures missing from a batched answer '
+                           'are requested one by one')
 
     # --------------------------- INSERT steps functions --------------------
     def _insertAllSteps(self):
@@ -55,21 +60,21 @@ class ProtBioinformaticsPDBSmallMolecules(EMProtocol):
             if pdbId not in listIds:
                 listIds.append(pdbId)
 
+        jobs = {}
+        for pdbId in listIds:
+            fnXml = self._getExtraPath("%s.xml"%pdbId)
+            if not os.path.exists(fnXml):
+                jobs[pdbId] = fnXml
+        print("Fetching ligands of %d structures"%len(jobs))
+        sys.stdout.flush()
+        fetchCached("rcsb", "ligandInfo", jobs, lambda missing: fetchLigandInfo(missing, self.chunkSize.get()))
+
         ligandDict = {}
         currentLigand = None
         ligandName = None
         for pdbId in listIds:
             print("Processing %s"%pdbId)
             fnXml=self._getExtraPath("%s.xml"%pdbId)
-            if not os.path.exists(fnXml):
-                urlId="https://www.rcsb.org/pdb/rest/ligandInfo?structureId=%s"%pdbId
-                print("Fetching ligands: %s"%urlId)
-                for i in range(3):
-                    try:
-                        urllib.request.urlretrieve(urlId,fnXml)
-                        break
-                    except: # The library raises an exception when the web is not found
-                        pass
             if os.path.exists(fnXml):
                 tree = ET.parse(fnXml)
                 # print(ET.tostring(tree, pretty_print=True))
@@ -114,27 +119,27 @@ class ProtBioinformaticsPDBSmallMolecules(EMProtocol):
                             currentLigand._PDBLigandSmiles = pwobj.String(child.text)
 
         outputDatabaseID = SetOfDatabaseID().create(path=self._getPath(),suffix='SmallMols')
-        for chemId in ligandDict:
-            if not hasattr(ligandDict[chemId],"_PDBLigandChemicalName"):
-                ligandDict[chemId]._PDBLigandChemicalName = pwobj.String("Not available")
-            if not hasattr(ligandDict[chemId],"_PDBLigandFormula"):
-                ligandDict[chemId]._PDBLigandFormula = pwobj.String("Not available")
-            if not hasattr(ligandDict[chemId],"_PDBLigandInChI"):
-                ligandDict[chemId]._PDBLigandInChI = pwobj.String("Not available")
-            if not hasattr(ligandDict[chemId],"_PDBLigandInChiKey"):
-                ligandDict[chemId]._PDBLigandInChiKey = pwobj.String("Not available")
-            if not hasattr(ligandDict[chemId],"_PDBLigandSmiles"):
-                ligandDict[chemId]._PDBLigandSmiles = pwobj.String("Not available")
-                ligandDict[chemId]._PDBLigandSmilesImage = pwobj.String("Not available")
-            else:
-                fnTmp = self._getTmpPath("molecule.smiles")
-                fnOut = self._getExtraPath("%s.png"%chemId)
-                fh = open(fnTmp,"w")
-                fh.write(ligandDict[chemId]._PDBLigandSmiles.get())
-                fh.close()
-                args = Plugin.getPluginHome('utils/rdkitUtils.py')+" draw %s %s"%(fnTmp,fnOut)
-                Plugin.runRDKit(self,"python3",args)
-                ligandDict[chemId]._PDBLigandImage = pwobj.String(fnOut)
-            outputDatabaseID.append(ligandDict[chemId])
+        with Plugin.startRDKitWorker() as worker:
+            for chemId in ligandDict:
+                if not hasattr(ligandDict[chemId],"_PDBLigandChemicalName"):
+                    ligandDict[chemId]._PDBLigandChemicalName = pwobj.String("Not available")
+                if not hasattr(ligandDict[chemId],"_PDBLigandFormula"):
+                    ligandDict[chemId]._PDBLigandFormula = pwobj.String("Not available")
+                if not hasattr(ligandDict[chemId],"_PDBLigandInChI"):
+                    ligandDict[chemId]._PDBLigandInChI = pwobj.String("Not available")
+                if not hasattr(ligandDict[chemId],"_PDBLigandInChiKey"):
+                    ligandDict[chemId]._PDBLigandInChiKey = pwobj.String("Not available")
+                if not hasattr(ligandDict[chemId],"_PDBLigandSmiles"):
+                    ligandDict[chemId]._PDBLigandSmiles = pwobj.String("Not available")
+                    ligandDict[chemId]._PDBLigandSmilesImage = pwobj.String("Not available")
+                else:
+                    fnTmp = self._getTmpPath("molecule.smi")
+                    fnOut = self._getExtraPath("%s.png"%chemId)
+                    fh = open(fnTmp,"w")
+                    fh.write(ligandDict[chemId]._PDBLigandSmiles.get())
+                    fh.close()
+                    worker.draw(fnTmp, fnOut)
+                    ligandDict[chemId]._PDBLigandImage = pwobj.String(fnOut)
+                outputDatabaseID.append(ligandDict[chemId])
         self._defineOutputs(outputSmallMols=outputDatabaseID)
         self._defineSourceRelation(self.inputListID, outputDatabaseID)
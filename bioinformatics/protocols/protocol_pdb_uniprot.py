@@ -27,12 +27,12 @@
 import lxml.etree as ET
 import os
 import sys
-import urllib.request
 
 from pwem.protocols import EMProtocol
-import pyworkflow.object as pwobj
 from pyworkflow.protocol.params import (PointerParam)
-from bioinformatics.objects import DatabaseID, SetOfDatabaseID
+from bioinformatics.utils.webFetch import WebFetcher
+from bioinformatics.utils.recordCache import fetchCached
+from bioinformatics.objects import SetOfDatabaseID
 
 class ProtBioinformaticsPDBUniprot(EMProtocol):
     """Query PDB for Uniprot sequences related to these proteins"""
@@ -48,30 +48,36 @@ class ProtBioinformaticsPDBUniprot(EMProtocol):
     def _insertAllSteps(self):
         self._insertFunctionStep('searchStep')
 
+    def getQuery(self, item):
+        query = item._pdbId.get()
+        if hasattr(item,"_chain") and item._chain.get():
+            query+="."+item._chain.get().upper()
+        return query
+
     def searchStep(self):
-        outputDatabaseID = SetOfDatabaseID().create(path=self._getPath())
+        jobs = {}
+        pending = set()
+        for item in self.inputListID.get():
+            fnXml = self._getExtraPath("%s.xml"%item._pdbId.get())
+            if not os.path.exists(fnXml) and not fnXml in pending:
+                jobs[self.getQuery(item)] = fnXml
+                pending.add(fnXml)
+        print("Fetching %d uniprot mappings"%len(jobs))
+        sys.stdout.flush()
+        url = "https://www.rcsb.org/pdb/rest/das/pdb_uniprot_mapping/alignment?query=%s"
+        fetchCached("rcsb", "uniprotMapping", jobs, lambda missing: WebFetcher().fetchAll(
+            [(url % query, fnXml) for query, fnXml in missing.items()]))
+
+        rows = []
         for item in self.inputListID.get():
-            newItem = DatabaseID()
-            newItem.copy(item)
-            newItem._uniprotId = pwobj.String("Not available")
-            newItem._uniprotLink = pwobj.String("Not available")
+            newRow = item.getRow(copyId=True)
+            newRow['_uniprotId'] = "Not available"
+            newRow['_uniprotLink'] = "Not available"
 
             pdbId = item._pdbId.get()
             print("Processing %s"%pdbId)
 
-            urlId = "https://www.rcsb.org/pdb/rest/das/pdb_uniprot_mapping/alignment?query=%s" % pdbId
-            if hasattr(item,"_chain"):
-                urlId+="."+item._chain.get().upper()
-
             fnXml=self._getExtraPath("%s.xml"%pdbId)
-            if not os.path.exists(fnXml):
-                print("Fetching uniprot: %s"%urlId)
-                for i in range(3):
-                    try:
-                        urllib.request.urlretrieve(urlId,fnXml)
-                        break
-                    except: # The library raises an exception when the web is not found
-                        pass
             if os.path.exists(fnXml):
                 try:
                     tree = ET.parse(fnXml)
@@ -84,12 +90,17 @@ class ProtBioinformaticsPDBUniprot(EMProtocol):
                                 uniprotId=child.attrib['dbAccessionId']
                                 break
                     if uniprotId:
-                        newItem._uniprotId = pwobj.String(uniprotId)
-                        newItem._uniprotLink = pwobj.String("https://www.uniprot.org/uniprot/%s"%uniprotId)
+                        newRow['_uniprotId'] = uniprotId
+                        newRow['_uniprotLink'] = "https://www.uniprot.org/uniprot/%s"%uniprotId
                 except:
                     print("    Cannot parse the Uniprot XML: %s"%fnXml)
 
-                outputDatabaseID.append(newItem)
+                rows.append(newRow)
+
+        outputDatabaseID = SetOfDatabaseID().create(path=self._getPath())
+        if len(rows)>0:
+            outputDatabaseID.appendMany(rows, self.inputListID.get().getFirstItem().getColumns()+
+                                        ['_uniprotId', '_uniprotLink'])
 
         self._defineOutputs(outputUniprot=outputDatabaseID)
         self._defineSourceRelation(self.inputListID, outputDatabaseID)
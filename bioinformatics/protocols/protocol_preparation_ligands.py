@@ -26,15 +26,21 @@
 import glob
 import os
 
+from pyworkflow.protocol import STEPS_PARALLEL
 from pyworkflow.protocol.params import PointerParam
 from .protocol_preparation_receptor import ProtBioinformaticsADTPrepare
 from bioinformatics.objects import SmallMolecule, SetOfSmallMolecules
+from bioinformatics.utils.moleculeFiles import writeMoleculeRecord
 
 class ProtBioinformaticsADTPrepareLigands(ProtBioinformaticsADTPrepare):
         """Prepare ligands using Autodocking Tools from MGL"""
         _label = 'ligand preparation ADT'
         _program = ""
 
+        def __init__(self, **kwargs):
+            ProtBioinformaticsADTPrepare.__init__(self, **kwargs)
+            self.stepsExecutionMode = STEPS_PARALLEL
+
         def _defineParams(self, form):
             self.typeRL="ligand"
             form.addSection(label='Input')
@@ -42,18 +48,63 @@ class ProtBioinformaticsADTPrepareLigands(ProtBioinformaticsADTPrepare):
                           label='Set of small molecules:', allowsNull=False,
                           help='It must be in pdb or mol2 format, you may use Schrodinger convert to change it')
             ProtBioinformaticsADTPrepare._defineParamsBasic(self, form)
+            form.addParallelSection(threads=4, mpi=0)
 
-        def preparationStep(self):
-            for mol in self.inputSmallMols.get():
-                fnSmall = mol.smallMoleculeFile.get()
-                fnMol = os.path.split(fnSmall)[1]
-                fnRoot = os.path.splitext(fnMol)[0]
+        def _insertAllSteps(self):
+            # Only the chunk number is stored with the step, each step reads its molecules from the input set.
+            # The step runner takes one of the threads
+            nMolecules = self.inputSmallMols.get().getSize()
+            nChunks = max(1, self.numberOfThreads.get()-1)
+            prepSteps = []
+            for chunk in range(nChunks):
+                if chunk < nMolecules:
+                    stepId = self._insertFunctionStep('preparationStep', chunk, nChunks, prerequisites=[])
+                    prepSteps.append(stepId)
+            self._insertFunctionStep('createOutput', prerequisites=prepSteps)
+
+        def _iterChunk(self, chunk, nChunks):
+            """ (file, name, offset, size) of the molecules of a chunk. Offset and size are None for molecules
+                that are not in a library. The set file is read with its own connection because the steps
+                run in parallel, and only the rows of the chunk are selected"""
+            for row in self.inputSmallMols.get().iterRows(chunk=(chunk, nChunks)):
+                fnMol = row.smallMoleculeFile
+                offset = getattr(row, '_libraryOffset', None)
+                if offset is not None:
+                    yield fnMol, row._molName, offset, row._librarySize
+                else:
+                    yield fnMol, os.path.splitext(os.path.split(fnMol)[1])[0], None, None
+
+        def preparationStep(self, chunk, nChunks):
+            for fnMol, fnRoot, offset, size in self._iterChunk(chunk, nChunks):
                 fnOut = self._getExtraPath(fnRoot+".pdbqt")
+                if os.path.exists(fnOut) and os.path.getsize(fnOut)>0:
+                    continue # Already prepared in a previous execution
+                if offset is not None:
+                    # prepare_ligand4 needs a file with a single molecule
+                    fnSmall = self._getTmpPath(fnRoot+os.path.splitext(fnMol)[1])
+                    writeMoleculeRecord(fnMol, offset, size, fnSmall)
+                else:
+                    fnSmall = fnMol
 
                 args = ' -v -l %s -o %s' % (fnSmall, fnOut)
-                ProtBioinformaticsADTPrepare.callPrepare(self, "prepare_ligand4", args)
+                try:
+                    ProtBioinformaticsADTPrepare.callPrepare(self, "prepare_ligand4", args)
+                except Exception as e:
+                    print("Ligand %s could not be prepared: %s" % (fnRoot, e))
+                    if os.path.exists(fnOut):
+                        os.remove(fnOut)
+                if offset is not None:
+                    os.remove(fnSmall)
 
         def createOutput(self):
+            failed = []
+            for mol in self.inputSmallMols.get():
+                if not os.path.exists(self._getExtraPath(mol.getMolName()+".pdbqt")):
+                    failed.append(mol.getMolName())
+            with open(self._getPath("failedLigands.txt"), 'w') as fh:
+                for molName in failed:
+                    fh.write(molName+"\n")
+
             outputSmallMolecules = SetOfSmallMolecules().create(path=self._getPath(), suffix='SmallMols')
             for fnOut in glob.glob(self._getExtraPath("*.pdbqt")):
                 smallMolecule = SmallMolecule(smallMolFilename=fnOut)
@@ -61,3 +112,13 @@ class ProtBioinformaticsADTPrepareLigands(ProtBioinformaticsADTPrepare):
             if len(outputSmallMolecules)>0:
                 self._defineOutputs(outputSmallMols=outputSmallMolecules)
                 self._defineSourceRelation(self.inputSmallMols, outputSmallMolecules)
+
+        def _summary(self):
+            summary = []
+            fnFailed = self._getPath("failedLigands.txt")
+            if os.path.exists(fnFailed):
+                with open(fnFailed) as fh:
+                    failed = [line.strip() for line in fh if line.strip()]
+                if len(failed)>0:
+                    summary.append("%d ligands could not be prepared, see %s" % (len(failed), fnFailed))
+            return summary
@@ -32,6 +32,7 @@ import urllib.request
 import pyworkflow.object as pwobj
 from pwem.protocols import EMProtocol
 from pyworkflow.protocol.params import PointerParam, BooleanParam, EnumParam
+from bioinformatics.utils.recordCache import getRecordCache, BufferedRecords
 
 class ProtBioinformaticsPubChemSearch(EMProtocol):
     """Add the best batching entry from Pubchem https://pubchem.ncbi.nlm.nih.gov/"""
@@ -48,46 +49,57 @@ class ProtBioinformaticsPubChemSearch(EMProtocol):
 
     def operateStep(self):
         outputSet = self.inputSet.get().create(self._getPath())
+        # The downloaded records are stored in the cache in batches
+        cache = BufferedRecords(getRecordCache())
         for oldEntry in self.inputSet.get():
-            fnSmall = oldEntry.smallMoleculeFile.get()
-            fnBase = os.path.splitext(os.path.split(fnSmall)[1])[0]
+            fnBase = oldEntry.getMolName()
             fnName = self._getExtraPath(fnBase+".txt")
             cid = None
             if not os.path.exists(fnName):
-                if fnSmall.endswith('.smi'):
-                    fhSmile = open(fnSmall)
-                    smile = fhSmile.readlines()[0].split()[0].strip() # Only first line
-                    fhSmile.close()
+                smile = None # Only SMILES entries can be looked up
+                if oldEntry.getMolExtension()=='.smi':
+                    smile = oldEntry.getRecord().split()[0].strip() # Only first line
                     url = "https://pubchem.ncbi.nlm.nih.gov/rest/pug/compound/smiles/%s/cids/TXT"%smile
                     print(url)
 
                 pubChemName = ""
-                try:
-                    with contextlib.closing(urllib.request.urlopen(url)) as fp:
-                        mybytes = fp.read()
+                if smile is not None:
+                    try:
+                        mybytes = cache.get("pubchem", "cid", smile)
+                        if mybytes is None:
+                            with contextlib.closing(urllib.request.urlopen(url)) as fp:
+                                mybytes = fp.read()
+                                fp.close()
+                            cache.put("pubchem", "cid", smile, mybytes)
                         cid = mybytes.decode("utf8").split()[0]
-                        fp.close()
 
-                    if cid!="0":
-                        url = "https://pubchem.ncbi.nlm.nih.gov/rest/pug_view/data/compound/%s/XML/?response_type=save&response_basename=compound_CID_%s"%(cid,cid)
-                        print(url)
-                        fnXml = self._getTmpPath("compound.xml")
-                        urllib.request.urlretrieve(url, fnXml)
-                        if os.path.exists(fnXml):
-                            tree = ET.parse(fnXml)
+                        if cid!="0":
+                            url = "https://pubchem.ncbi.nlm.nih.gov/rest/pug_view/data/compound/%s/XML/?response_type=save&response_basename=compound_CID_%s"%(cid,cid)
+                            print(url)
+                            fnXml = self._getTmpPath("compound.xml")
+                            compound = cache.get("pubchem", "compoundXml", cid)
+                            if compound is None:
+                                urllib.request.urlretrieve(url, fnXml)
+                                with open(fnXml, 'rb') as fh:
+                                    cache.put("pubchem", "compoundXml", cid, fh.read())
+                            else:
+                                with open(fnXml, 'wb') as fh:
+                                    fh.write(compound)
+                            if os.path.exists(fnXml):
+                                tree = ET.parse(fnXml)
 
-                        pubChemName = ""
-                        for child in tree.getroot().iter():
-                            if "RecordTitle" in child.tag:
-                                pubChemName = child.text
-                                print(pubChemName)
-                                fh = open(fnName,'w')
-                                fh.write(pubChemName+" ;; %s"%cid)
-                                fh.close()
-                                break
-                except Exception as e:
-                    print(e)
-                    print("  Could not be retrieved")
+                            pubChemName = ""
+                            for child in tree.getroot().iter():
+                                if "RecordTitle" in child.tag:
+                                    pubChemName = child.text
+                                    print(pubChemName)
+                                    fh = open(fnName,'w')
+                                    fh.write(pubChemName+" ;; %s"%cid)
+                                    fh.close()
+                                    break
+                    except Exception as e:
+                        print(e)
+                        print("  Could not be retrieved")
             else:
                 fh = open(fnName)
                 tokens = fh.readline().split(';;')
@@ -104,6 +116,7 @@ class ProtBioinformaticsPubChemSearch(EMProtocol):
                 url = ""
             newEntry.pubChemURL = pwobj.String(url)
             outputSet.append(newEntry)
+        cache.flush()
 
         if len(outputSet)>0:
             self._defineOutputs(output=outputSet)
@@ -50,16 +50,18 @@ class ProtBioinformaticsSmallMoleculesPDB(EMProtocol):
     def extractStep(self):
         listIds={}
         smallMolID = "none"
-        for item in self.inputListID.get():
-            if hasattr(item,"_iteractsWithPDBId"):
-                tokens = item._iteractsWithPDBId.get().split(";")
+        firstItem = self.inputListID.get().getFirstItem()
+        columns = [column for column in ["_iteractsWithPDBId", "_PDBChemId"] if hasattr(firstItem, column)]
+        for row in self.inputListID.get().iterRows(["dbId"]+columns):
+            if hasattr(row,"_iteractsWithPDBId"):
+                tokens = row._iteractsWithPDBId.split(";")
                 for token in tokens:
                     pdbId = token.strip()
                     if not pdbId in listIds:
                         listIds[pdbId]=[]
-                    chemId=item.getDbId()
-                    if hasattr(item,"_PDBChemId"):
-                        chemId=item._PDBChemId.get()
+                    chemId=row.dbId
+                    if hasattr(row,"_PDBChemId"):
+                        chemId=row._PDBChemId
                         smallMolID = "pdbchem"
                     listIds[pdbId].append(chemId)
 
@@ -24,15 +24,19 @@
 # *
 # **************************************************************************
 
-import lxml.etree as ET
+import json
 import os
 import sys
-import urllib.request
 
 from pwem.protocols import EMProtocol
-import pyworkflow.object as pwobj
-from pyworkflow.protocol.params import PointerParam, EnumParam
-from bioinformatics.objects import DatabaseID, SetOfDatabaseID
+from pyworkflow.protocol.params import PointerParam, EnumParam, IntParam, PathParam, LEVEL_ADVANCED
+from bioinformatics import Plugin
+from bioinformatics.utils.databaseQueries import fetchUniprotEntries
+from bioinformatics.utils.recordCache import fetchCached, getRecordCache
+from bioinformatics.utils.uniprotXrefs import XrefIndex, iterUniprotEntries
+from bioinformatics.objects import SetOfDatabaseID
+
+OUTPUT_NAMES = {0: 'PDB', 1: 'ENA', 2: 'GO', 3: 'Family'}
 
 class ProtBioinformaticsUniprotCrossRef(EMProtocol):
     """Extract cross references from uniprot"""
@@ -44,137 +48,148 @@ class ProtBioinformaticsUniprotCrossRef(EMProtocol):
                        label='List of Uniprot Ids:', allowsNull=False,
                        help="List of atomic structures for the query")
         form.addParam('extract', EnumParam, choices=['PDB (structure)', 'ENA (RNA sequence)', 'GO (Gene Ontology)',
-                                                     'Family or domain'],
-                       default=0, label='What to extract:')
+                                                     'Family or domain', 'All'],
+                       default=0, label='What to extract:',
+                       help='All produces the sets outputPDB, outputENA, outputGO and outputFamily in a single pass')
+        form.addParam('source', EnumParam, choices=['Web', 'Local UniProt dump'], default=0, label='Source:',
+                      help='A local dump (uniprot_sprot.xml.gz or idmapping.dat.gz from '
+                           'https://ftp.uniprot.org/pub/databases/uniprot/current_release/knowledgebase) '
+                           'is indexed the first time it is used, and then it is queried without network access')
+        form.addParam('dumpFile', PathParam, condition='source==1', label='UniProt dump:',
+                      help='UniProt XML or idmapping.dat file, possibly gzipped')
+        form.addParam('chunkSize', IntParam, label='Entries per query', default=100, expertLevel=LEVEL_ADVANCED,
+                      condition='source==0',
+                      help='Entries are requested in batches of this size. Entries missing from a batched answer '
+                           'are requested one by one')
 
     # --------------------------- INSERT steps functions --------------------
     def _insertAllSteps(self):
         self._insertFunctionStep('extractStep')
 
+    def fetchEntries(self, extracted):
+        """ Download the entries whose references have not been extracted yet"""
+        jobs = {}
+        for item in self.inputListID.get():
+            uniprotId = item._uniprotId.get()
+            fnXML = self._getExtraPath("%s.xml"%uniprotId)
+            if not os.path.exists(fnXML) and not uniprotId in extracted:
+                jobs[uniprotId] = fnXML
+        print("Fetching %d uniprot entries"%len(jobs))
+        sys.stdout.flush()
+        fetchCached("uniprot", "xml", jobs,
+                    lambda missing: fetchUniprotEntries(missing, "xml", self.chunkSize.get()))
+
     def extractStep(self):
-        outputDatabaseID = SetOfDatabaseID().create(path=self._getPath())
+        if self.source.get()==0:
+            cache = getRecordCache()
+            uniprotIds = [item._uniprotId.get() for item in self.inputListID.get()]
+            extractedXrefs = cache.getMany("uniprot", "xrefs", uniprotIds)
+            newXrefs = {}
+            self.fetchEntries(extractedXrefs)
+        else:
+            xrefIndex = XrefIndex(self.dumpFile.get(),
+                                  os.path.join(Plugin.getVar("BIOINFORMATICS_CACHE_DIR"), "uniprotDumps"))
+
+        if self.extract.get()==4:
+            outputSets = {extract: SetOfDatabaseID().create(path=self._getPath(), suffix=OUTPUT_NAMES[extract])
+                          for extract in OUTPUT_NAMES}
+        else:
+            outputSets = {self.extract.get(): SetOfDatabaseID().create(path=self._getPath())}
+        firstItem = self.inputListID.get().getFirstItem()
+        columns = firstItem.getColumns() if firstItem is not None else []
         for item in self.inputListID.get():
 
             uniprotId = item._uniprotId.get()
             print("Processing %s"%uniprotId)
 
-            urlId = "https://www.uniprot.org/uniprot/%s.xml" % uniprotId
-
-            fnXML=self._getExtraPath("%s.xml"%uniprotId)
-            if not os.path.exists(fnXML):
-                print("Fetching uniprot: %s"%urlId)
-                for i in range(3):
-                    try:
-                        urllib.request.urlretrieve(urlId,fnXML)
-                    except: # The library raises an exception when the web is not found
-                        pass
-            if os.path.exists(fnXML):
-                tree = ET.parse(fnXML)
-
-                outputId = []
-                for child in tree.getroot().iter():
-                    if child.tag.endswith("dbReference"):
-                        if self.extract.get()==0:
-                            if child.attrib['type']=='PDB':
-                                outputId.append(child.attrib['id'])
-                        elif self.extract.get()==1:
-                            if child.attrib['type'] == 'EMBL':
-                                moleculeType="Not available"
-                                for childChild in child.iter():
-                                    if childChild.tag.endswith("property"):
-                                        if childChild.attrib["type"]=="molecule type":
-                                            moleculeType=childChild.attrib["value"]
-                                outputId.append((child.attrib['id'],moleculeType))
-                        elif self.extract.get()==2:
-                            if child.attrib['type'] == 'GO':
-                                goTerm="Not available"
-                                for childChild in child.iter():
-                                    if childChild.tag.endswith("property"):
-                                        if childChild.attrib["type"]=="term":
-                                            goTerm=childChild.attrib["value"]
-                                outputId.append((child.attrib['id'],goTerm))
-                        elif self.extract.get()==3:
-                            if child.attrib['type'] == 'Gene3D':
-                                famId = child.attrib['id']
-                                url = 'http://www.cathdb.info/version/latest/superfamily/%s'%famId
-                                outputId.append(('Gene3D', famId,'Not available',url))
-                            elif child.attrib['type'] == 'HAMAP':
-                                famId = child.attrib['id']
-                                superfamily="Not available"
-                                for childChild in child.iter():
-                                    if childChild.tag.endswith("property"):
-                                        if childChild.attrib["type"]=="entry name":
-                                            superfamily=childChild.attrib["value"]
-                                            break
-                                url = 'https://hamap.expasy.org/signature/%s'%famId
-                                outputId.append(('HAMAP',child.attrib['id'],superfamily,url))
-                            elif child.attrib['type'] == 'InterPro':
-                                famId = child.attrib['id']
-                                superfamily="Not available"
-                                for childChild in child.iter():
-                                    if childChild.tag.endswith("property"):
-                                        if childChild.attrib["type"]=="entry name":
-                                            superfamily=childChild.attrib["value"]
-                                url = 'https://www.ebi.ac.uk/interpro/entry/InterPro/%s'%famId
-                                outputId.append(('InterPro',child.attrib['id'],superfamily,url))
-                            elif child.attrib['type'] == 'Pfam':
-                                famId = child.attrib['id']
-                                superfamily="Not available"
-                                for childChild in child.iter():
-                                    if childChild.tag.endswith("property"):
-                                        if childChild.attrib["type"]=="entry name":
-                                            superfamily=childChild.attrib["value"]
-                                url = 'http://pfam.xfam.org/family/%s'%famId
-                                outputId.append(('Pfam',child.attrib['id'],superfamily,url))
-                            elif child.attrib['type'] == 'SUPFAM':
-                                famId = child.attrib['id']
-                                superfamily="Not available"
-                                for childChild in child.iter():
-                                    if childChild.tag.endswith("property"):
-                                        if childChild.attrib["type"]=="entry name":
-                                            superfamily=childChild.attrib["value"]
-                                url = 'http://supfam.org/SUPERFAMILY/cgi-bin/scop.cgi?ipid=%s'%famId
-                                outputId.append(('Supfam',child.attrib['id'],superfamily,url))
-
-                if len(outputId)>0:
-                    if self.extract.get() == 0:
-                        for outId in outputId:
-                            newItem = DatabaseID()
-                            newItem.copy(item, copyId=False)
-                            newItem._pdbId = pwobj.String(outId)
-                            newItem._PDBLink = pwobj.String("https://www.rcsb.org/structure/%s" % outId)
-                            outputDatabaseID.append(newItem)
-                    elif self.extract.get()==1:
-                        for outId, moleculeType in outputId:
-                            newItem = DatabaseID()
-                            newItem.copy(item, copyId=False)
-                            newItem._enaId = pwobj.String(outId)
-                            newItem._enaLink = pwobj.String("https://www.ebi.ac.uk/ena/data/view/%s" % outId)
-                            newItem._enaMoleculeType = pwobj.String(moleculeType)
-                            outputDatabaseID.append(newItem)
-                    elif self.extract.get()==2:
-                        for outId, goTerm in outputId:
-                            newItem = DatabaseID()
-                            newItem.copy(item, copyId=False)
-                            newItem._goId = pwobj.String(outId)
-                            newItem._goLink = pwobj.String("http://amigo.geneontology.org/amigo/term/%s" % outId)
-                            newItem._goTerm = pwobj.String(goTerm)
-                            outputDatabaseID.append(newItem)
-                    elif self.extract.get()==3:
-                        for familyDb, outId, superfamily, url in outputId:
-                            newItem = DatabaseID()
-                            newItem.copy(item, copyId=False)
-                            newItem._familyDb = pwobj.String(familyDb)
-                            newItem._familyId = pwobj.String(outId)
-                            newItem._familyLink = pwobj.String(url)
-                            newItem._familyName = pwobj.String(superfamily)
-                            outputDatabaseID.append(newItem)
-
-        self._defineOutputs(outputUniprot=outputDatabaseID)
-        self._defineSourceRelation(self.inputListID, outputDatabaseID)
+            xrefs = None
+            if self.source.get()==0:
+                fnXML=self._getExtraPath("%s.xml"%uniprotId)
+                if uniprotId in extractedXrefs:
+                    xrefs = json.loads(extractedXrefs[uniprotId].decode())
+                elif os.path.exists(fnXML):
+                    xrefs = self.parseXML(fnXML)
+                    newXrefs[uniprotId] = json.dumps(xrefs).encode()
+            else:
+                xrefs = xrefIndex.lookup(uniprotId)
+                if xrefs is None:
+                    print("  %s is not in the dump"%uniprotId)
+
+            row = item.getRow()
+            for extract, outputSet in outputSets.items():
+                outputId = self.getOutputIds(xrefs, extract) if xrefs is not None else []
+                self.appendItems(row, columns, extract, outputId, outputSet)
+
+        if self.source.get()==0:
+            cache.putMany("uniprot", "xrefs", newXrefs)
+        else:
+            xrefIndex.close()
+        if self.extract.get()==4:
+            for extract, outputSet in outputSets.items():
+                self._defineOutputs(**{'output'+OUTPUT_NAMES[extract]: outputSet})
+                self._defineSourceRelation(self.inputListID, outputSet)
+        else:
+            outputSet = outputSets[self.extract.get()]
+            self._defineOutputs(outputUniprot=outputSet)
+            self._defineSourceRelation(self.inputListID, outputSet)
+
+    def parseXML(self, fnXML):
+        """ All the (database, id, property) references of a UniProt XML entry, in a single streaming pass"""
+        xrefs = []
+        for accessions, entryXrefs in iterUniprotEntries(fnXML):
+            xrefs += entryXrefs
+        return xrefs
+
+    def getOutputIds(self, xrefs, extract):
+        """ References of one type (0=PDB, 1=ENA, 2=GO, 3=Family) among the (database, id, property)
+            of an entry"""
+        outputId = []
+        for database, id, value in xrefs:
+            value = value or "Not available"
+            if extract==0:
+                if database=='PDB':
+                    outputId.append(id)
+            elif extract==1:
+                if database=='EMBL':
+                    outputId.append((id, value))
+            elif extract==2:
+                if database=='GO':
+                    outputId.append((id, value))
+            elif extract==3:
+                if database=='Gene3D':
+                    outputId.append(('Gene3D', id, value, 'http://www.cathdb.info/version/latest/superfamily/%s'%id))
+                elif database=='HAMAP':
+                    outputId.append(('HAMAP', id, value, 'https://hamap.expasy.org/signature/%s'%id))
+                elif database=='InterPro':
+                    outputId.append(('InterPro', id, value, 'https://www.ebi.ac.uk/interpro/entry/InterPro/%s'%id))
+                elif database=='Pfam':
+                    outputId.append(('Pfam', id, value, 'http://pfam.xfam.org/family/%s'%id))
+                elif database=='SUPFAM':
+                    outputId.append(('Supfam', id, value, 'http://supfam.org/SUPERFAMILY/cgi-bin/scop.cgi?ipid=%s'%id))
+        return outputId
+
+    def appendItems(self, row, columns, extract, outputId, outputSet):
+        """ Add to outputSet one copy of the input entry (row with columns) for each reference in outputId"""
+        if extract==0:
+            outputSet.appendMany([dict(row, _pdbId=outId, _PDBLink="https://www.rcsb.org/structure/%s" % outId)
+                                  for outId in outputId], columns+['_pdbId', '_PDBLink'])
+        elif extract==1:
+            outputSet.appendMany([dict(row, _enaId=outId, _enaLink="https://www.ebi.ac.uk/ena/data/view/%s" % outId,
+                                       _enaMoleculeType=moleculeType)
+                                  for outId, moleculeType in outputId], columns+['_enaId', '_enaLink', '_enaMoleculeType'])
+        elif extract==2:
+            outputSet.appendMany([dict(row, _goId=outId, _goLink="http://amigo.geneontology.org/amigo/term/%s" % outId,
+                                       _goTerm=goTerm)
+                                  for outId, goTerm in outputId], columns+['_goId', '_goLink', '_goTerm'])
+        elif extract==3:
+            outputSet.appendMany([dict(row, _familyDb=familyDb, _familyId=outId, _familyLink=url, _familyName=superfamily)
+                                  for familyDb, outId, superfamily, url in outputId],
+                                 columns+['_familyDb', '_familyId', '_familyLink', '_familyName'])
 
     def _validate(self):
         errors=[]
+        if self.source.get()==1 and not os.path.exists(self.dumpFile.get() or ""):
+            errors.append("Cannot find the UniProt dump %s"%self.dumpFile.get())
         if not hasattr(self.inputListID.get().getFirstItem(),"_uniprotId"):
             errors.append("The set does not have an _uniprotId")
         return errors
\ No newline at end of file
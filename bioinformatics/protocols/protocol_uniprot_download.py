@@ -26,12 +26,13 @@
 
 import os
 import sys
-import urllib.request
 
 from pwem.protocols import EMProtocol
 from pwem.convert.sequence import sequenceLength
 import pyworkflow.object as pwobj
-from pyworkflow.protocol.params import PointerParam
+from pyworkflow.protocol.params import PointerParam, IntParam, LEVEL_ADVANCED
+from bioinformatics.utils.databaseQueries import fetchUniprotEntries
+from bioinformatics.utils.recordCache import fetchCached
 from bioinformatics.objects import DatabaseID, SetOfDatabaseID, ProteinSequenceFile
 
 class ProtBioinformaticsUniprotDownload(EMProtocol):
@@ -43,12 +44,26 @@ class ProtBioinformaticsUniprotDownload(EMProtocol):
         form.addParam('inputListID', PointerParam, pointerClass="SetOfDatabaseID",
                        label='List of Uniprot Ids:', allowsNull=False,
                        help="List of atomic structures for the query")
+        form.addParam('chunkSize', IntParam, label='Entries per query', default=100, expertLevel=LEVEL_ADVANCED,
+                      help='Entries are requested in batches of this size. Entries missing from a batched answer '
+                           'are requested one by one')
 
     # --------------------------- INSERT steps functions --------------------
     def _insertAllSteps(self):
         self._insertFunctionStep('searchStep')
 
     def searchStep(self):
+        jobs = {}
+        for item in self.inputListID.get():
+            uniprotId = item._uniprotId.get()
+            fnFasta = self._getExtraPath("%s.fasta"%uniprotId)
+            if not os.path.exists(fnFasta):
+                jobs[uniprotId] = fnFasta
+        print("Fetching %d uniprot entries"%len(jobs))
+        sys.stdout.flush()
+        fetchCached("uniprot", "fasta", jobs,
+                    lambda missing: fetchUniprotEntries(missing, "fasta", self.chunkSize.get()))
+
         outputDatabaseID = SetOfDatabaseID().create(path=self._getPath())
         fnList = []
         for item in self.inputListID.get():
@@ -58,22 +73,10 @@ class ProtBioinformaticsUniprotDownload(EMProtocol):
             newItem._unitprotSeqLength = pwobj.Integer(-1)
 
             uniprotId = item._uniprotId.get()
-            print("Processing %s"%uniprotId)
-
-            urlId = "https://www.uniprot.org/uniprot/%s.fasta" % uniprotId
-
             fnFasta=self._getExtraPath("%s.fasta"%uniprotId)
-            if not os.path.exists(fnFasta):
-                print("Fetching uniprot: %s"%urlId)
-                for i in range(3):
-                    try:
-                        urllib.request.urlretrieve(urlId,fnFasta)
-                        if not fnFasta in fnList:
-                            fnList.append(fnFasta)
-                        break
-                    except: # The library raises an exception when the web is not found
-                        pass
             if os.path.exists(fnFasta):
+                if not fnFasta in fnList:
+                    fnList.append(fnFasta)
                 newItem._uniprotFile = pwobj.String(fnFasta)
                 newItem._unitprotSeqLength = pwobj.Integer(sequenceLength(fnFasta))
 
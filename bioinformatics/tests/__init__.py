@@ -28,6 +28,7 @@ from pyworkflow.tests import *
 from .test_import_small_Molecules import TestImportSmallMolecules
 from .test_list_operate import TestListOperate
 from .test_export_csv import TestExportcsv
+from .test_web_fetch import TestWebFetch
 
 DataSet(name='ligandLibraries',
         folder='ligandLibraries',
@@ -26,13 +26,17 @@
 # *
 # **************************************************************************
 
+import contextlib
 import os
 from pathlib import Path
+import sqlite3
+import tempfile
 from pyworkflow.tests import *
 from pyworkflow.protocol import *
 from pwem.protocols.protocol_import import ProtImportPdb
 from bioinformatics.protocols import ProtBioinformaticsListOperate as LOperate
 from bioinformatics.protocols import ProtBioinformaticsDali as DALI
+from bioinformatics.utils.setUtils import externalSort
 
 
 class TestImportBase(BaseTest):
@@ -237,7 +241,7 @@ class TestListOperate(TestCreateOutput):
         setf = setf.output
 
         self.assertIsNotNone(setf, "Error in creation of a new SetOfDatabaseID - It is NONE")
-        self.assertTrue(setf.getSize() == 23, "Error in creation of a new SetOfDatabaseID. There is not unique entries")
+        self.assertTrue(setf.getSize() == 22, "Error in creation of a new SetOfDatabaseID. 5% of 432 entries are 22 entries")
 
         for entry in setf:
             first_value = entry.getAttributeValue('_DaliZscore')
@@ -330,3 +334,69 @@ class TestListOperate(TestCreateOutput):
 
         self.assertTrue(first_value == 51.4, "Failed to sort (descending) the SetDatabaseID regarding _DaliZscorecolumn")
 
+
+        # Sort by 2 columns: _DaliZscore descending and then _pdbId ascending
+        args = {'operation': 9,
+                'inputSet': outputDali,
+                'filterColumn': '_DaliZscore',
+                'direction': 1, #descending
+                'secondaryKeys': '_pdbId asc'
+                }
+
+        setf = self.newProtocol(LOperate, **args)
+        self.launchProtocol(setf)
+        setf = setf.output
+
+        self.assertIsNotNone(setf, "Error in creation of a new SetOfDatabaseID - It is NONE")
+        self.assertTrue(setf.getSize() == 432, "Error in creation of a new SetOfDatabaseID")
+
+        keys = [(-entry.getAttributeValue('_DaliZscore'), entry.getAttributeValue('_pdbId')) for entry in setf]
+        self.assertTrue(keys == sorted(keys), "Failed to sort the SetDatabaseID regarding _DaliZscore and _pdbId")
+
+
+    def test_8join(self):
+        """8. Join 2 SetOfDatabaseID using the column called _pdbId
+        """
+        print("\n Join 2 SetOfDatabaseID using 1 column (inner, left and anti)")
+
+        sizes = {}
+        for joinType in [0, 1, 2]:
+            args = {'operation': 10,
+                    'inputSet': outputDali,
+                    'secondSet': outputDali2,
+                    'filterColumn': '_pdbId',
+                    'joinType': joinType
+                    }
+
+            setf = self.newProtocol(LOperate, **args)
+            self.launchProtocol(setf)
+            setf = setf.output
+            self.assertIsNotNone(setf, "Error in creation of a new SetOfDatabaseID - It is NONE")
+            sizes[joinType] = setf.getSize()
+
+            attributes = [name for name, _ in setf.getFirstItem().getAttributes()]
+            if joinType == 2:
+                self.assertFalse('_DaliZscore_2' in attributes, "The anti join must not add columns")
+            else:
+                self.assertTrue('_DaliZscore_2' in attributes, "The columns of the second set were not added")
+
+        self.assertTrue(sizes[2] == 432-314, "The anti join must keep the entries that are not in the intersection")
+        self.assertTrue(sizes[0] >= 314, "The inner join must have at least one entry per entry of the intersection")
+        self.assertTrue(sizes[1] == sizes[0]+sizes[2], "The left join must add the entries without a match")
+
+    def test_9sortMissing(self):
+        """9. Sort values with missing entries in the same order as SQLite
+        """
+        print("\n Sort with missing values (Python and SQLite must agree)")
+
+        entries = [((None, "b"), 1), ((2.5, None), 2), ((1.0, "a"), 3), ((None, None), 4), ((2.5, "c"), 5),
+                   ((1.0, None), 6)]
+        with contextlib.closing(sqlite3.connect(":memory:")) as conn:
+            conn.execute("CREATE TABLE Objects (id INTEGER PRIMARY KEY, c01 REAL, c02 TEXT)")
+            conn.executemany("INSERT INTO Objects VALUES (?,?,?)", [(objId,)+values for values, objId in entries])
+            for descending in [(False, False), (True, False), (True, True)]:
+                orderBy = ", ".join(["%s %s" % (column, "DESC" if desc else "ASC")
+                                     for column, desc in zip(["c01", "c02"], descending)])
+                expected = [row[0] for row in conn.execute("SELECT id FROM Objects ORDER BY %s, id" % orderBy)]
+                sortedIds = list(externalSort(entries, descending, tempfile.mkdtemp(), chunkSize=4))
+                self.assertTrue(sortedIds == expected, "Missing values are not sorted as in SQLite (%s)" % orderBy)
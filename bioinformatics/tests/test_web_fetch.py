@@ -0,0 +1,152 @@
+# **************************************************************************
+# *
+# * Name:     TEST OF UTILS/WEBFETCH.PY
+# *
+# * Authors:    Carlos Oscar Sorzano (coss@cnb.csic.es)
+# *
+# * Unidad de  Bioinformatica of Centro Nacional de Biotecnologia , CSIC
+# *
+# * This program is free software; you can redistribute it and/or modify
+# * it under the terms of the GNU General Public License as published by
+# * the Free Software Foundation; either version 2 of the License, or
+# * (at your option) any later version.
+# *
+# * This program is distributed in the hope that it will be useful,
+# * but WITHOUT ANY WARRANTY; without even the implied warranty of
+# * MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# * GNU General Public License for more details.
+# *
+# * You should have received a copy of the GNU General Public License
+# * along with this program; if not, write to the Free Software
+# * Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA
+# * 02111-1307  USA
+# *
+# *  All comments concerning this program package may be sent to the
+# *  e-mail address 'scipion@cnb.csic.es'
+# *
+# **************************************************************************
+import http.server
+import os
+import tempfile
+import threading
+import urllib.parse
+from pyworkflow.tests import *
+from bioinformatics.utils.webFetch import WebFetcher
+from bioinformatics.utils.databaseQueries import splitUniprotFasta
+
+
+class LocalHandler(http.server.BaseHTTPRequestHandler):
+    """ Stand-in for a remote database. /flaky fails the first time it is requested,
+        /moved redirects to /entry1, /missing does not exist, /batch?ids=A,B answers a multi-entry
+        fasta that never contains the entry P00000 and /paged?ids=A,B answers it in pages of 3 entries
+        linked by a Link rel="next" header"""
+    protocol_version = "HTTP/1.1"
+    flakyRequests = 0
+    singleRequests = 0
+
+    def _answer(self, status, body=b"", headers={}):
+        self.send_response(status)
+        for key, value in headers.items():
+            self.send_header(key, value)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_GET(self):
+        if self.path == "/flaky":
+            LocalHandler.flakyRequests += 1
+            if LocalHandler.flakyRequests == 1:
+                self._answer(503)
+                return
+        if self.path.startswith("/single/"):
+            LocalHandler.singleRequests += 1
+        if self.path.startswith("/paged?ids="):
+            query = urllib.parse.parse_qs(urllib.parse.urlparse(self.path).query)
+            ids = query["ids"][0].split(",")
+            start = int(query.get("start", ["0"])[0])
+            headers = {}
+            if start+3 < len(ids):
+                headers["Link"] = '</paged?ids=%s&start=%d>; rel="next"' % (",".join(ids), start+3)
+            self._answer(200, "".join([">sp|%s|%s_HUMAN\nMKV\n" % (id, id) for id in ids[start:start+3]]).encode(),
+                         headers)
+        elif self.path.startswith("/batch?ids="):
+            ids = [id for id in self.path.split("=")[1].split(",") if id != "P00000"]
+            self._answer(200, "".join([">sp|%s|%s_HUMAN\nMKV\n" % (id, id) for id in ids]).encode())
+        elif self.path == "/moved":
+            self._answer(302, headers={"Location": "/entry1"})
+        elif self.path == "/missing":
+            self._answer(404)
+        else:
+            self._answer(200, ("content of %s" % self.path).encode())
+
+    def log_message(self, *args):
+        pass
+
+
+class TestWebFetch(BaseTest):
+
+    @classmethod
+    def setUpClass(cls):
+        cls.server = http.server.ThreadingHTTPServer(('127.0.0.1', 0), LocalHandler)
+        cls.baseUrl = "http://127.0.0.1:%d" % cls.server.server_address[1]
+        threading.Thread(target=cls.server.serve_forever, daemon=True).start()
+
+    @classmethod
+    def tearDownClass(cls):
+        cls.server.shutdown()
+
+    def test_fetchAll(self):
+        """ Download many entries concurrently, with retries, redirections and missing entries
+        """
+        fnDir = tempfile.mkdtemp()
+        jobs = [(self.baseUrl+"/entry%d" % i, os.path.join(fnDir, "entry%d.txt" % i)) for i in range(20)]
+        jobs.append((self.baseUrl+"/flaky", os.path.join(fnDir, "flaky.txt")))
+        jobs.append((self.baseUrl+"/moved", os.path.join(fnDir, "moved.txt")))
+        jobs.append((self.baseUrl+"/missing", os.path.join(fnDir, "missing.txt")))
+
+        downloaded = WebFetcher(maxPerHost=2, backoff=0.01).fetchAll(jobs)
+
+        self.assertTrue(len(downloaded) == 22, "Wrong number of downloaded entries")
+        self.assertFalse(os.path.exists(os.path.join(fnDir, "missing.txt")), "A missing entry was written")
+        with open(os.path.join(fnDir, "flaky.txt")) as fh:
+            self.assertTrue(fh.read() == "content of /flaky", "The failed request was not retried")
+        with open(os.path.join(fnDir, "moved.txt")) as fh:
+            self.assertTrue(fh.read() == "content of /entry1", "The redirection was not followed")
+        self.assertTrue(len([fn for fn in os.listdir(fnDir) if fn.startswith(".tmp_")]) == 0,
+                        "Temporary files were left behind")
+        fnTest = os.path.join(fnDir, "plain.txt")
+        open(fnTest, 'w').close()
+        self.assertTrue(os.stat(jobs[0][1]).st_mode == os.stat(fnTest).st_mode,
+                        "The downloaded files do not have the usual permissions")
+
+    def test_fetchBatches(self):
+        """ Download entries with batched queries, falling back to single queries for the missing ones
+        """
+        fnDir = tempfile.mkdtemp()
+        jobs = {"P%05d" % i: os.path.join(fnDir, "P%05d.fasta" % i) for i in range(25)}
+
+        downloaded = WebFetcher().fetchBatches(jobs, lambda ids: self.baseUrl+"/batch?ids="+",".join(ids),
+                                               splitUniprotFasta, chunkSize=10,
+                                               singleUrl=lambda id: self.baseUrl+"/single/"+id)
+
+        self.assertTrue(len(downloaded) == 25, "Wrong number of downloaded entries")
+        with open(jobs["P00007"]) as fh:
+            self.assertTrue(fh.read() == ">sp|P00007|P00007_HUMAN\nMKV\n", "Wrong split of the batched answer")
+        with open(jobs["P00000"]) as fh:
+            self.assertTrue(fh.read() == "content of /single/P00000", "The missing entry was not fetched alone")
+
+    def test_fetchBatchesPaged(self):
+        """ Download entries with batched queries whose answers are split in pages
+        """
+        fnDir = tempfile.mkdtemp()
+        jobs = {"Q%05d" % i: os.path.join(fnDir, "Q%05d.fasta" % i) for i in range(25)}
+        LocalHandler.singleRequests = 0
+
+        downloaded = WebFetcher().fetchBatches(jobs, lambda ids: self.baseUrl+"/paged?ids="+",".join(ids),
+                                               splitUniprotFasta, chunkSize=10,
+                                               singleUrl=lambda id: self.baseUrl+"/single/"+id)
+
+        self.assertTrue(len(downloaded) == 25, "Wrong number of downloaded entries")
+        self.assertTrue(LocalHandler.singleRequests == 0, "The next pages were not followed")
+        with open(jobs["Q00008"]) as fh:
+            self.assertTrue(fh.read() == ">sp|Q00008|Q00008_HUMAN\nMKV\n", "Wrong split of a later page")
@@ -0,0 +1,94 @@
+# **************************************************************************
+# *
+# * Authors:     Carlos Oscar Sorzano (coss@cnb.csic.es)
+# *
+# * Unidad de  Bioinformatica of Centro Nacional de Biotecnologia , CSIC
+# *
+# * This program is free software; you can redistribute it and/or modify
+# * it under the terms of the GNU General Public License as published by
+# * the Free Software Foundation; either version 2 of the License, or
+# * (at your option) any later version.
+# *
+# * This program is distributed in the hope that it will be useful,
+# * but WITHOUT ANY WARRANTY; without even the implied warranty of
+# * MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# * GNU General Public License for more details.
+# *
+# * You should have received a copy of the GNU General Public License
+# * along with this program; if not, write to the Free Software
+# * Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA
+# * 02111-1307  USA
+# *
+# *  All comments concerning this program package may be sent to the
+# *  e-mail address 'scipion@cnb.csic.es'
+# *
+# **************************************************************************
+
+import re
+
+CLUSTER_ROW = re.compile(r"^\s*(\d+)\s*\|\s*(-?\d+\.?\d*)\s*\|\s*(\d+)\s*\|\s*(-?\d+\.?\d*)\s*\|\s*(\d+)\s*\|")
+
+class DlgResults:
+    """ Results of an AutoDock docking log (.dlg)"""
+    def __init__(self):
+        self.bestEnergy = None    # Lowest estimated free energy of binding (kcal/mol)
+        self.bestPose = []        # Lines of the lowest energy pose in pdbqt format
+        self.bestRun = None
+        self.clusters = []        # (rank, lowest energy, run, mean energy, number of conformations)
+        self.heavyAtoms = 0
+
+    def ligandEfficiency(self, energy):
+        return energy/self.heavyAtoms if self.heavyAtoms>0 else 0.0
+
+    def writeBestPose(self, fnOut):
+        with open(fnOut, 'w') as fh:
+            fh.write("".join(self.bestPose))
+
+def countHeavyAtoms(poseLines):
+    n = 0
+    for line in poseLines:
+        if line.startswith("ATOM") or line.startswith("HETATM"):
+            tokens = line.split()
+            if not tokens[-1] in ["H", "HD", "HS"]:
+                n += 1
+    return n
+
+def parseDlg(fnDlg):
+    """ Read in a single pass the docked poses and the clustering histogram of a .dlg file.
+        Only the current and the best pose are kept in memory."""
+    results = DlgResults()
+    pose = []
+    energy = None
+    run = None
+    inHistogram = False
+    with open(fnDlg) as fh:
+        for line in fh:
+            if line.startswith("DOCKED: "):
+                line = line[8:]
+                if line.startswith("MODEL"):
+                    pose = []
+                    energy = None
+                    run = None
+                elif line.startswith("USER    Run ="):
+                    run = int(line.split("=")[1])
+                elif line.startswith("USER    Estimated Free Energy of Binding"):
+                    energy = float(line.split("=")[1].split()[0])
+                if line.startswith("ENDMDL"):
+                    if energy is not None and (results.bestEnergy is None or energy<results.bestEnergy):
+                        results.bestEnergy = energy
+                        results.bestRun = run
+                        results.bestPose = pose
+                elif not line.startswith("MODEL"):
+                    pose.append(line)
+            elif "CLUSTERING HISTOGRAM" in line:
+                inHistogram = True
+            elif inHistogram:
+                if "RMSD TABLE" in line:
+                    inHistogram = False
+                else:
+                    match = CLUSTER_ROW.match(line)
+                    if match:
+                        results.clusters.append((int(match.group(1)), float(match.group(2)), int(match.group(3)),
+                                                 float(match.group(4)), int(match.group(5))))
+    results.heavyAtoms = countHeavyAtoms(results.bestPose)
+    return results
@@ -0,0 +1,149 @@
+# **************************************************************************
+# *
+# * Authors:     Carlos Oscar Sorzano (coss@cnb.csic.es)
+# *
+# * Unidad de  Bioinformatica of Centro Nacional de Biotecnologia , CSIC
+# *
+# * This program is free software; you can redistribute it and/or modify
+# * it under the terms of the GNU General Public License as published by
+# * the Free Software Foundation; either version 2 of the License, or
+# * (at your option) any later version.
+# *
+# * This program is distributed in the hope that it will be useful,
+# * but WITHOUT ANY WARRANTY; without even the implied warranty of
+# * MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# * GNU General Public License for more details.
+# *
+# * You should have received a copy of the GNU General Public License
+# * along with this program; if not, write to the Free Software
+# * Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA
+# * 02111-1307  USA
+# *
+# *  All comments concerning this program package may be sent to the
+# *  e-mail address 'scipion@cnb.csic.es'
+# *
+# **************************************************************************
+
+"""
+Columnar snapshot of the items of a set. It is a directory next to the SQLite file of the set
+(setOfDatabaseIds.sqlite -> setOfDatabaseIds.columns/) with uncompressed NumPy .npy files, which are
+memory-mapped when they are read: the ids and one array per attribute. Numeric attributes are float
+arrays with NaN for the missing values. Any other attribute is stored as its UTF-8 encoded values
+concatenated in a byte array, with the offset of each value and a mask of missing values, so that every
+value takes only its own length.
+The files are in a subdirectory named after the size and modification time of the SQLite file, so the
+snapshot is ignored as soon as the set is modified afterwards. A subdirectory is written under a
+temporary name and renamed when it is complete.
+"""
+
+import contextlib
+import os
+import shutil
+import sqlite3
+import tempfile
+import numpy as np
+
+from bioinformatics.utils.setUtils import getSetColumns, NUMERIC_CLASSES
+
+SNAPSHOT_SUFFIX = '.columns'
+
+def getSnapshotDir(fnSqlite):
+    return os.path.splitext(fnSqlite)[0]+SNAPSHOT_SUFFIX
+
+def _getVersionDir(fnSqlite):
+    """ Subdirectory of the snapshot of the current contents of the set file"""
+    stat = os.stat(fnSqlite)
+    return os.path.join(getSnapshotDir(fnSqlite), "%d_%d" % (stat.st_size, stat.st_mtime_ns))
+
+def _readColumn(conn, column, numeric):
+    """ Arrays of a column: {'': values} if numeric, or else {'data': bytes, 'offsets': ..., 'missing': ...}"""
+    values = [row[0] for row in conn.execute("SELECT %s FROM Objects ORDER BY id" % column)]
+    if numeric:
+        return {'': np.array([np.nan if value is None else value for value in values], dtype=float)}
+    encoded = [b'' if value is None else str(value).encode('utf-8') for value in values]
+    offsets = np.zeros(len(encoded)+1, dtype=np.int64)
+    np.cumsum([len(value) for value in encoded], out=offsets[1:])
+    return {'data': np.frombuffer(b''.join(encoded), dtype=np.uint8),
+            'offsets': offsets,
+            'missing': np.array([value is None for value in values], dtype=bool)}
+
+def _decodeColumn(data, offsets, missing):
+    """ Object array with the strings of a column, None for the missing values"""
+    blob = data.tobytes()
+    values = np.empty(len(missing), dtype=object)
+    for i in range(len(missing)):
+        if not missing[i]:
+            values[i] = blob[offsets[i]:offsets[i+1]].decode('utf-8')
+    return values
+
+def writeColumnSnapshot(fnSqlite):
+    """ Write the snapshot of a set file. The columns are read one by one from SQLite"""
+    fnVersion = _getVersionDir(fnSqlite)
+    setColumns = getSetColumns(fnSqlite)
+    attributes = list(setColumns)
+    arrays = {'attributes': np.array(attributes, dtype=str),
+              'classes': np.array([setColumns[attribute][1] for attribute in attributes], dtype=str)}
+    with contextlib.closing(sqlite3.connect(fnSqlite)) as conn:
+        arrays['id'] = np.array([row[0] for row in conn.execute("SELECT id FROM Objects ORDER BY id")],
+                                dtype=np.int64)
+        for i, attribute in enumerate(attributes):
+            column, className = setColumns[attribute]
+            for part, values in _readColumn(conn, column, className in NUMERIC_CLASSES).items():
+                arrays['c%d' % i + ('.'+part if part else '')] = values
+
+    fnSnapshot = getSnapshotDir(fnSqlite)
+    os.makedirs(fnSnapshot, exist_ok=True)
+    fnTmp = tempfile.mkdtemp(dir=fnSnapshot, prefix=".tmp_")
+    try:
+        for name, values in arrays.items():
+            np.save(os.path.join(fnTmp, name+".npy"), values, allow_pickle=False)
+        os.rename(fnTmp, fnVersion)
+    except OSError:
+        shutil.rmtree(fnTmp, ignore_errors=True)
+        if not os.path.isdir(fnVersion): # Else another process has just written it
+            raise
+    for fn in os.listdir(fnSnapshot):
+        if os.path.join(fnSnapshot, fn) != fnVersion and not fn.startswith(".tmp_"):
+            shutil.rmtree(os.path.join(fnSnapshot, fn), ignore_errors=True)
+
+def isSnapshotCurrent(fnSqlite):
+    return os.path.exists(fnSqlite) and os.path.isdir(_getVersionDir(fnSqlite))
+
+def updateColumnSnapshot(fnSqlite):
+    """ Write the snapshot of a set file if it is missing or out of date. Sets whose file cannot be read
+        (e.g. still empty) are skipped"""
+    if fnSqlite is None or not os.path.exists(fnSqlite) or isSnapshotCurrent(fnSqlite):
+        return
+    try:
+        writeColumnSnapshot(fnSqlite)
+    except (sqlite3.Error, OSError) as e:
+        print("Cannot write the column snapshot of %s: %s" % (fnSqlite, e))
+
+def readColumnSnapshot(fnSqlite, attributes=None):
+    """ Read the ids and some attributes (all if None) from the snapshot of a set file. It returns
+        (ids, dictionary attribute -> array, dictionary attribute -> class name), or None if there is
+        no current snapshot or some attribute is not in it. Numeric columns are read-only memory maps,
+        the rest are object arrays with None for the missing values"""
+    if fnSqlite is None or not isSnapshotCurrent(fnSqlite):
+        return None
+    fnVersion = _getVersionDir(fnSqlite)
+    def load(name):
+        return np.load(os.path.join(fnVersion, name+".npy"), mmap_mode='r', allow_pickle=False)
+    try:
+        names = np.load(os.path.join(fnVersion, "attributes.npy")).tolist()
+        classNames = dict(zip(names, np.load(os.path.join(fnVersion, "classes.npy")).tolist()))
+        if attributes is None:
+            attributes = names
+        if any(not attribute in classNames for attribute in attributes):
+            return None
+        columns = {}
+        for attribute in attributes:
+            i = names.index(attribute)
+            if classNames[attribute] in NUMERIC_CLASSES:
+                columns[attribute] = load('c%d' % i)
+            else:
+                columns[attribute] = _decodeColumn(load('c%d.data' % i), load('c%d.offsets' % i),
+                                                   load('c%d.missing' % i))
+        return load('id'), columns, {attribute: classNames[attribute] for attribute in attributes}
+    except (OSError, ValueError):
+        return None
@@ -0,0 +1,111 @@
+# **************************************************************************
+# *
+# * Authors:     Carlos Oscar Sorzano (coss@cnb.csic.es)
+# *
+# * Unidad de  Bioinformatica of Centro Nacional de Biotecnologia , CSIC
+# *
+# * This program is free software; you can redistribute it and/or modify
+# * it under the terms of the GNU General Public License as published by
+# * the Free Software Foundation; either version 2 of the License, or
+# * (at your option) any later version.
+# *
+# * This program is distributed in the hope that it will be useful,
+# * but WITHOUT ANY WARRANTY; without even the implied warranty of
+# * MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# * GNU General Public License for more details.
+# *
+# * You should have received a copy of the GNU General Public License
+# * along with this program; if not, write to the Free Software
+# * Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA
+# * 02111-1307  USA
+# *
+# *  All comments concerning this program package may be sent to the
+# *  e-mail address 'scipion@cnb.csic.es'
+# *
+# **************************************************************************
+
+import copy
+import re
+import lxml.etree as ET
+
+from bioinformatics.utils.webFetch import WebFetcher
+
+UNIPROT_BATCH_URL = "https://rest.uniprot.org/uniprotkb/accessions?accessions=%s&format=%s&size=%d"
+UNIPROT_MAX_PAGE = 500 # Largest page size of the UniProt REST API
+UNIPROT_SINGLE_URL = "https://www.uniprot.org/uniprot/%s.%s"
+LIGANDINFO_URL = "https://www.rcsb.org/pdb/rest/ligandInfo?structureId=%s"
+
+def splitUniprotFasta(ids, body):
+    """ Split a multi-entry Uniprot fasta into its records. An entry is matched by the accession or
+        the entry name in its header (>sp|P69905|HBA_HUMAN ...)"""
+    wanted = {id.upper(): id for id in ids}
+    parts = {}
+    for record in re.split(b'(?m)^(?=>)', body):
+        if not record.startswith(b'>'):
+            continue
+        fields = record.split(b'\n', 1)[0][1:].split(b' ')[0].split(b'|')
+        for key in fields[1:3]:
+            id = wanted.get(key.decode().upper())
+            if id is not None and not id in parts:
+                parts[id] = record
+    return parts
+
+def splitUniprotXML(ids, body):
+    """ Split a multi-entry Uniprot XML into one document per entry. An entry is matched by any of
+        its accessions or its entry name"""
+    wanted = {id.upper(): id for id in ids}
+    parts = {}
+    root = ET.fromstring(body)
+    for entry in root:
+        if not isinstance(entry.tag, str) or ET.QName(entry).localname != "entry":
+            continue
+        keys = [child.text for child in entry
+                if isinstance(child.tag, str) and ET.QName(child).localname in ("accession", "name")]
+        for key in keys:
+            id = wanted.get((key or "").upper())
+            if id is not None and not id in parts:
+                document = ET.Element(root.tag, nsmap=root.nsmap)
+                document.append(copy.deepcopy(entry))
+                parts[id] = ET.tostring(document, xml_declaration=True, encoding="UTF-8")
+    return parts
+
+def splitLigandInfo(ids, body):
+    """ Split the RCSB ligandInfo answer for several structures into one document per structure.
+        Structures without ligands get an empty ligandInfo"""
+    if len(ids) == 1:
+        return {ids[0]: body}
+    root = ET.fromstring(body)
+    ligands = {id.upper(): [] for id in ids}
+    for ligand in root.iter("ligand"):
+        if not "structureId" in ligand.attrib:
+            return {} # The ligands cannot be assigned to their structures
+        key = ligand.attrib["structureId"].upper()
+        if key in ligands:
+            ligands[key].append(ligand)
+    parts = {}
+    for id in ids:
+        document = ET.Element("structureId", id=id)
+        ligandInfo = ET.SubElement(document, "ligandInfo")
+        for ligand in ligands[id.upper()]:
+            ligandInfo.append(copy.deepcopy(ligand))
+        parts[id] = ET.tostring(document, xml_declaration=True, encoding="UTF-8")
+    return parts
+
+def fetchUniprotEntries(jobs, format, chunkSize=100, fetcher=None):
+    """ Download Uniprot entries (jobs is a dictionary uniprotId -> fnOut) in the given format
+        (fasta or xml) with one query per chunk of ids. It returns the list of written files"""
+    splitResponse = splitUniprotFasta if format == "fasta" else splitUniprotXML
+    fetcher = fetcher or WebFetcher()
+    return fetcher.fetchBatches(jobs,
+                                lambda ids: UNIPROT_BATCH_URL % (",".join(ids), format, len(ids)),
+                                splitResponse, min(chunkSize, UNIPROT_MAX_PAGE),
+                                lambda id: UNIPROT_SINGLE_URL % (id, format))
+
+def fetchLigandInfo(jobs, chunkSize=100, fetcher=None):
+    """ Download the RCSB ligand descriptions of several structures (jobs is a dictionary
+        pdbId -> fnOut) with one query per chunk of structures. It returns the list of written files"""
+    fetcher = fetcher or WebFetcher()
+    return fetcher.fetchBatches(jobs,
+                                lambda ids: LIGANDINFO_URL % ",".join(ids),
+                                splitLigandInfo, chunkSize,
+                                lambda id: LIGANDINFO_URL % id)
@@ -0,0 +1,151 @@
+# **************************************************************************
+# *
+# * Authors:     Carlos Oscar Sorzano (coss@cnb.csic.es)
+# *
+# * Unidad de  Bioinformatica of Centro Nacional de Biotecnologia , CSIC
+# *
+# * This program is free software; you can redistribute it and/or modify
+# * it under the terms of the GNU General Public License as published by
+# * the Free Software Foundation; either version 2 of the License, or
+# * (at your option) any later version.
+# *
+# * This program is distributed in the hope that it will be useful,
+# * but WITHOUT ANY WARRANTY; without even the implied warranty of
+# * MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# * GNU General Public License for more details.
+# *
+# * You should have received a copy of the GNU General Public License
+# * along with this program; if not, write to the Free Software
+# * Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA
+# * 02111-1307  USA
+# *
+# *  All comments concerning this program package may be sent to the
+# *  e-mail address 'scipion@cnb.csic.es'
+# *
+# **************************************************************************
+
+import os
+import time
+
+def iterSDFRecords(fnIn):
+    """ Iterate over the molecules of a multiple SDF file. It yields (name, record).
+        The name is the zinc_id field if present, or the title line otherwise.
+        Only one record is kept in memory at a time."""
+    with open(fnIn) as fh:
+        record = []
+        zincId = None
+        previousIsZincTag = False
+        for line in fh:
+            record.append(line)
+            if previousIsZincTag:
+                zincId = line.strip()
+            previousIsZincTag = line.startswith(">") and "<zinc_id>" in line
+            if line.startswith("$$$$"):
+                name = zincId if zincId else record[0].strip()
+                yield name, "".join(record)
+                record = []
+                zincId = None
+        if "".join(record).strip():
+            yield (zincId if zincId else record[0].strip()), "".join(record)+"$$$$\n"
+
+def iterMol2Records(fnIn):
+    """ Iterate over the molecules of a multiple Mol2 file. It yields (name, record).
+        The name is the line after @<TRIPOS>MOLECULE. Comment lines are skipped."""
+    with open(fnIn) as fh:
+        record = []
+        name = None
+        for line in fh:
+            if line.startswith("#"):
+                continue
+            if line.startswith("@<TRIPOS>MOLECULE"):
+                if record:
+                    yield name, "".join(record)
+                record = [line]
+                name = None
+            elif record:
+                if name is None:
+                    name = line.strip()
+                record.append(line)
+        if record:
+            yield name, "".join(record)
+
+def iterSmilesCSVRecords(fnIn):
+    """ Iterate over the molecules of a CSV file with lines: ID, smiles. It yields (ID, record)"""
+    with open(fnIn) as fh:
+        for line in fh:
+            tokens = line.split(',')
+            if len(tokens)==2 and tokens[1].strip().lower()!="smiles":
+                yield tokens[0].strip(), tokens[1].strip()+"\n"
+
+def iterMoleculeRecords(fnIn):
+    """ Choose the record iterator by the extension of the file. It returns the extension of the
+        records and the iterator"""
+    if fnIn.endswith(".mol2"):
+        return ".mol2", iterMol2Records(fnIn)
+    elif fnIn.endswith(".sdf"):
+        return ".sdf", iterSDFRecords(fnIn)
+    else:
+        return ".smi", iterSmilesCSVRecords(fnIn)
+
+def iterUniqueRecords(records):
+    """ Give a valid and unique file name to each (name, record). Repeated names get a -2, -3, ... suffix"""
+    names = {}
+    n = 0
+    for name, record in records:
+        n += 1
+        name = name.split()[0].replace(os.sep, "_") if name and name.split() else "molecule%06d" % n
+        if name in names:
+            names[name] += 1
+            name = "%s-%d" % (name, names[name])
+        else:
+            names[name] = 1
+        yield name, record
+
+def reportThroughput(n, fnIn, t0):
+    elapsed = time.time()-t0
+    print("Split %d molecules from %s in %.1f s (%.1f records/s)" %
+          (n, fnIn, elapsed, n/elapsed if elapsed>0 else 0.0))
+
+def splitMoleculeFile(fnIn, fnDir):
+    """ Write each molecule of a multiple molecule file (SDF, Mol2 or CSV smiles) in its own file in fnDir.
+        The input is read in place and records are written as they are read. It returns the list of written files."""
+    ext, records = iterMoleculeRecords(fnIn)
+    fnList = []
+    t0 = time.time()
+    for name, record in iterUniqueRecords(records):
+        fnSmall = os.path.join(fnDir, name+ext)
+        with open(fnSmall, 'w') as fh:
+            fh.write(record)
+        fnList.append(fnSmall)
+    reportThroughput(len(fnList), fnIn, t0)
+    return fnList
+
+def writeMoleculeLibrary(fnIn, fnRoot):
+    """ Store all the molecules of a multiple molecule file (SDF, Mol2 or CSV smiles) in a single library file,
+        fnRoot plus the extension of the records. The records are concatenated so that the library is itself
+        a valid multiple molecule file. It returns the library filename and a list of (name, offset, size),
+        offset and size in bytes."""
+    ext, records = iterMoleculeRecords(fnIn)
+    fnLibrary = fnRoot+ext
+    index = []
+    offset = 0
+    t0 = time.time()
+    with open(fnLibrary, 'wb') as fh:
+        for name, record in iterUniqueRecords(records):
+            data = record.encode()
+            fh.write(data)
+            index.append((name, offset, len(data)))
+            offset += len(data)
+    reportThroughput(len(index), fnIn, t0)
+    return fnLibrary, index
+
+def readMoleculeRecord(fnLibrary, offset, size):
+    """ Read a single molecule from a library file"""
+    with open(fnLibrary, 'rb') as fh:
+        fh.seek(offset)
+        return fh.read(size).decode()
+
+def writeMoleculeRecord(fnLibrary, offset, size, fnOut):
+    """ Write a single molecule of a library file to its own file"""
+    with open(fnOut, 'w') as fh:
+        fh.write(readMoleculeRecord(fnLibrary, offset, size))
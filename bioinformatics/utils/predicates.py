@@ -0,0 +1,264 @@
+# **************************************************************************
+# *
+# * Authors:     Carlos Oscar Sorzano (coss@cnb.csic.es)
+# *
+# * Unidad de  Bioinformatica of Centro Nacional de Biotecnologia , CSIC
+# *
+# * This program is free software; you can redistribute it and/or modify
+# * it under the terms of the GNU General Public License as published by
+# * the Free Software Foundation; either version 2 of the License, or
+# * (at your option) any later version.
+# *
+# * This program is distributed in the hope that it will be useful,
+# * but WITHOUT ANY WARRANTY; without even the implied warranty of
+# * MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# * GNU General Public License for more details.
+# *
+# * You should have received a copy of the GNU General Public License
+# * along with this program; if not, write to the Free Software
+# * Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA
+# * 02111-1307  USA
+# *
+# *  All comments concerning this program package may be sent to the
+# *  e-mail address 'scipion@cnb.csic.es'
+# *
+# **************************************************************************
+
+"""
+Vectorized filters over the columns of a set. An expression combines comparisons with and, or, not and
+parentheses, e.g.
+    _DaliZscore > 10 and _DaliSeqIdentity between 30,90 and not _DaliDescription contains ESTERASE
+The comparisons are ==, !=, >, >=, <, <=, between (inclusive), startswith, endswith and contains.
+String values can be quoted. Every comparison is evaluated on whole NumPy columns and the result is a
+boolean mask with one element per row. Missing values (None or NaN) never satisfy a comparison,
+although they satisfy its negation. Boolean attributes are numeric columns of 1 and 0, and they can be
+compared with 1, 0, True or False.
+"""
+
+import contextlib
+import re
+import sqlite3
+import numpy as np
+
+from bioinformatics.utils.columnSnapshot import readColumnSnapshot
+from bioinformatics.utils.setUtils import getSetColumns, NUMERIC_CLASSES
+
+OPERATORS = ('==', '!=', '>=', '<=', '>', '<', 'between', 'startswith', 'endswith', 'contains')
+TOKENS = re.compile(r"\s*(?:(==|!=|>=|<=|>|<|\(|\)|,)|\"([^\"]*)\"|'([^']*)'|([^\s()<>=!,\"']+))")
+
+# Texts of the filterOp choices of the list operate protocols
+FILTER_OPS = {'==': ('==', False), '>': ('>', False), '>=': ('>=', False), '<': ('<', False),
+              '<=': ('<=', False), '!=': ('!=', False), 'between': ('between', False),
+              'startswith': ('startswith', False), 'endswith': ('endswith', False),
+              'contains': ('contains', False), 'does not startwith': ('startswith', True),
+              'does not end with': ('endswith', True), 'does not contain': ('contains', True)}
+
+def _tokenize(expression):
+    tokens = []
+    position = 0
+    expression = expression.strip()
+    while position < len(expression):
+        match = TOKENS.match(expression, position)
+        if match is None or match.end() == position:
+            raise ValueError("Cannot parse the filter expression at: %s" % expression[position:])
+        symbol, quoted1, quoted2, word = match.groups()
+        if symbol is not None:
+            tokens.append(('symbol', symbol))
+        elif word is not None:
+            tokens.append(('word', word))
+        else:
+            tokens.append(('string', quoted1 if quoted1 is not None else quoted2))
+        position = match.end()
+    return tokens
+
+class _Parser:
+    """ Recursive descent parser: expression := term (or term)*, term := factor (and factor)*,
+        factor := not factor | ( expression ) | column operator value[,value]"""
+    def __init__(self, expression):
+        self.tokens = _tokenize(expression)
+        self.position = 0
+
+    def peek(self):
+        return self.tokens[self.position] if self.position < len(self.tokens) else (None, None)
+
+    def next(self):
+        token = self.peek()
+        if token[0] is None:
+            raise ValueError("Unexpected end of the filter expression")
+        self.position += 1
+        return token
+
+    def isWord(self, word):
+        kind, text = self.peek()
+        return kind == 'word' and text.lower() == word
+
+    def parse(self):
+        node = self.expression()
+        if self.position < len(self.tokens):
+            raise ValueError("Unexpected %s in the filter expression" % self.peek()[1])
+        return node
+
+    def expression(self):
+        node = self.term()
+        while self.isWord('or'):
+            self.next()
+            node = ('or', node, self.term())
+        return node
+
+    def term(self):
+        node = self.factor()
+        while self.isWord('and'):
+            self.next()
+            node = ('and', node, self.factor())
+        return node
+
+    def factor(self):
+        if self.isWord('not'):
+            self.next()
+            return ('not', self.factor())
+        if self.peek() == ('symbol', '('):
+            self.next()
+            node = self.expression()
+            if self.next() != ('symbol', ')'):
+                raise ValueError("Missing ) in the filter expression")
+            return node
+        kind, column = self.next()
+        if kind != 'word':
+            raise ValueError("Expected a column name instead of %s" % column)
+        kind, operator = self.next()
+        operator = operator.lower()
+        if not operator in OPERATORS:
+            raise ValueError("Unknown comparison %s" % operator)
+        values = [self.next()[1]]
+        if operator == 'between':
+            if self.next() != ('symbol', ','):
+                raise ValueError("between needs two values separated by a comma")
+            values.append(self.next()[1])
+        return ('compare', column, operator, values)
+
+def parsePredicate(expression):
+    """ Parse a filter expression into a tree of tuples"""
+    return _Parser(expression).parse()
+
+def singlePredicate(column, filterOp, value, value2=None):
+    """ Predicate of a single filter of the list operate protocols, filterOp is the text of the choice.
+        In between, value is the upper limit and value2 the lower one"""
+    operator, negate = FILTER_OPS[filterOp]
+    values = [value2, value] if operator == 'between' else [value]
+    node = ('compare', column, operator, [str(v) for v in values])
+    return ('not', node) if negate else node
+
+def predicateColumns(node):
+    """ Set of the columns used by a predicate"""
+    if node[0] == 'compare':
+        return {node[1]}
+    return set().union(*[predicateColumns(child) for child in node[1:]])
+
+def toColumn(values, numeric=None):
+    """ NumPy array of a column given as a list. Numeric columns, Boolean included, are float arrays with
+        NaN for missing values, any other column is an object array with None for missing values"""
+    if numeric is None:
+        numeric = all(isinstance(value, (int, float)) for value in values if value is not None)
+    if numeric:
+        return np.array([np.nan if value is None else value for value in values], dtype=float)
+    return np.array(values, dtype=object)
+
+def _toNumber(value):
+    """ Boolean columns are stored as 1 and 0, so True and False are compared as those numbers"""
+    if value.lower() in ('true', 'false'):
+        return 1.0 if value.lower() == 'true' else 0.0
+    return float(value)
+
+def _compare(column, operator, values):
+    if column.dtype.kind == 'f' and not operator in ('startswith', 'endswith', 'contains'):
+        references = [_toNumber(value) for value in values]
+        valid = ~np.isnan(column)
+        data = column
+    else:
+        references = values
+        if column.dtype.kind == 'f':
+            valid = ~np.isnan(column)
+            data = np.where(valid, column, 0).astype(str)
+        else:
+            valid = np.not_equal(column, None)
+            data = np.where(valid, column, '').astype(str)
+
+    if operator == '==':
+        mask = data == references[0]
+    elif operator == '!=':
+        mask = data != references[0]
+    elif operator == '>':
+        mask = data > references[0]
+    elif operator == '>=':
+        mask = data >= references[0]
+    elif operator == '<':
+        mask = data < references[0]
+    elif operator == '<=':
+        mask = data <= references[0]
+    elif operator == 'between':
+        lower, upper = min(references), max(references)
+        mask = (data >= lower) & (data <= upper)
+    elif operator == 'startswith':
+        mask = np.char.startswith(data, references[0])
+    elif operator == 'endswith':
+        mask = np.char.endswith(data, references[0])
+    else:
+        mask = np.char.find(data, references[0]) >= 0
+    return np.asarray(mask, dtype=bool) & valid
+
+def evaluatePredicate(node, columns):
+    """ Boolean mask of a predicate. columns is a dictionary name -> NumPy array"""
+    kind = node[0]
+    if kind == 'and':
+        return evaluatePredicate(node[1], columns) & evaluatePredicate(node[2], columns)
+    elif kind == 'or':
+        return evaluatePredicate(node[1], columns) | evaluatePredicate(node[2], columns)
+    elif kind == 'not':
+        return ~evaluatePredicate(node[1], columns)
+    _, column, operator, values = node
+    if not column in columns:
+        raise ValueError("Unknown column %s in the filter" % column)
+    return _compare(columns[column], operator, values)
+
+def readSetColumns(fnSqlite, attributes):
+    """ Read the ids and some attributes of the items of a set file as NumPy arrays. It returns
+        (ids, dictionary attribute -> array). The columnar snapshot of the set is used if it is current"""
+    snapshot = readColumnSnapshot(fnSqlite, attributes)
+    if snapshot is not None:
+        return snapshot[0], snapshot[1]
+    setColumns = getSetColumns(fnSqlite)
+    names = [setColumns[attribute][0] for attribute in attributes]
+    with contextlib.closing(sqlite3.connect(fnSqlite)) as conn:
+        rows = conn.execute("SELECT id%s FROM Objects ORDER BY id" %
+                            "".join([", "+name for name in names])).fetchall()
+    ids = np.array([row[0] for row in rows], dtype=np.int64)
+    columns = {}
+    for i, attribute in enumerate(attributes):
+        columns[attribute] = toColumn([row[i+1] for row in rows],
+                                      numeric=setColumns[attribute][1] in NUMERIC_CLASSES)
+    return ids, columns
+
+def readItemColumns(items, attributes):
+    """ Same as readSetColumns for any iterable of items, using getAttributeValue. The type of a column
+        is taken from the class of the attribute, as in the set file"""
+    ids = []
+    values = {attribute: [] for attribute in attributes}
+    classNames = {}
+    for item in items:
+        ids.append(item.getObjId())
+        for attribute in attributes:
+            values[attribute].append(item.getAttributeValue(attribute))
+            attributeObject = getattr(item, attribute, None)
+            if not attribute in classNames and hasattr(attributeObject, 'getClassName'):
+                classNames[attribute] = attributeObject.getClassName()
+    return (np.array(ids, dtype=np.int64),
+            {attribute: toColumn(columnValues, numeric=classNames[attribute] in NUMERIC_CLASSES
+                                 if attribute in classNames else None)
+             for attribute, columnValues in values.items()})
+
+def readColumns(inputSet, attributes):
+    """ Columns of a set, from its columnar snapshot if it is current or else item by item"""
+    snapshot = readColumnSnapshot(inputSet.getFileName(), attributes)
+    if snapshot is not None:
+        return snapshot[0], snapshot[1]
+    return readItemColumns(inputSet, attributes)
@@ -24,33 +24,117 @@
 # *
 # **************************************************************************
 
+from multiprocessing import Pool
 import sys
 from rdkit import Chem
 from rdkit.Chem import Draw
 
+def drawMolecule(fnIn, fnOut):
+    if fnIn.endswith('.smi'):
+        smile=open(fnIn).readlines()[0]
+        smile=smile.split()[0]
+        Draw.MolToFile(Chem.MolFromSmiles(smile),fnOut)
+    elif fnIn.endswith('.sdf'):
+        supplier = Chem.rdmolfiles.SDMolSupplier(fnIn)
+        for molecule in supplier:
+            Draw.MolToFile(molecule, fnOut)
+    elif fnIn.endswith('.mae') or fnIn.endswith('.maegz'):
+        supplier = Chem.rdmolfiles.MaeMolSupplier(fnIn)
+        for molecule in supplier:
+            Draw.MolToFile(molecule, fnOut)
+    elif fnIn.endswith('.mol2'):
+        molecule = Chem.rdmolfiles.MolFromMol2File(fnIn)
+        Draw.MolToFile(molecule, fnOut)
+    elif fnIn.endswith('.pdb'):
+        molecule = Chem.rdmolfiles.MolFromPDBFile(fnIn)
+        Draw.MolToFile(molecule, fnOut)
+
+def drawLibraryRecord(fnLibrary, offset, size, fnOut):
+    with open(fnLibrary, 'rb') as fh:
+        fh.seek(offset)
+        record = fh.read(size).decode()
+    if fnLibrary.endswith('.smi'):
+        molecule = Chem.MolFromSmiles(record.split()[0])
+    elif fnLibrary.endswith('.sdf'):
+        molecule = Chem.MolFromMolBlock(record)
+    elif fnLibrary.endswith('.mol2'):
+        molecule = Chem.MolFromMol2Block(record)
+    Draw.MolToFile(molecule, fnOut)
+
+def drawJob(job):
+    fnIn = job[0]
+    try:
+        if len(job)==4:
+            drawLibraryRecord(fnIn, int(job[2]), int(job[3]), job[1])
+        else:
+            drawMolecule(fnIn, job[1])
+        return fnIn, None
+    except Exception as e:
+        return fnIn, str(e).replace('\n',' ')
+
+def drawBatch(fnManifest, jobs=1):
+    """ Draw all the molecules of a manifest. Each line of the manifest is <smallMoleculeFile> TAB <pngFile>,
+        or <libraryFile> TAB <pngFile> TAB <offset> TAB <size> for molecules stored in a library file.
+        Failed molecules are reported in stdout as: ERROR <smallMoleculeFile> <message>
+    """
+    drawJobs = []
+    with open(fnManifest) as fh:
+        for line in fh:
+            tokens = line.rstrip('\n').split('\t')
+            if len(tokens)==2 or len(tokens)==4:
+                drawJobs.append(tokens)
+
+    if jobs>1:
+        pool = Pool(jobs)
+        results = pool.imap_unordered(drawJob, drawJobs, chunksize=max(1, min(100, len(drawJobs)//(4*jobs))))
+    else:
+        pool = None
+        results = map(drawJob, drawJobs)
+    errors = 0
+    for fnIn, error in results:
+        if error is not None:
+            errors += 1
+            print("ERROR\t%s\t%s"%(fnIn, error))
+    if pool is not None:
+        pool.close()
+        pool.join()
+    print("Drawn %d molecules, %d errors"%(len(drawJobs)-errors, errors))
+
+def serve():
+    """ Process jobs read from stdin until 'quit' or end of input.
+        Each job is a tab separated line: draw <smallMoleculeFile> <pngFile>.
+        For each job a single line is written to stdout: OK or ERROR <message>.
+        Anything else printed while a job runs goes to stderr so that it cannot be taken as an answer.
+    """
+    answers = sys.stdout
+    sys.stdout = sys.stderr
+    for line in sys.stdin:
+        tokens = line.rstrip('\n').split('\t')
+        if tokens[0]=="quit":
+            break
+        try:
+            if tokens[0]=="draw":
+                drawMolecule(tokens[1], tokens[2])
+                answer = "OK"
+            else:
+                answer = "ERROR\tUnknown command %s"%tokens[0]
+        except Exception as e:
+            answer = "ERROR\t%s"%str(e).replace('\n',' ')
+        answers.write(answer+"\n")
+        answers.flush()
+
 if __name__ == "__main__":
     if len(sys.argv)==1:
         print("Usage: python3 rdkitUtils.py [options]")
         print("   draw <smallMoleculeFile> <pngFile>: Small molecules .smi, .sdf, .mae, .mol2. .pdb")
+        print("   draw-batch <manifest> [--jobs N]: Draw all the molecules in a manifest (one <smallMoleculeFile> TAB <pngFile> per line)")
+        print("   server: Read draw jobs from stdin (one per line, tab separated) until quit")
     elif sys.argv[1]=="draw":
-        fnIn = sys.argv[2]
-        fnOut = sys.argv[3]
-        if fnIn.endswith('.smi'):
-            smile=open(fnIn).readlines()[0]
-            smile=smile.split()[0]
-            Draw.MolToFile(Chem.MolFromSmiles(smile),fnOut)
-        elif fnIn.endswith('.sdf'):
-            supplier = Chem.rdmolfiles.SDMolSupplier(fnIn)
-            for molecule in supplier:
-                Draw.MolToFile(molecule, fnOut)
-        elif fnIn.endswith('.mae') or fnIn.endswith('.maegz'):
-            supplier = Chem.rdmolfiles.MaeMolSupplier(fnIn)
-            for molecule in supplier:
-                Draw.MolToFile(molecule, fnOut)
-        elif fnIn.endswith('.mol2'):
-            supplier = Chem.rdmolfiles.MolFromMol2Block(fnIn)
-            for molecule in supplier:
-                Draw.MolToFile(molecule, fnOut)
-        elif fnIn.endswith('.pdb'):
-            molecule = Chem.rdmolfiles.MolFromPDBFile(fnIn)
-            Draw.MolToFile(molecule, fnOut)
+        drawMolecule(sys.argv[2], sys.argv[3])
+    elif sys.argv[1]=="draw-batch":
+        jobs = 1
+        if "--jobs" in sys.argv:
+            jobs = int(sys.argv[sys.argv.index("--jobs")+1])
+        drawBatch(sys.argv[2], jobs)
+    elif sys.argv[1]=="server":
+        serve()
@@ -0,0 +1,220 @@
+# **************************************************************************
+# *
+# * Authors:     Carlos Oscar Sorzano (coss@cnb.csic.es)
+# *
+# * Unidad de  Bioinformatica of Centro Nacional de Biotecnologia , CSIC
+# *
+# * This program is free software; you can redistribute it and/or modify
+# * it under the terms of the GNU General Public License as published by
+# * the Free Software Foundation; either version 2 of the License, or
+# * (at your option) any later version.
+# *
+# * This program is distributed in the hope that it will be useful,
+# * but WITHOUT ANY WARRANTY; without even the implied warranty of
+# * MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# * GNU General Public License for more details.
+# *
+# * You should have received a copy of the GNU General Public License
+# * along with this program; if not, write to the Free Software
+# * Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA
+# * 02111-1307  USA
+# *
+# *  All comments concerning this program package may be sent to the
+# *  e-mail address 'scipion@cnb.csic.es'
+# *
+# **************************************************************************
+
+import contextlib
+import hashlib
+import os
+import sqlite3
+import sys
+import time
+
+from bioinformatics import Plugin
+from bioinformatics.utils.webFetch import writeAtomically
+
+class RecordCache:
+    """ On-disk cache of remote database records shared by all projects.
+        Records are keyed by (database, record type, id) in an SQLite index and their contents are
+        stored once per sha1 digest in objects/. A record older than ttl seconds is not returned,
+        and the least recently used records are evicted when the contents exceed maxSize bytes.
+        Contents are written atomically before they are indexed, and the index is updated in
+        SQLite transactions, so that several processes can use the same cache.
+        The size of the contents is measured when the cache is first written and then kept as a running
+        total, eviction scans the index only when the total exceeds maxSize or every evictEvery records.
+    """
+    evictEvery = 1000
+
+    def __init__(self, fnDir, ttl=30*86400, maxSize=2*1024**3):
+        self.fnDir = fnDir
+        self.ttl = ttl
+        self.maxSize = maxSize
+        self._totalSize = None
+        self._putsSinceEviction = 0
+        os.makedirs(os.path.join(fnDir, "objects"), exist_ok=True)
+        with contextlib.closing(self._connect()) as conn, conn:
+            conn.execute("CREATE TABLE IF NOT EXISTS records (database TEXT, type TEXT, id TEXT, "
+                         "digest TEXT, size INTEGER, created REAL, accessed REAL, "
+                         "PRIMARY KEY (database, type, id))")
+            conn.execute("CREATE INDEX IF NOT EXISTS recordsAccessed ON records (accessed)")
+            conn.execute("CREATE INDEX IF NOT EXISTS recordsDigest ON records (digest)")
+
+    def _connect(self):
+        return sqlite3.connect(os.path.join(self.fnDir, "index.sqlite"), timeout=60)
+
+    def _objectPath(self, digest):
+        return os.path.join(self.fnDir, "objects", digest[:2], digest)
+
+    def getMany(self, database, recordType, ids):
+        """ Return a dictionary id -> bytes with the fresh records of ids that are in the cache"""
+        now = time.time()
+        records = {}
+        with contextlib.closing(self._connect()) as conn, conn:
+            for id in ids:
+                row = conn.execute("SELECT digest, created FROM records WHERE database=? AND type=? AND id=?",
+                                   (database, recordType, id)).fetchone()
+                if row is None or now-row[1] > self.ttl:
+                    continue
+                try:
+                    with open(self._objectPath(row[0]), 'rb') as fh:
+                        records[id] = fh.read()
+                except OSError: # Evicted by another process
+                    conn.execute("DELETE FROM records WHERE database=? AND type=? AND id=?",
+                                 (database, recordType, id))
+                    continue
+                conn.execute("UPDATE records SET accessed=? WHERE database=? AND type=? AND id=?",
+                             (now, database, recordType, id))
+        return records
+
+    def get(self, database, recordType, id):
+        """ Return the record as bytes, or None if it is not in the cache or it is too old"""
+        return self.getMany(database, recordType, [id]).get(id)
+
+    def putMany(self, database, recordType, records):
+        """ Store a dictionary id -> bytes"""
+        if len(records)==0:
+            return
+        now = time.time()
+        rows = []
+        newSize = 0
+        for id, data in records.items():
+            digest = hashlib.sha1(data).hexdigest()
+            fnObject = self._objectPath(digest)
+            if not os.path.exists(fnObject):
+                os.makedirs(os.path.dirname(fnObject), exist_ok=True)
+                writeAtomically(fnObject, data)
+                newSize += len(data)
+            rows.append((database, recordType, id, digest, len(data), now, now))
+        with contextlib.closing(self._connect()) as conn, conn:
+            conn.executemany("INSERT OR REPLACE INTO records VALUES (?,?,?,?,?,?,?)", rows)
+            self._putsSinceEviction += len(rows)
+            if self._totalSize is not None:
+                self._totalSize += newSize
+            if self._totalSize is None or self._totalSize > self.maxSize or \
+               self._putsSinceEviction >= self.evictEvery:
+                self._totalSize = self._evict(conn)
+                self._putsSinceEviction = 0
+
+    def put(self, database, recordType, id, data):
+        self.putMany(database, recordType, {id: data})
+
+    def _evict(self, conn):
+        """ Remove the stale records and then the least recently used ones until the cache fits in 90% of
+            maxSize, so that the next records do not trigger another eviction. It returns the size left"""
+        oldest = time.time()-self.ttl
+        removed = conn.execute("SELECT database, type, id, digest FROM records WHERE created<?", (oldest,)).fetchall()
+        conn.execute("DELETE FROM records WHERE created<?", (oldest,))
+        totalSize = conn.execute("SELECT SUM(size) FROM (SELECT DISTINCT digest, size FROM records)").fetchone()[0] or 0
+        if totalSize > self.maxSize:
+            for database, recordType, id, digest, size in conn.execute(
+                    "SELECT database, type, id, digest, size FROM records ORDER BY accessed").fetchall():
+                conn.execute("DELETE FROM records WHERE database=? AND type=? AND id=?", (database, recordType, id))
+                removed.append((database, recordType, id, digest))
+                totalSize -= size
+                if totalSize <= 0.9*self.maxSize:
+                    break
+        for digest in set(row[3] for row in removed):
+            if conn.execute("SELECT 1 FROM records WHERE digest=? LIMIT 1", (digest,)).fetchone() is None:
+                try:
+                    os.remove(self._objectPath(digest))
+                except OSError:
+                    pass
+        return totalSize
+
+class BufferedRecords:
+    """ Store the records of a cache in batches. put keeps the records in memory and they are written with
+        one putMany per database and record type every batchSize records, and when the context is left.
+        get also returns the records that are not written yet.
+
+        Typical use:
+            with BufferedRecords(getRecordCache()) as cache:
+                data = cache.get(database, recordType, id)
+                if data is None:
+                    cache.put(database, recordType, id, download(id))
+    """
+    def __init__(self, cache, batchSize=100):
+        self.cache = cache
+        self.batchSize = batchSize
+        self._pending = {}
+        self._size = 0
+
+    def get(self, database, recordType, id):
+        data = self._pending.get((database, recordType), {}).get(id)
+        if data is None:
+            data = self.cache.get(database, recordType, id)
+        return data
+
+    def put(self, database, recordType, id, data):
+        self._pending.setdefault((database, recordType), {})[id] = data
+        self._size += 1
+        if self._size >= self.batchSize:
+            self.flush()
+
+    def flush(self):
+        for (database, recordType), records in self._pending.items():
+            self.cache.putMany(database, recordType, records)
+        self._pending = {}
+        self._size = 0
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.flush()
+
+_recordCaches = {}
+
+def getRecordCache():
+    """ Cache configured in the plugin variables. The same object is returned while the configuration
+        does not change, so that it keeps its running size"""
+    key = (Plugin.getVar("BIOINFORMATICS_CACHE_DIR"),
+           float(Plugin.getVar("BIOINFORMATICS_CACHE_DAYS"))*86400,
+           float(Plugin.getVar("BIOINFORMATICS_CACHE_MB"))*1024**2)
+    if not key in _recordCaches:
+        _recordCaches[key] = RecordCache(key[0], ttl=key[1], maxSize=key[2])
+    return _recordCaches[key]
+
+def fetchCached(database, recordType, jobs, fetchMissing, cache=None):
+    """ Write the records of jobs (a dictionary id -> fnOut) that are in the cache, and call
+        fetchMissing(missingJobs) to download the rest. The files written by fetchMissing are
+        stored in the cache. It returns the list of written files"""
+    cache = cache or getRecordCache()
+    written = []
+    cached = cache.getMany(database, recordType, jobs)
+    for id, data in cached.items():
+        writeAtomically(jobs[id], data)
+        written.append(jobs[id])
+    missingJobs = {id: fnOut for id, fnOut in jobs.items() if not id in cached}
+    print("  %d records taken from the cache, %d to download" % (len(written), len(missingJobs)))
+    sys.stdout.flush()
+    if len(missingJobs)>0:
+        downloaded = set(fetchMissing(missingJobs))
+        records = {}
+        for id, fnOut in missingJobs.items():
+            if fnOut in downloaded:
+                with open(fnOut, 'rb') as fh:
+                    records[id] = fh.read()
+                written.append(fnOut)
+        cache.putMany(database, recordType, records)
+    return written
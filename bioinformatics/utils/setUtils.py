@@ -0,0 +1,281 @@
+# **************************************************************************
+# *
+# * Authors:     Carlos Oscar Sorzano (coss@cnb.csic.es)
+# *
+# * Unidad de  Bioinformatica of Centro Nacional de Biotecnologia , CSIC
+# *
+# * This program is free software; you can redistribute it and/or modify
+# * it under the terms of the GNU General Public License as published by
+# * the Free Software Foundation; either version 2 of the License, or
+# * (at your option) any later version.
+# *
+# * This program is distributed in the hope that it will be useful,
+# * but WITHOUT ANY WARRANTY; without even the implied warranty of
+# * MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# * GNU General Public License for more details.
+# *
+# * You should have received a copy of the GNU General Public License
+# * along with this program; if not, write to the Free Software
+# * Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA
+# * 02111-1307  USA
+# *
+# *  All comments concerning this program package may be sent to the
+# *  e-mail address 'scipion@cnb.csic.es'
+# *
+# **************************************************************************
+
+"""
+Operations on the SQLite file of a set. The items of a set are the rows of its Objects table, and the
+Classes table maps every attribute (label_property) to its column (c01, c02, ...) and class.
+Operating on a copy of the file avoids building a Python object per item.
+"""
+
+import contextlib
+import heapq
+from math import ceil
+from operator import itemgetter
+import os
+import pickle
+import shutil
+import sqlite3
+import tempfile
+
+NUMERIC_CLASSES = ('Float', 'Integer', 'Boolean')
+
+def getSetColumns(fnSqlite):
+    """ Dictionary attribute -> (column, class name) of the items stored in a set file"""
+    with contextlib.closing(sqlite3.connect(fnSqlite)) as conn, conn:
+        rows = conn.execute("SELECT label_property, column_name, class_name FROM Classes ORDER BY id").fetchall()
+    return {label: (column, className) for label, column, className in rows if label != 'self'}
+
+def rowClass(attributes):
+    """ Class of the rows of iterSetRows: a tuple (objId, value1, value2, ...) with a read-only property per
+        attribute. It is a namedtuple that admits attribute names starting with an underscore"""
+    attributes = tuple(attributes)
+    def rowRepr(row):
+        return "Row(%s)" % ", ".join(["objId=%s" % row[0]]+["%s=%r" % (attribute, value)
+                                                             for attribute, value in zip(attributes, row[1:])])
+    namespace = {'__slots__': (), '__repr__': rowRepr, 'objId': property(itemgetter(0))}
+    for i, attribute in enumerate(attributes):
+        namespace[attribute] = property(itemgetter(i+1))
+    return type('Row', (tuple,), namespace)
+
+def iterSetRows(fnSqlite, attributes=None, column=None, values=None, chunk=None):
+    """ Iterate over the items of a set file yielding light rows (see rowClass) with the id and some
+        attributes (all if None). The values are those stored in SQLite, e.g. Boolean is 0 or 1.
+        If column is given, only the items whose column takes one of values are returned. The values are
+        loaded into a temporary table, so that the query uses the index of the column if there is one.
+        If chunk=(i, n) is given, only the items of the i-th of n consecutive id ranges are returned,
+        which SQLite reads directly from the primary key"""
+    setColumns = getSetColumns(fnSqlite)
+    if attributes is None:
+        attributes = list(setColumns)
+    missing = [attribute for attribute in list(attributes)+([column] if column is not None else [])
+               if not attribute in setColumns]
+    if len(missing)>0:
+        raise ValueError("%s are not columns of %s" % (", ".join(missing), fnSqlite))
+    Row = rowClass(attributes)
+    with contextlib.closing(sqlite3.connect(fnSqlite)) as conn:
+        conditions = []
+        if column is not None:
+            conn.execute("CREATE TEMP TABLE lookupValues (value PRIMARY KEY)")
+            conn.executemany("INSERT OR IGNORE INTO lookupValues VALUES (?)", ((value,) for value in values))
+            conditions.append("%s IN (SELECT value FROM lookupValues)" % setColumns[column][0])
+        if chunk is not None:
+            i, n = chunk
+            minId, maxId = conn.execute("SELECT MIN(id), MAX(id) FROM Objects").fetchone()
+            if minId is None:
+                return
+            step = (maxId-minId)//n+1
+            conditions.append("id >= %d AND id < %d" % (minId+i*step, minId+(i+1)*step))
+        where = " WHERE "+" AND ".join(conditions) if len(conditions)>0 else ""
+        for values in conn.execute("SELECT id%s FROM Objects%s ORDER BY id" %
+                                   ("".join([", "+setColumns[attribute][0] for attribute in attributes]), where)):
+            yield Row(values)
+
+def copySetFile(inputSet, outputSet):
+    """ Replace the (empty) file of outputSet by a copy of the file of inputSet. It returns the file name"""
+    fnOut = outputSet.getFileName()
+    outputSet.close()
+    shutil.copyfile(inputSet.getFileName(), fnOut)
+    return fnOut
+
+def keepRows(fnSqlite, ids):
+    """ Keep only the rows whose id is in ids"""
+    with contextlib.closing(sqlite3.connect(fnSqlite)) as conn, conn:
+        conn.execute("CREATE TEMP TABLE keepIds (id INTEGER PRIMARY KEY)")
+        conn.executemany("INSERT INTO keepIds VALUES (?)", ((int(objId),) for objId in ids))
+        conn.execute("DELETE FROM Objects WHERE id NOT IN (SELECT id FROM keepIds)")
+
+def uniqueRows(fnSqlite, column):
+    """ Keep the first row of each distinct value of column"""
+    with contextlib.closing(sqlite3.connect(fnSqlite)) as conn, conn:
+        conn.execute("DELETE FROM Objects WHERE id NOT IN (SELECT MIN(id) FROM Objects GROUP BY %s)" % column)
+
+def topRows(fnSqlite, column, n=None, percentile=None, top=True):
+    """ Keep the n rows with the largest (top) or smallest (bottom) values of column, or the given percentile
+        of the rows. Ties are resolved by id, so exactly n rows are kept. The rows keep their order"""
+    with contextlib.closing(sqlite3.connect(fnSqlite)) as conn, conn:
+        if percentile is not None:
+            size = conn.execute("SELECT COUNT(*) FROM Objects").fetchone()[0]
+            n = ceil(percentile/100*size)
+        # SQLite sorts with a bounded heap when the ORDER BY has a LIMIT
+        conn.execute("DELETE FROM Objects WHERE id NOT IN (SELECT id FROM Objects WHERE %s IS NOT NULL "
+                     "ORDER BY %s %s, id LIMIT ?)" % (column, column, "DESC" if top else "ASC"), (n,))
+
+def countRows(fnSqlite, column, label='count'):
+    """ Add a new Integer attribute (label) with the number of rows that share the value of column"""
+    with contextlib.closing(sqlite3.connect(fnSqlite)) as conn, conn:
+        nColumns = conn.execute("SELECT COUNT(*) FROM Classes").fetchone()[0]
+        countColumn = 'c%02d' % nColumns
+        conn.execute("ALTER TABLE Objects ADD COLUMN %s INTEGER DEFAULT NULL" % countColumn)
+        conn.execute("INSERT INTO Classes (label_property, column_name, class_name) VALUES (?, ?, 'Integer')",
+                     (label, countColumn))
+        conn.execute("CREATE TEMP TABLE counts AS SELECT %s AS value, COUNT(*) AS n FROM Objects GROUP BY %s" %
+                     (column, column))
+        conn.execute("CREATE INDEX temp.countsValue ON counts (value)")
+        conn.execute("UPDATE Objects SET %s = (SELECT n FROM counts WHERE value = Objects.%s) WHERE %s IS NOT NULL" %
+                     (countColumn, column, column))
+        conn.execute("UPDATE Objects SET %s = (SELECT COUNT(*) FROM Objects WHERE %s IS NULL) WHERE %s IS NULL" %
+                     (countColumn, column, column))
+
+def intersectRows(fnSqlite, column, fnSecond, secondColumn):
+    """ Keep the rows whose value of column is among the values of secondColumn in the set file fnSecond"""
+    with contextlib.closing(sqlite3.connect(fnSqlite)) as conn, conn:
+        conn.execute("ATTACH DATABASE ? AS second", (fnSecond,))
+        conn.execute("CREATE TEMP TABLE secondValues AS SELECT DISTINCT %s AS value FROM second.Objects "
+                     "WHERE %s IS NOT NULL" % (secondColumn, secondColumn))
+        conn.execute("DELETE FROM Objects WHERE %s IS NULL OR %s NOT IN (SELECT value FROM secondValues)" %
+                     (column, column))
+        conn.commit()
+        conn.execute("DETACH DATABASE second")
+
+def joinRows(fnSqlite, column, fnSecond, secondColumn, joinType='inner', suffix='_2'):
+    """ Join the rows with those of the set file fnSecond whose secondColumn is equal to column. joinType is
+        inner (one row per matching pair), left (also the rows without a match, with empty attributes from
+        the second set) or anti (only the rows without a match, and no new attributes). The attributes of the
+        second set but its key are added as new columns, with suffix if the name is already in use.
+        The second set is copied to a temporary table indexed by the key and SQLite writes the joined rows
+        in order, so that the memory is bounded"""
+    with contextlib.closing(sqlite3.connect(fnSqlite)) as conn, conn:
+        conn.execute("ATTACH DATABASE ? AS second", (fnSecond,))
+        if joinType=='anti':
+            conn.execute("DELETE FROM Objects WHERE %s IN (SELECT %s FROM second.Objects)" % (column, secondColumn))
+        else:
+            usedNames = set(row[0].split('.')[0] for row in conn.execute("SELECT label_property FROM Classes"))
+            nColumns = conn.execute("SELECT COUNT(*) FROM Classes").fetchone()[0]
+            sqlTypes = {row[1]: row[2] for row in conn.execute("PRAGMA second.table_info(Objects)")}
+            renamed = {}
+            newColumns = []
+            for label, secondName, className in conn.execute("SELECT label_property, column_name, class_name "
+                                                             "FROM second.Classes ORDER BY id").fetchall():
+                if label=='self' or secondName==secondColumn:
+                    continue
+                name = label.split('.')[0]
+                if not name in renamed:
+                    renamed[name] = name
+                    while renamed[name] in usedNames:
+                        renamed[name] += suffix
+                    usedNames.add(renamed[name])
+                newColumn = 'c%02d' % (nColumns+len(newColumns))
+                conn.execute("ALTER TABLE Objects ADD COLUMN %s %s DEFAULT NULL" %
+                             (newColumn, sqlTypes.get(secondName) or 'TEXT'))
+                conn.execute("INSERT INTO Classes (label_property, column_name, class_name) VALUES (?, ?, ?)",
+                             (renamed[name]+label[len(name):], newColumn, className))
+                newColumns.append((newColumn, secondName))
+
+            conn.execute("CREATE TEMP TABLE secondRows AS SELECT id AS secondId, %s AS joinKey%s FROM second.Objects "
+                         "WHERE %s IS NOT NULL" % (secondColumn, "".join([", "+secondName for _, secondName in newColumns]),
+                                                   secondColumn))
+            conn.execute("CREATE INDEX temp.secondRowsKey ON secondRows (joinKey, secondId)")
+
+            createTable = conn.execute("SELECT sql FROM sqlite_master WHERE type='table' AND name='Objects'").fetchone()[0]
+            createIndexes = [row[0] for row in conn.execute("SELECT sql FROM sqlite_master WHERE type='index' AND "
+                                                            "tbl_name='Objects' AND sql IS NOT NULL")]
+            newNames = [newColumn for newColumn, _ in newColumns]
+            columns = [row[1] for row in conn.execute("PRAGMA table_info(Objects)")
+                       if row[1] != 'id' and not row[1] in newNames]
+            conn.execute("ALTER TABLE Objects RENAME TO ObjectsUnjoined")
+            conn.execute(createTable)
+            conn.execute("INSERT INTO Objects (%s) SELECT %s FROM ObjectsUnjoined AS l %sJOIN secondRows AS r "
+                         "ON l.%s = r.joinKey ORDER BY l.id, r.secondId" %
+                         (", ".join(columns+newNames),
+                          ", ".join(["l."+name for name in columns]+["r."+secondName for _, secondName in newColumns]),
+                          "LEFT " if joinType=='left' else "", column))
+            conn.execute("DROP TABLE ObjectsUnjoined")
+            for createIndex in createIndexes:
+                conn.execute(createIndex)
+        conn.commit()
+        conn.execute("DETACH DATABASE second")
+
+def sortRows(fnSqlite, keys):
+    """ Renumber the rows so that iterating the set by id follows the sort keys, a list of
+        (column, descending). Ties keep their order. SQLite sorts large tables externally,
+        with temporary files, so the memory is bounded"""
+    orderBy = ", ".join(["%s %s" % (column, "DESC" if descending else "ASC") for column, descending in keys])
+    with contextlib.closing(sqlite3.connect(fnSqlite)) as conn, conn:
+        createTable = conn.execute("SELECT sql FROM sqlite_master WHERE type='table' AND name='Objects'").fetchone()[0]
+        createIndexes = [row[0] for row in conn.execute("SELECT sql FROM sqlite_master WHERE type='index' AND "
+                                                        "tbl_name='Objects' AND sql IS NOT NULL")]
+        columns = [row[1] for row in conn.execute("PRAGMA table_info(Objects)") if row[1] != 'id']
+        conn.execute("ALTER TABLE Objects RENAME TO ObjectsUnsorted")
+        conn.execute(createTable)
+        conn.execute("INSERT INTO Objects (%s) SELECT %s FROM ObjectsUnsorted ORDER BY %s, id" %
+                     (", ".join(columns), ", ".join(columns), orderBy))
+        conn.execute("DROP TABLE ObjectsUnsorted")
+        for createIndex in createIndexes:
+            conn.execute(createIndex)
+
+class Reversed:
+    """ Wrapper that inverts the order of a value, to sort by several keys in different directions"""
+    __slots__ = ('value',)
+
+    def __init__(self, value):
+        self.value = value
+
+    def __lt__(self, other):
+        return other.value < self.value
+
+    def __eq__(self, other):
+        return self.value == other.value
+
+def _writeChunk(chunk, fnDir):
+    fh, fnChunk = tempfile.mkstemp(dir=fnDir, suffix=".chunk")
+    with os.fdopen(fh, 'wb') as fhChunk:
+        for entry in chunk:
+            pickle.dump(entry, fhChunk)
+    return fnChunk
+
+def _readChunk(fnChunk):
+    with open(fnChunk, 'rb') as fh:
+        while True:
+            try:
+                yield pickle.load(fh)
+            except EOFError:
+                break
+
+def externalSort(entries, descending, fnDir, chunkSize=100000):
+    """ Sort (values, id) pairs, where values is a tuple with one value per sort key, and yield the ids.
+        descending has a boolean per key. Sorted chunks of chunkSize pairs are written to fnDir and merged,
+        so that the memory is bounded. Ties are resolved by id. Missing values (None) go first in ascending
+        order and last in descending order, as NULL in SQLite"""
+    def sortKey(entry):
+        values, objId = entry
+        return tuple(Reversed((value is not None, value)) if reverse else (value is not None, value)
+                     for value, reverse in zip(values, descending)) + (objId,)
+
+    fnChunks = []
+    chunk = []
+    for entry in entries:
+        chunk.append(entry)
+        if len(chunk) == chunkSize:
+            chunk.sort(key=sortKey)
+            fnChunks.append(_writeChunk(chunk, fnDir))
+            chunk = []
+    chunk.sort(key=sortKey)
+    try:
+        for values, objId in heapq.merge(chunk, *[_readChunk(fn) for fn in fnChunks], key=sortKey):
+            yield objId
+    finally:
+        for fnChunk in fnChunks:
+            os.remove(fnChunk)
@@ -0,0 +1,155 @@
+# **************************************************************************
+# *
+# * Authors:     Carlos Oscar Sorzano (coss@cnb.csic.es)
+# *
+# * Unidad de  Bioinformatica of Centro Nacional de Biotecnologia , CSIC
+# *
+# * This program is free software; you can redistribute it and/or modify
+# * it under the terms of the GNU General Public License as published by
+# * the Free Software Foundation; either version 2 of the License, or
+# * (at your option) any later version.
+# *
+# * This program is distributed in the hope that it will be useful,
+# * but WITHOUT ANY WARRANTY; without even the implied warranty of
+# * MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# * GNU General Public License for more details.
+# *
+# * You should have received a copy of the GNU General Public License
+# * along with this program; if not, write to the Free Software
+# * Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA
+# * 02111-1307  USA
+# *
+# *  All comments concerning this program package may be sent to the
+# *  e-mail address 'scipion@cnb.csic.es'
+# *
+# **************************************************************************
+
+import fcntl
+import gzip
+import hashlib
+import os
+import sqlite3
+import sys
+import time
+
+import lxml.etree as ET
+
+# Cross-reference databases that are extracted, and the property that describes each reference
+XREF_PROPERTIES = {'PDB': None,
+                   'EMBL': 'molecule type',
+                   'GO': 'term',
+                   'Gene3D': None,
+                   'HAMAP': 'entry name',
+                   'InterPro': 'entry name',
+                   'Pfam': 'entry name',
+                   'SUPFAM': 'entry name'}
+
+def openDump(fn):
+    return gzip.open(fn, 'rb') if fn.endswith('.gz') else open(fn, 'rb')
+
+def iterUniprotEntries(fn):
+    """ Iterate over the entries of a UniProt XML file (possibly gzipped) without loading it.
+        It yields (accessions, xrefs) where xrefs is a list of (database, id, property)"""
+    with openDump(fn) as fh:
+        for event, entry in ET.iterparse(fh, events=('end',), tag='{*}entry'):
+            accessions = []
+            xrefs = []
+            for child in entry:
+                if not isinstance(child.tag, str):
+                    continue
+                tag = ET.QName(child).localname
+                if tag == 'accession':
+                    accessions.append(child.text)
+                elif tag == 'dbReference' and child.get('type') in XREF_PROPERTIES:
+                    database = child.get('type')
+                    value = None
+                    if XREF_PROPERTIES[database] is not None:
+                        for prop in child:
+                            if isinstance(prop.tag, str) and prop.get('type') == XREF_PROPERTIES[database]:
+                                value = prop.get('value')
+                                break
+                    xrefs.append((database, child.get('id'), value))
+            yield accessions, xrefs
+            entry.clear()
+            while entry.getprevious() is not None:
+                del entry.getparent()[0]
+
+def iterIdMapping(fn):
+    """ Iterate over a UniProt idmapping.dat file (accession, database, id), grouped by accession"""
+    with openDump(fn) as fh:
+        currentAccession = None
+        xrefs = []
+        for line in fh:
+            tokens = line.decode().rstrip('\n').split('\t')
+            if len(tokens) < 3:
+                continue
+            accession, database, id = tokens[:3]
+            if accession != currentAccession:
+                if currentAccession is not None:
+                    yield [currentAccession], xrefs
+                currentAccession = accession
+                xrefs = []
+            if database in XREF_PROPERTIES:
+                xrefs.append((database, id, None))
+        if currentAccession is not None:
+            yield [currentAccession], xrefs
+
+def buildXrefIndex(fnDump, fnIndex):
+    """ Index the cross-references of a UniProt dump (XML or idmapping.dat, possibly gzipped) in an
+        SQLite database. The index is written to a temporary file and renamed when complete"""
+    fnTmp = fnIndex+".tmp"
+    if os.path.exists(fnTmp):
+        os.remove(fnTmp)
+    conn = sqlite3.connect(fnTmp)
+    conn.execute("CREATE TABLE accessions (accession TEXT, entry INTEGER)")
+    conn.execute("CREATE TABLE xrefs (entry INTEGER, database TEXT, id TEXT, property TEXT)")
+    entries = iterUniprotEntries(fnDump) if '.xml' in os.path.basename(fnDump) else iterIdMapping(fnDump)
+    accessionRows = []
+    xrefRows = []
+    t0 = time.time()
+    for n, (accessions, xrefs) in enumerate(entries):
+        accessionRows += [(accession, n) for accession in accessions]
+        xrefRows += [(n, database, id, value) for database, id, value in xrefs]
+        if len(xrefRows) > 100000:
+            conn.executemany("INSERT INTO accessions VALUES (?,?)", accessionRows)
+            conn.executemany("INSERT INTO xrefs VALUES (?,?,?,?)", xrefRows)
+            accessionRows = []
+            xrefRows = []
+            print("  %d entries indexed (%.0f entries/s)" % (n+1, (n+1)/(time.time()-t0)))
+            sys.stdout.flush()
+    conn.executemany("INSERT INTO accessions VALUES (?,?)", accessionRows)
+    conn.executemany("INSERT INTO xrefs VALUES (?,?,?,?)", xrefRows)
+    conn.execute("CREATE INDEX accessionsIndex ON accessions (accession)")
+    conn.execute("CREATE INDEX xrefsIndex ON xrefs (entry)")
+    conn.commit()
+    conn.close()
+    os.replace(fnTmp, fnIndex)
+
+class XrefIndex:
+    """ Accession -> cross-references index of a local UniProt dump. It is built once per dump file
+        (identified by its path, size and modification time) in fnDir and reused afterwards."""
+    def __init__(self, fnDump, fnDir):
+        fnDump = os.path.abspath(fnDump)
+        stat = os.stat(fnDump)
+        key = hashlib.sha1(("%s %d %d" % (fnDump, stat.st_size, stat.st_mtime)).encode()).hexdigest()
+        os.makedirs(fnDir, exist_ok=True)
+        self.fnIndex = os.path.join(fnDir, "%s.sqlite" % key)
+        with open(self.fnIndex+".lock", 'w') as fhLock:
+            fcntl.flock(fhLock, fcntl.LOCK_EX) # Only one process builds the index
+            if not os.path.exists(self.fnIndex):
+                print("Indexing %s into %s" % (fnDump, self.fnIndex))
+                sys.stdout.flush()
+                buildXrefIndex(fnDump, self.fnIndex)
+            fcntl.flock(fhLock, fcntl.LOCK_UN)
+        self.conn = sqlite3.connect(self.fnIndex)
+
+    def lookup(self, accession):
+        """ List of (database, id, property) of an accession. None if the accession is not in the dump"""
+        row = self.conn.execute("SELECT entry FROM accessions WHERE accession=?", (accession,)).fetchone()
+        if row is None:
+            return None
+        return self.conn.execute("SELECT database, id, property FROM xrefs WHERE entry=? ORDER BY rowid",
+                                 (row[0],)).fetchall()
+
+    def close(self):
+        self.conn.close()
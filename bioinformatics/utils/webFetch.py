@@ -0,0 +1,243 @@
+# **************************************************************************
+# *
+# * Authors:     Carlos Oscar Sorzano (coss@cnb.csic.es)
+# *
+# * Unidad de  Bioinformatica of Centro Nacional de Biotecnologia , CSIC
+# *
+# * This program is free software; you can redistribute it and/or modify
+# * it under the terms of the GNU General Public License as published by
+# * the Free Software Foundation; either version 2 of the License, or
+# * (at your option) any later version.
+# *
+# * This program is distributed in the hope that it will be useful,
+# * but WITHOUT ANY WARRANTY; without even the implied warranty of
+# * MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# * GNU General Public License for more details.
+# *
+# * You should have received a copy of the GNU General Public License
+# * along with this program; if not, write to the Free Software
+# * Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA
+# * 02111-1307  USA
+# *
+# *  All comments concerning this program package may be sent to the
+# *  e-mail address 'scipion@cnb.csic.es'
+# *
+# **************************************************************************
+
+from concurrent.futures import ThreadPoolExecutor
+import http.client
+import os
+import re
+import sys
+import threading
+import time
+import urllib.parse
+import uuid
+
+class WebFetcher:
+    """ Download many URLs concurrently. Each thread keeps one persistent connection per host,
+        the number of simultaneous requests to a host is limited, failed requests are retried with
+        exponential backoff, and files are written to a temporary name and renamed when complete,
+        so that a partial download never looks like a valid file. The connections opened by the
+        worker threads are closed when fetchAll and fetchBatches finish, or by close().
+
+        Typical use:
+            fetcher = WebFetcher()
+            ok = fetcher.fetchAll([(url1, fn1), (url2, fn2)])
+    """
+    def __init__(self, maxWorkers=8, maxPerHost=4, retries=3, backoff=1.0, timeout=60):
+        self.maxWorkers = maxWorkers
+        self.maxPerHost = maxPerHost
+        self.retries = retries
+        self.backoff = backoff
+        self.timeout = timeout
+        self._hostLimits = {}
+        self._lock = threading.Lock()
+        self._local = threading.local()
+        self._connections = []
+
+    def _getHostLimit(self, host):
+        with self._lock:
+            if not host in self._hostLimits:
+                self._hostLimits[host] = threading.BoundedSemaphore(self.maxPerHost)
+            return self._hostLimits[host]
+
+    def _getConnection(self, scheme, host):
+        if not hasattr(self._local, 'connections'):
+            self._local.connections = {}
+        key = (scheme, host)
+        if not key in self._local.connections:
+            if scheme == 'https':
+                connection = http.client.HTTPSConnection(host, timeout=self.timeout)
+            else:
+                connection = http.client.HTTPConnection(host, timeout=self.timeout)
+            self._local.connections[key] = connection
+            with self._lock:
+                self._connections.append(connection)
+        return self._local.connections[key]
+
+    def _dropConnection(self, scheme, host):
+        connection = self._local.connections.pop((scheme, host), None)
+        if connection is not None:
+            connection.close()
+            with self._lock:
+                if connection in self._connections:
+                    self._connections.remove(connection)
+
+    def close(self):
+        """ Close the keep-alive connections of all threads. A thread that uses the fetcher
+            afterwards reconnects"""
+        with self._lock:
+            connections = self._connections
+            self._connections = []
+        for connection in connections:
+            connection.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def _request(self, url, redirects=5):
+        """ Return the body of a GET request and the url of its next page, given by a Link header with
+            rel="next", or None. It raises IOError on failure, with a permanent flag for errors that
+            should not be retried"""
+        parsed = urllib.parse.urlsplit(url)
+        path = parsed.path or "/"
+        if parsed.query:
+            path += "?"+parsed.query
+        with self._getHostLimit(parsed.netloc):
+            connection = self._getConnection(parsed.scheme, parsed.netloc)
+            try:
+                connection.request("GET", path, headers={"Connection": "keep-alive"})
+                response = connection.getresponse()
+                body = response.read()
+            except (http.client.HTTPException, OSError) as e:
+                self._dropConnection(parsed.scheme, parsed.netloc)
+                raise IOError("%s: %s" % (url, e))
+            if response.getheader("Connection", "").lower() == "close":
+                self._dropConnection(parsed.scheme, parsed.netloc)
+        if response.status in (301, 302, 303, 307, 308) and redirects > 0:
+            return self._request(urllib.parse.urljoin(url, response.getheader("Location")), redirects-1)
+        if response.status != 200:
+            error = IOError("%s: HTTP %d %s" % (url, response.status, response.reason))
+            error.permanent = response.status in (400, 404, 410)
+            raise error
+        return body, _nextPageUrl(url, response.getheader("Link", ""))
+
+    def _get(self, url):
+        """ (body, next page url) of url, retrying with exponential backoff. None if it cannot be retrieved."""
+        for i in range(self.retries):
+            try:
+                return self._request(url)
+            except IOError as e:
+                print("  %s" % e)
+                sys.stdout.flush()
+                if getattr(e, 'permanent', False):
+                    break
+                if i+1 < self.retries:
+                    time.sleep(self.backoff*2**i)
+        return None
+
+    def get(self, url):
+        """ Return the body of url, retrying with exponential backoff. None if it cannot be retrieved."""
+        answer = self._get(url)
+        return answer[0] if answer is not None else None
+
+    def getPages(self, url, maxPages=1000):
+        """ Return the bodies of url and of the pages that follow it (Link rel="next"). None if the first
+            page cannot be retrieved, if a later page fails the pages retrieved so far are returned"""
+        pages = []
+        while url is not None and len(pages) < maxPages:
+            answer = self._get(url)
+            if answer is None:
+                break
+            body, url = answer
+            pages.append(body)
+        return pages if len(pages)>0 else None
+
+    def fetch(self, url, fnOut):
+        """ Download url into fnOut. It returns True on success"""
+        body = self.get(url)
+        if body is None:
+            return False
+        writeAtomically(fnOut, body)
+        return True
+
+    def fetchAll(self, jobs):
+        """ Download a list of (url, fnOut) concurrently. It returns the list of the files that
+            could be downloaded."""
+        try:
+            with ThreadPoolExecutor(max_workers=self.maxWorkers) as executor:
+                results = list(executor.map(lambda job: self.fetch(*job), jobs))
+        finally:
+            # The worker threads are gone, their connections cannot be reused
+            self.close()
+        return [fnOut for (url, fnOut), ok in zip(jobs, results) if ok]
+
+    def fetchBatches(self, jobs, batchUrl, splitResponse, chunkSize=100, singleUrl=None):
+        """ Download many identifiers with a few batched queries. jobs is a dictionary id -> fnOut,
+            batchUrl(ids) is the query for a chunk of ids and splitResponse(ids, body) returns a
+            dictionary id -> bytes with the part of the combined answer that belongs to each id.
+            Paginated answers (Link rel="next") are followed and every page is split.
+            The identifiers missing from the batched answers are fetched one by one from
+            singleUrl(id), if given. It returns the list of the files that could be written."""
+        ids = list(jobs)
+        chunkSize = max(chunkSize, 1)
+        chunks = [ids[i:i+chunkSize] for i in range(0, len(ids), chunkSize)]
+        try:
+            with ThreadPoolExecutor(max_workers=self.maxWorkers) as executor:
+                bodies = list(executor.map(lambda chunk: self.getPages(batchUrl(chunk)), chunks))
+        finally:
+            self.close()
+
+        written = []
+        missing = []
+        for chunk, body in zip(chunks, bodies):
+            parts = {}
+            for page in body or []:
+                try:
+                    for id, part in splitResponse(chunk, page).items():
+                        parts.setdefault(id, part)
+                except Exception as e:
+                    print("  Cannot split the answer to %s: %s" % (batchUrl(chunk), e))
+            for id in chunk:
+                if id in parts:
+                    writeAtomically(jobs[id], parts[id])
+                    written.append(jobs[id])
+                else:
+                    missing.append(id)
+        if len(missing)>0 and singleUrl is not None:
+            print("  %d entries were not in the batched answers, fetching them one by one" % len(missing))
+            sys.stdout.flush()
+            written += self.fetchAll([(singleUrl(id), jobs[id]) for id in missing])
+        return written
+
+def _nextPageUrl(url, link):
+    """ Url of the next page in a Link header (<url>; rel="next", ...), relative to url, or None"""
+    for target, params in re.findall(r'<([^>]*)>([^<]*)', link):
+        if re.search(r'\brel="?next"?', params):
+            return urllib.parse.urljoin(url, target)
+    return None
+
+def writeAtomically(fnOut, data):
+    """ Write data (bytes) into fnOut through a temporary file in the same directory.
+        The file gets the same permissions as one written with open"""
+    fnDir = os.path.dirname(os.path.abspath(fnOut))
+    while True:
+        fnTmp = os.path.join(fnDir, ".tmp_"+uuid.uuid4().hex)
+        try:
+            # Created like open(fn, 'w') does, so that the umask applies
+            fh = os.open(fnTmp, os.O_WRONLY | os.O_CREAT | os.O_EXCL, 0o666)
+            break
+        except FileExistsError:
+            continue
+    try:
+        with os.fdopen(fh, 'wb') as fhTmp:
+            fhTmp.write(data)
+        os.replace(fnTmp, fnOut)
+    except:
+        if os.path.exists(fnTmp):
+            os.remove(fnTmp)
+        raise